@@ -19,11 +19,11 @@ client = KaspiApiClient(token)
 
 print("🔍 Fetching uploads from database...")
 # Fetch recent products with upload IDs
-res = supabase.schema('Parser').table('wb_search_results').select("id, name, specs").not_.is_("specs->>kaspi_upload_id", "null").limit(100).execute()
+res = supabase.schema('Parser').table('wb_search_results').select("id, name, kaspi_upload_id, kaspi_sku").not_.is_("kaspi_upload_id", "null").limit(100).execute()
 
 tasks = {}
 for p in res.data:
-    upload_id = p['specs'].get('kaspi_upload_id')
+    upload_id = p.get('kaspi_upload_id')
     if upload_id and upload_id != "unknown":
         if upload_id not in tasks:
             tasks[upload_id] = []
@@ -41,7 +41,7 @@ for upload_id, products in tasks.items():
             # For each product in the task, check its specific result
             res_details = result.get('result', {})
             for p in products:
-                sku = p['specs'].get('kaspi_sku')
+                sku = p.get('kaspi_sku')
                 if sku in res_details:
                     status = res_details[sku].get('state')
                     if status == "ERRORS":
@@ -18,11 +18,11 @@ token = config.KASPI_API_TOKEN or os.getenv("KASPI_API_TOKEN") or os.getenv("KAS
 client = KaspiApiClient(token)
 
 print("🔍 Auditing last 50 unique uploads...")
-res = supabase.schema('Parser').table('wb_search_results').select("id, specs").not_.is_("specs->>kaspi_upload_id", "null").order("updated_at", desc=True).limit(200).execute()
+res = supabase.schema('Parser').table('wb_search_results').select("id, kaspi_upload_id").not_.is_("kaspi_upload_id", "null").order("updated_at", desc=True).limit(200).execute()
 
 tasks = {}
 for p in res.data:
-    uid = p['specs'].get('kaspi_upload_id')
+    uid = p.get('kaspi_upload_id')
     if uid and uid != "unknown" and uid not in tasks:
         tasks[uid] = p
 
@@ -0,0 +1,83 @@
+"""
+Batched Airtable writer.
+
+Airtable accepts up to 10 records per write and can upsert on a field
+(`performUpsert`), so a table of N products costs N/10 requests instead of
+one POST/PATCH per product, and records deleted in Airtable are simply
+re-created. Requests share a 5 req/s token bucket per base (Airtable's
+documented limit) and are retried after a back-off on 429 and 5xx.
+"""
+
+import os
+import sys
+import time
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rate_limit
+
+API_URL = "https://api.airtable.com/v0"
+BATCH_SIZE = 10
+BASE_RATE = 5  # requests per second per base
+MAX_RETRIES = 5
+RATE_LIMIT_BACKOFF = 30  # Airtable asks clients to wait 30s after a 429
+MERGE_FIELD = "Артикул WB"
+
+
+class AirtableBatchWriter:
+    def __init__(self, api_key, base_id, merge_field=MERGE_FIELD):
+        self.base_id = base_id
+        self.merge_field = merge_field
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        self.limiter = rate_limit.for_host(f"airtable:{base_id}", BASE_RATE)
+
+    def _send(self, table_name, payload):
+        url = f"{API_URL}/{self.base_id}/{table_name}"
+        for attempt in range(MAX_RETRIES):
+            self.limiter.acquire()
+            try:
+                resp = self.session.patch(url, json=payload, timeout=30)
+            except requests.RequestException as e:
+                print(f"⚠️ Airtable request failed ({table_name}), retrying: {e}")
+                time.sleep(2 ** attempt)
+                continue
+
+            if resp.status_code == 200:
+                return resp.json()
+            if resp.status_code == 429:
+                print(f"⏳ Airtable rate limit hit ({table_name}), waiting {RATE_LIMIT_BACKOFF}s...")
+                time.sleep(RATE_LIMIT_BACKOFF)
+                continue
+            if resp.status_code >= 500:
+                time.sleep(2 ** attempt)
+                continue
+
+            print(f"❌ Airtable Error ({table_name}): {resp.status_code} - {resp.text}")
+            return None
+        print(f"❌ Airtable batch to {table_name} gave up after {MAX_RETRIES} attempts")
+        return None
+
+    def upsert(self, table_name, records):
+        """
+        Upsert a list of `fields` dicts into a table, merging on merge_field.
+        Returns {merge_field value: Airtable record id} for records that were written.
+        """
+        ids = {}
+        for i in range(0, len(records), BATCH_SIZE):
+            batch = records[i:i + BATCH_SIZE]
+            data = self._send(table_name, {
+                "performUpsert": {"fieldsToMergeOn": [self.merge_field]},
+                "records": [{"fields": fields} for fields in batch]
+            })
+            if not data:
+                continue
+            for record in data.get("records", []):
+                key = record.get("fields", {}).get(self.merge_field)
+                if key is not None:
+                    ids[str(key)] = record.get("id")
+        print(f"  {table_name}: upserted {len(ids)}/{len(records)} records")
+        return ids
@@ -1,10 +1,18 @@
 import os
-import requests
 import time
+import sys
 import json
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from airtable_batch import AirtableBatchWriter
+from ms_code_map import get_code_map
+
 # Load env variables
 env_paths = [
     os.path.join(os.getcwd(), ".env.local"),
@@ -25,6 +33,13 @@ if not URL or not KEY:
 
 supabase: Client = create_client(URL, KEY)
 
+SYNC_DEBOUNCE_SECONDS = int(os.getenv("AIRTABLE_SYNC_DEBOUNCE", "30"))
+DIRTY_FETCH_CHUNK = 200
+FETCH_PAGE_SIZE = 1000
+SYNC_STATE_NAME = "airtable"
+# Rows written while a run is in progress are picked up again by the next one
+WATERMARK_OVERLAP = timedelta(minutes=2)
+
 def get_config():
     try:
         res = supabase.schema('Parser').table('client_configs').select('*').limit(1).execute()
@@ -34,7 +49,112 @@ def get_config():
         print(f"⚠️ Error fetching config: {e}")
     return None
 
-def sync_products():
+def get_watermark():
+    """airtable_dirty_at watermark of the last successful full sync, or None."""
+    res = supabase.schema('Parser').table('sync_state').select('watermark').eq('name', SYNC_STATE_NAME).execute()
+    if res.data:
+        return res.data[0].get('watermark')
+    return None
+
+def set_watermark(value):
+    supabase.schema('Parser').table('sync_state').upsert({
+        "name": SYNC_STATE_NAME,
+        "watermark": value,
+        "updated_at": "now()"
+    }).execute()
+
+def fields_hash(fields):
+    """Stable hash of the Airtable fields dict, stored in specs to skip unchanged rows."""
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def fetch_products(ids=None, since=None):
+    """Rows to push: the given ids, or every row whose Airtable fields changed after `since` (all rows if None)."""
+    if ids is None:
+        products = []
+        offset = 0
+        while True:
+            query = supabase.schema('Parser').table('wb_search_results').select('*')
+            if since:
+                query = query.gt('airtable_dirty_at', since)
+            res = query.order('airtable_dirty_at').order('id')\
+                .range(offset, offset + FETCH_PAGE_SIZE - 1)\
+                .execute()
+            page = res.data or []
+            products.extend(page)
+            if len(page) < FETCH_PAGE_SIZE:
+                return products
+            offset += FETCH_PAGE_SIZE
+
+    ids = list(ids)
+    products = []
+    for i in range(0, len(ids), DIRTY_FETCH_CHUNK):
+        res = supabase.schema('Parser').table('wb_search_results')\
+            .select('*')\
+            .in_('id', ids[i:i + DIRTY_FETCH_CHUNK])\
+            .execute()
+        products.extend(res.data or [])
+    return products
+
+def build_fields(product):
+    """Airtable `fields` for a wb_search_results row (Russian column names)."""
+    specs = product.get('specs') or {}
+
+    # Mapping to Russian columns per User Request
+    k_status = product.get('kaspi_status') or specs.get('kaspi_status') or ('created' if product.get('kaspi_created') else 'pending')
+
+    # Map internal status to Russian human-readable
+    status_map = {
+        'pending': 'Ожидание',
+        'moderation': 'На модерации',
+        'created': 'Опубликован',
+        'requires_fix': 'Нужна доработка',
+        'rejected': 'Отклонен',
+        'manual_review': 'Ручная проверка'
+    }
+    status_ru = status_map.get(k_status, k_status)
+
+    if specs.get('needs_manual_review'):
+         status_ru = "Проверка данных (WB)"
+
+    # Get MS Code for the Airtable column (a product just created in MS may be newer than the cached map)
+    ms_code = product.get('kaspi_sku') or specs.get('kaspi_sku') or \
+        get_code_map(supabase).get(product['id'], fetch_missing=bool(product.get('ms_created')))
+
+    # Get Moderation Comments
+    comment = specs.get('moderation_comment') or ""
+    if not comment and specs.get('kaspi_errors'):
+        errors = specs.get('kaspi_errors')
+        if isinstance(errors, list):
+            comment = "; ".join([str(e) for e in errors])
+        else:
+            comment = str(errors)
+
+    # Add Integrity Error to comment if present
+    integrity_error = specs.get('integrity_error')
+    if integrity_error:
+         if comment: comment += f" | ОШИБКА: {integrity_error}"
+         else: comment = f"ОШИБКА: {integrity_error}"
+
+    fields = {
+        "Название": product.get('name') or "Unknown",
+        "Категория": specs.get('kaspi_category') or product.get('query') or "Unknown",
+        "Бренд": product.get('brand') or "Generic",
+        "Цена": product.get('price_kzt') or 0,
+        "Артикул WB": str(product.get('id')),
+        "Код МС": ms_code or "",
+        "Статус": status_ru,
+        "Комментарий": comment,
+        "Изображение": product.get('image_url') or ""
+    }
+
+    return fields
+
+def sync_products(ids=None):
+    """
+    Push changed rows to Airtable. ids=None reads rows dirtied since the last successful
+    full sync, otherwise only those ids. Rows whose fields hash matches specs are skipped.
+    """
     config = get_config()
     if not config:
         print("❌ Config not found.")
@@ -58,159 +178,150 @@ def sync_products():
 
     print(f"🔄 Syncing to Airtable: {table_main}, {table_fix}, {table_rejected}")
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+    writer = AirtableBatchWriter(api_key, base_id)
+
+    run_started = (datetime.now(timezone.utc) - WATERMARK_OVERLAP).strftime('%Y-%m-%dT%H:%M:%SZ')
+    try:
+        # Fetch products that need sync
+        since = get_watermark() if ids is None else None
+        products = fetch_products(ids, since)
+    except Exception as e:
+        print(f"❌ sync_products fetch error: {e}")
+        return
+
+    # table -> (specs key holding the record id, records to upsert)
+    routes = {
+        table_main: ('airtable_id', []),
+        table_fix: ('airtable_fix_id', []),
+        table_rejected: ('airtable_rejected_id', [])
     }
+    by_article = {}
+    targets = {}
+    hashes = {}
+    for p in products:
+        specs = p.get('specs') or {}
+        p['specs'] = specs
+        k_status = p.get('kaspi_status') or specs.get('kaspi_status') or ('created' if p.get('kaspi_created') else 'pending')
+        fields = build_fields(p)
+        digest = fields_hash(fields)
+        if digest == specs.get('airtable_hash'):
+            continue
+        article = fields["Артикул WB"]
+        by_article[article] = p
+        hashes[article] = digest
+        targets[article] = 1
 
-    def sync_to_table(product, table_name, id_key):
-        specs = product.get('specs') or {}
-        already_synced_id = specs.get(id_key)
-        
-        # Mapping to Russian columns per User Request
-        k_status = specs.get('kaspi_status') or ('created' if product.get('kaspi_created') else 'pending')
-        
-        # Map internal status to Russian human-readable
-        status_map = {
-            'pending': 'Ожидание',
-            'moderation': 'На модерации',
-            'created': 'Опубликован',
-            'requires_fix': 'Нужна доработка',
-            'rejected': 'Отклонен',
-            'manual_review': 'Ручная проверка'
-        }
-        status_ru = status_map.get(k_status, k_status)
-        
-        if specs.get('needs_manual_review'):
-             status_ru = "Проверка данных (WB)"
-
-        # Get MS Code for the and Airtable column
-        ms_code = specs.get('kaspi_sku')
-        if not ms_code:
-            # Try to fetch from products table if available
-            try:
-                res_ms = supabase.schema('Parser').table('products').select('code').eq('article', str(product['id'])).execute()
-                if res_ms.data:
-                    ms_code = res_ms.data[0].get('code')
-            except: pass
-
-        # Get Moderation Comments
-        comment = specs.get('moderation_comment') or ""
-        if not comment and specs.get('kaspi_errors'):
-            errors = specs.get('kaspi_errors')
-            if isinstance(errors, list):
-                comment = "; ".join([str(e) for e in errors])
-            else:
-                comment = str(errors)
-        
-        # Add Integrity Error to comment if present
-        integrity_error = specs.get('integrity_error')
-        if integrity_error:
-             if comment: comment += f" | ОШИБКА: {integrity_error}"
-             else: comment = f"ОШИБКА: {integrity_error}"
-
-        fields = {
-            "Название": product.get('name') or "Unknown",
-            "Категория": specs.get('kaspi_category') or product.get('query') or "Unknown",
-            "Бренд": product.get('brand') or "Generic",
-            "Цена": product.get('price_kzt') or 0,
-            "Артикул WB": str(product.get('id')),
-            "Код МС": ms_code or "",
-            "Статус": status_ru,
-            "Комментарий": comment,
-            "Изображение": product.get('image_url') or ""
-        }
-
-        url = f"https://api.airtable.com/v0/{base_id}/{table_name}"
-        
+        # 1. Main Table (Always)
+        routes[table_main][1].append(fields)
+
+        # 2. Filter-based routing
+        if k_status == 'requires_fix' or specs.get('needs_manual_review'):
+            # Both internal 'requires_fix' and our new 'manual_review' go to the fix table
+            routes[table_fix][1].append(fields)
+            targets[article] += 1
+        elif k_status == 'rejected':
+            routes[table_rejected][1].append(fields)
+            targets[article] += 1
+
+    print(f"🔎 {len(by_article)} of {len(products)} rows changed since last sync")
+
+    written = {}
+    for table_name, (id_key, records) in routes.items():
+        if not records:
+            continue
+        print(f"📤 Upserting {len(records)} records to {table_name}...")
+        for article, record_id in writer.upsert(table_name, records).items():
+            p = by_article.get(article)
+            if not p or not record_id:
+                continue
+            p['specs'][id_key] = record_id
+            written[article] = written.get(article, 0) + 1
+
+    # Remember the hash only once every table the row belongs to has it
+    changed = {}
+    for article, count in written.items():
+        if count == targets[article]:
+            by_article[article]['specs']['airtable_hash'] = hashes[article]
+            changed[article] = by_article[article]
+
+    for p in changed.values():
         try:
-            # We use POST for all since user wants to see them in new tables
-            # But for MAIN we can use PATCH to update status
-            resp = None
-            if table_name == table_main and already_synced_id:
-                print(f"📝 Updating Main: [{product.get('id')}] {product.get('name')} (Record {already_synced_id})...")
-                resp = requests.patch(f"{url}/{already_synced_id}", headers=headers, json={"fields": fields})
-            else:
-                # For Fix/Rejected, we always want to ensure it exists
-                if already_synced_id:
-                     print(f"🔄 Updating [{product.get('id')}] {product.get('name')} in {table_name}...")
-                     resp = requests.patch(f"{url}/{already_synced_id}", headers=headers, json={"fields": fields})
-                     
-                     # 🚨 KEY FIX: If record was deleted in Airtable (404), create it again!
-                     if resp.status_code == 404:
-                         print(f"⚠️ Record {already_synced_id} not found in Airtable (deleted?). Re-creating...")
-                         resp = requests.post(url, headers=headers, json={"fields": fields})
-                else:
-                     print(f"➕ Creating [{product.get('id')}] {product.get('name')} in {table_name}...")
-                     resp = requests.post(url, headers=headers, json={"fields": fields})
-            
-            # Rate limiting
-            time.sleep(0.22)
-            
-            if resp.status_code in [200, 201]:
-                return resp.json().get('id')
-            else:
-                print(f"❌ Airtable Error ({table_name}): {resp.status_code} - {resp.text}")
-                return None
+            supabase.schema('Parser').table('wb_search_results')\
+                .update({'specs': p['specs']})\
+                .eq('id', p['id'])\
+                .execute()
         except Exception as e:
-            print(f"❌ Airtable Request Exception: {e}")
-            return None
+            print(f"❌ Error saving Airtable ids for {p['id']}: {e}")
 
-    while True:
+    print(f"✅ Sync Batch Complete. Updated {len(changed)} records.")
+
+    if ids is None and len(changed) == len(by_article):
         try:
-            # Fetch products that need sync
-            # Increase limit to 2000 to catch everything
-            res = supabase.schema('Parser').table('wb_search_results')\
-                .select('*')\
-                .order('updated_at', desc=True)\
-                .limit(2000)\
-                .execute()
-            
-            products = res.data or []
-            if not products:
-                break
-
-            processed_count = 0
-            for p in products:
-                specs = p.get('specs') or {}
-                k_status = specs.get('kaspi_status') or ('created' if p.get('kaspi_created') else 'pending')
-                
-                updated_specs = False
-                
-                # 1. Sync to Main Table (Always)
-                main_id = sync_to_table(p, table_main, 'airtable_id')
-                if main_id and main_id != specs.get('airtable_id'):
-                    specs['airtable_id'] = main_id
-                    updated_specs = True
-                
-                # 2. Filter-based routing
-                if k_status == 'requires_fix' or specs.get('needs_manual_review'):
-                     # Both internal 'requires_fix' and our new 'manual_review' go to the fix table
-                     fix_id = sync_to_table(p, table_fix, 'airtable_fix_id')
-                     if fix_id and fix_id != specs.get('airtable_fix_id'):
-                         specs['airtable_fix_id'] = fix_id
-                         updated_specs = True
-                         
-                elif k_status == 'rejected':
-                     rej_id = sync_to_table(p, table_rejected, 'airtable_rejected_id')
-                     if rej_id and rej_id != specs.get('airtable_rejected_id'):
-                         specs['airtable_rejected_id'] = rej_id
-                         updated_specs = True
-                
-                if updated_specs:
-                    supabase.schema('Parser').table('wb_search_results')\
-                        .update({'specs': specs})\
-                        .eq('id', p['id'])\
-                        .execute()
-                    processed_count += 1
-            
-            print(f"✅ Sync Batch Complete. Updated {processed_count} records.")
-            # Break after one large batch or remove if you want infinite loop (worker handles it anyway)
-            break 
+            set_watermark(run_started)
+        except Exception as e:
+            print(f"⚠️ Could not save sync watermark: {e}")
+
+# Debounced sync trigger: callers mark rows dirty, one loop pushes them in coalesced runs
+_dirty_ids = set()
+_full_requested = False
+_dirty_lock = threading.Lock()
+_sync_event = threading.Event()
+_sync_thread = None
+
+def mark_dirty(ids):
+    """Queue rows for the next sync run."""
+    ids = [i for i in (ids or []) if i is not None]
+    if not ids:
+        return
+    with _dirty_lock:
+        _dirty_ids.update(ids)
+    _sync_event.set()
+
+def request_full_sync():
+    """Queue a full sync; merges with any pending or running request."""
+    global _full_requested
+    with _dirty_lock:
+        _full_requested = True
+    _sync_event.set()
 
+def _take_pending():
+    global _full_requested
+    with _dirty_lock:
+        full, ids = _full_requested, set(_dirty_ids)
+        _full_requested = False
+        _dirty_ids.clear()
+    return full, ids
+
+def _sync_loop(debounce):
+    while True:
+        _sync_event.wait()
+        # Let triggers that arrive in the same window pile up into one run
+        time.sleep(debounce)
+        _sync_event.clear()
+
+        full, ids = _take_pending()
+        if not full and not ids:
+            continue
+        try:
+            if full:
+                print("🔄 Airtable sync: full run")
+                sync_products()
+            else:
+                print(f"🔄 Airtable sync: {len(ids)} dirty rows")
+                sync_products(ids)
         except Exception as e:
-            print(f"❌ sync_products loop error: {e}")
-            break
+            print(f"⚠️ Airtable Sync Error: {e}")
+            # Retry the rows on the next run
+            mark_dirty(ids)
+
+def start_sync_loop(debounce=SYNC_DEBOUNCE_SECONDS):
+    """Start the single background sync loop (idempotent)."""
+    global _sync_thread
+    with _dirty_lock:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_sync_loop, args=(debounce,), daemon=True)
+            _sync_thread.start()
+    return _sync_thread
 
 if __name__ == "__main__":
     sync_products()
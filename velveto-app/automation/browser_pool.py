@@ -0,0 +1,211 @@
+"""
+Pool of long-lived headless Chrome drivers.
+
+Starting Chrome (and resolving chromedriver) costs several seconds, so the
+WB parser, the market scout and the Kaspi scrapers check drivers out of a
+shared pool instead of launching one per page. Drivers are warmed up once
+(e.g. WB delivery location set to Astana), reused for up to BROWSER_MAX_USES
+checkouts and replaced when they crash.
+
+Usage:
+    with get_pool("wb").driver() as driver:
+        driver.get(url)
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from webdriver_manager.chrome import ChromeDriverManager
+
+POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+MAX_USES = int(os.getenv("BROWSER_MAX_USES", "25"))
+CHECKOUT_TIMEOUT = int(os.getenv("BROWSER_CHECKOUT_TIMEOUT", "300"))
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+WB_COOKIES_PATH = os.getenv(
+    "WB_COOKIES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "wb_location_cookies.json"),
+)
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+def _get_driver_path():
+    """Resolve chromedriver once per process instead of once per browser."""
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            _driver_path = ChromeDriverManager().install()
+        return _driver_path
+
+
+def set_wb_location(driver):
+    """Open WB with the Astana delivery location, reusing saved cookies when possible."""
+    driver.get("https://www.wildberries.ru/")
+
+    if os.path.exists(WB_COOKIES_PATH):
+        try:
+            with open(WB_COOKIES_PATH, "r", encoding="utf-8") as f:
+                for cookie in json.load(f):
+                    cookie.pop("expiry", None)
+                    driver.add_cookie(cookie)
+            driver.refresh()
+            return
+        except Exception as e:
+            print(f"⚠️ Saved WB cookies rejected, setting location again: {e}")
+
+    try:
+        loc_btn = driver.find_element(By.CSS_SELECTOR, ".simple-menu__link--address")
+        loc_btn.click()
+        time.sleep(1)
+        search_input = driver.find_element(By.CSS_SELECTOR, ".ymaps-2-1-79-searchbox-input__input")
+        search_input.send_keys("Астана")
+        time.sleep(1)
+        first_res = driver.find_element(By.CSS_SELECTOR, ".address-item")
+        first_res.click()
+        time.sleep(1)
+        select_btn = driver.find_element(By.CSS_SELECTOR, ".details-self__btn")
+        select_btn.click()
+        time.sleep(2)
+        print("Location set to Astana (attempted)")
+    except Exception:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(WB_COOKIES_PATH), exist_ok=True)
+        with open(WB_COOKIES_PATH, "w", encoding="utf-8") as f:
+            json.dump(driver.get_cookies(), f)
+    except Exception as e:
+        print(f"⚠️ Could not save WB cookies: {e}")
+
+
+class BrowserPool:
+    """Bounded set of reusable Chrome drivers."""
+
+    def __init__(self, name, size=POOL_SIZE, max_uses=MAX_USES, headless=True,
+                 user_agent=DEFAULT_USER_AGENT, warmup=None):
+        self.name = name
+        self.max_uses = max_uses
+        self.headless = headless
+        self.user_agent = user_agent
+        self.warmup = warmup
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def _create(self):
+        chrome_options = Options()
+        if self.headless:
+            chrome_options.add_argument("--headless")
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+        chrome_options.add_argument(f"user-agent={self.user_agent}")
+
+        driver = webdriver.Chrome(service=Service(_get_driver_path()), options=chrome_options)
+        if self.warmup:
+            try:
+                self.warmup(driver)
+            except Exception as e:
+                print(f"⚠️ Browser warmup failed ({self.name}): {e}")
+        with self._lock:
+            self._uses[id(driver)] = 0
+        return driver
+
+    def _destroy(self, driver):
+        with self._lock:
+            self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=CHECKOUT_TIMEOUT):
+            raise TimeoutError(f"No browser available in pool '{self.name}'")
+        try:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                return self._create()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, driver, broken=False):
+        try:
+            with self._lock:
+                uses = self._uses.get(id(driver), 0) + 1
+                self._uses[id(driver)] = uses
+            if broken or uses >= self.max_uses or not self._is_alive(driver):
+                self._destroy(driver)
+            else:
+                self._idle.put(driver)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def driver(self):
+        driver = self.acquire()
+        try:
+            yield driver
+        finally:
+            # Crashed drivers fail the liveness check and are replaced on next checkout
+            self.release(driver)
+
+    def close(self):
+        while True:
+            try:
+                self._destroy(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Site-specific setup applied once per new driver
+PROFILES = {
+    "wb": {"warmup": set_wb_location},
+}
+
+
+def get_pool(name="default", headless=True, user_agent=None):
+    """Return the process-wide pool for a profile, creating it on first use."""
+    key = name if headless else f"{name}-headed"
+    with _pools_lock:
+        if key not in _pools:
+            profile = PROFILES.get(name, {})
+            _pools[key] = BrowserPool(
+                key,
+                headless=headless,
+                user_agent=user_agent or DEFAULT_USER_AGENT,
+                warmup=profile.get("warmup"),
+            )
+        return _pools[key]
+
+
+@atexit.register
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
@@ -0,0 +1,10 @@
+-- Migration: Change tracking for incremental reparse (parse_wb_top.py --mode reparse)
+-- content_hash: hash of price / stock / image URLs from the last refresh
+-- refreshed_at: when the row was last checked against WB (changed or not)
+ALTER TABLE "Parser".wb_search_results
+ADD COLUMN IF NOT EXISTS content_hash TEXT,
+ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMPTZ;
+
+-- Keyset batches walk the primary key inside each tier, filtered by refreshed_at
+CREATE INDEX IF NOT EXISTS idx_wb_search_results_refresh
+    ON "Parser".wb_search_results(ms_created, refreshed_at, id);
@@ -0,0 +1,70 @@
+-- Migration: Atomic claim + lease for parser_queue (worker.py)
+-- Workers claim jobs through claim_parser_job() instead of select-then-update,
+-- so two hosts can never pick the same row. A claimed job holds a lease that the
+-- worker extends with heartbeat_parser_job(); jobs whose lease expired (worker died)
+-- become claimable again.
+ALTER TABLE "Parser".parser_queue
+ADD COLUMN IF NOT EXISTS worker_id TEXT,
+ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_parser_queue_pending
+    ON "Parser".parser_queue(created_at)
+    WHERE status = 'pending';
+
+CREATE OR REPLACE FUNCTION "Parser".claim_parser_job(p_worker_id TEXT, p_lease_seconds INTEGER DEFAULT 120)
+RETURNS SETOF "Parser".parser_queue
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    UPDATE "Parser".parser_queue q
+    SET status = 'processing',
+        worker_id = p_worker_id,
+        lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+        updated_at = NOW()
+    WHERE q.id = (
+        SELECT id FROM "Parser".parser_queue
+        WHERE status = 'pending'
+           OR (status = 'processing' AND lease_expires_at < NOW())
+        -- Search jobs first, then everything else, oldest first
+        ORDER BY (mode = 'search') DESC, created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING q.*;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION "Parser".heartbeat_parser_job(p_job_id BIGINT, p_worker_id TEXT, p_lease_seconds INTEGER DEFAULT 120)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE "Parser".parser_queue
+    SET lease_expires_at = NOW() + make_interval(secs => p_lease_seconds)
+    WHERE id = p_job_id AND worker_id = p_worker_id AND status = 'processing';
+    RETURN FOUND;
+END;
+$$;
+
+-- Wake idle workers (LISTEN parser_queue) when work is added
+CREATE OR REPLACE FUNCTION "Parser".notify_parser_queue()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('parser_queue', NEW.id::text);
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS parser_queue_notify ON "Parser".parser_queue;
+CREATE TRIGGER parser_queue_notify
+    AFTER INSERT OR UPDATE OF status ON "Parser".parser_queue
+    FOR EACH ROW
+    EXECUTE FUNCTION "Parser".notify_parser_queue();
+
+GRANT EXECUTE ON FUNCTION "Parser".claim_parser_job(TEXT, INTEGER) TO anon, authenticated, service_role;
+GRANT EXECUTE ON FUNCTION "Parser".heartbeat_parser_job(BIGINT, TEXT, INTEGER) TO anon, authenticated, service_role;
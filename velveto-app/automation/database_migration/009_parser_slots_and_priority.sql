@@ -0,0 +1,67 @@
+-- Migration: Per-mode slot pools and job priority for worker.py
+-- claim_parser_job now only hands out jobs for modes that have a free slot on the
+-- calling worker, highest priority first. Modes other than 'top'/'reparse' count as 'search'.
+ALTER TABLE "Parser".parser_queue
+ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0;
+
+DROP INDEX IF EXISTS "Parser".idx_parser_queue_pending;
+CREATE INDEX IF NOT EXISTS idx_parser_queue_pending
+    ON "Parser".parser_queue(priority DESC, created_at)
+    WHERE status = 'pending';
+
+DROP FUNCTION IF EXISTS "Parser".claim_parser_job(TEXT, INTEGER);
+
+CREATE OR REPLACE FUNCTION "Parser".claim_parser_job(p_worker_id TEXT, p_modes TEXT[], p_lease_seconds INTEGER DEFAULT 120)
+RETURNS SETOF "Parser".parser_queue
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    UPDATE "Parser".parser_queue q
+    SET status = 'processing',
+        worker_id = p_worker_id,
+        lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+        updated_at = NOW()
+    WHERE q.id = (
+        SELECT id FROM "Parser".parser_queue
+        WHERE (status = 'pending' OR (status = 'processing' AND lease_expires_at < NOW()))
+          AND (CASE WHEN mode IN ('top', 'reparse') THEN mode ELSE 'search' END) = ANY(p_modes)
+        ORDER BY priority DESC, created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING q.*;
+END;
+$$;
+
+-- Pending jobs per slot mode, for worker metrics
+CREATE OR REPLACE FUNCTION "Parser".parser_queue_depth()
+RETURNS TABLE(mode TEXT, pending BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT (CASE WHEN q.mode IN ('top', 'reparse') THEN q.mode ELSE 'search' END) AS mode, COUNT(*) AS pending
+    FROM "Parser".parser_queue q
+    WHERE q.status = 'pending'
+    GROUP BY 1;
+$$;
+
+-- Latest slot usage / queue depth reported by each worker process
+CREATE TABLE IF NOT EXISTS "Parser".worker_status (
+    worker_id TEXT PRIMARY KEY,
+    slots JSONB,
+    queue_depth JSONB,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE "Parser".worker_status ENABLE ROW LEVEL SECURITY;
+DO $$
+BEGIN
+    CREATE POLICY "Full access" ON "Parser".worker_status FOR ALL USING (true) WITH CHECK (true);
+EXCEPTION WHEN duplicate_object THEN
+    NULL;
+END $$;
+
+GRANT ALL PRIVILEGES ON "Parser".worker_status TO anon, authenticated, service_role;
+GRANT EXECUTE ON FUNCTION "Parser".claim_parser_job(TEXT, TEXT[], INTEGER) TO anon, authenticated, service_role;
+GRANT EXECUTE ON FUNCTION "Parser".parser_queue_depth() TO anon, authenticated, service_role;
@@ -0,0 +1,62 @@
+-- Migration: Change-data-capture for the Airtable sync (airtable/sync_to_airtable.py)
+-- Periodic syncs only read wb_search_results rows whose airtable_dirty_at is after the last
+-- successful run. It moves only when a value the Airtable fields are built from changes,
+-- so the sync's own specs write (airtable ids / hash), conveyor bookkeeping and reparse
+-- refreshed_at bumps do not make rows look changed. updated_at keeps its meaning.
+
+-- An earlier version of this migration bumped updated_at on every UPDATE
+DROP TRIGGER IF EXISTS wb_search_results_touch_updated_at ON "Parser".wb_search_results;
+DROP FUNCTION IF EXISTS "Parser".touch_updated_at();
+
+ALTER TABLE "Parser".wb_search_results
+ADD COLUMN IF NOT EXISTS airtable_dirty_at TIMESTAMPTZ DEFAULT NOW();
+
+CREATE OR REPLACE FUNCTION "Parser".touch_airtable_dirty_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.airtable_dirty_at = NOW();
+    RETURN NEW;
+END;
+$$;
+
+-- Same inputs as build_fields(). kaspi_status / kaspi_sku are compared through specs: the
+-- columns only exist from migration 012, whose wb_search_results_kaspi_columns trigger mirrors
+-- them into specs and fires before this one (BEFORE triggers run in name order).
+-- Without a kaspi_sku, "Код МС" comes from Parser.products.code, which the conveyor writes
+-- just before it sets ms_created, so ms_created stands in for it.
+DROP TRIGGER IF EXISTS wb_search_results_touch_airtable_dirty ON "Parser".wb_search_results;
+CREATE TRIGGER wb_search_results_touch_airtable_dirty
+    BEFORE UPDATE ON "Parser".wb_search_results
+    FOR EACH ROW
+    WHEN ((OLD.name, OLD.query, OLD.brand, OLD.price_kzt, OLD.image_url, OLD.kaspi_created, OLD.ms_created,
+           OLD.specs->'kaspi_status', OLD.specs->'kaspi_sku', OLD.specs->'kaspi_category',
+           OLD.specs->'needs_manual_review', OLD.specs->'moderation_comment',
+           OLD.specs->'kaspi_errors', OLD.specs->'integrity_error')
+          IS DISTINCT FROM
+          (NEW.name, NEW.query, NEW.brand, NEW.price_kzt, NEW.image_url, NEW.kaspi_created, NEW.ms_created,
+           NEW.specs->'kaspi_status', NEW.specs->'kaspi_sku', NEW.specs->'kaspi_category',
+           NEW.specs->'needs_manual_review', NEW.specs->'moderation_comment',
+           NEW.specs->'kaspi_errors', NEW.specs->'integrity_error'))
+    EXECUTE FUNCTION "Parser".touch_airtable_dirty_at();
+
+CREATE INDEX IF NOT EXISTS idx_wb_search_results_airtable_dirty_at
+    ON "Parser".wb_search_results(airtable_dirty_at, id);
+
+-- Watermarks of incremental sync jobs, keyed by sync name
+CREATE TABLE IF NOT EXISTS "Parser".sync_state (
+    name TEXT PRIMARY KEY,
+    watermark TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE "Parser".sync_state ENABLE ROW LEVEL SECURITY;
+DO $$
+BEGIN
+    CREATE POLICY "Full access" ON "Parser".sync_state FOR ALL USING (true) WITH CHECK (true);
+EXCEPTION WHEN duplicate_object THEN
+    NULL;
+END $$;
+
+GRANT ALL PRIVILEGES ON "Parser".sync_state TO anon, authenticated, service_role;
@@ -0,0 +1,54 @@
+-- Migration: Indexed work queue for the conveyor (moysklad/process_conveyor.py)
+-- conveyor_next_attempt_at: when the row is next due (lease while claimed, back-off after errors)
+-- conveyor_attempts: consecutive failed runs, drives the back-off
+ALTER TABLE "Parser".wb_search_results
+ADD COLUMN IF NOT EXISTS conveyor_next_attempt_at TIMESTAMPTZ DEFAULT NOW(),
+ADD COLUMN IF NOT EXISTS conveyor_attempts INTEGER DEFAULT 0;
+
+-- Only actionable rows are indexed, so the claim stays cheap however many rows are done
+CREATE INDEX IF NOT EXISTS idx_wb_search_results_conveyor_queue
+    ON "Parser".wb_search_results(conveyor_next_attempt_at, id)
+    WHERE COALESCE(conveyor_status, 'idle') NOT IN ('done', 'manual_review');
+
+-- Manual resets (dashboard "retry", AI fix) and Kaspi status changes make a row due immediately
+CREATE OR REPLACE FUNCTION "Parser".conveyor_requeue()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF (NEW.conveyor_status = 'idle' AND OLD.conveyor_status IS DISTINCT FROM 'idle')
+       OR (NEW.specs->>'kaspi_status') IS DISTINCT FROM (OLD.specs->>'kaspi_status') THEN
+        NEW.conveyor_next_attempt_at = NOW();
+        NEW.conveyor_attempts = 0;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS wb_search_results_conveyor_requeue ON "Parser".wb_search_results;
+CREATE TRIGGER wb_search_results_conveyor_requeue
+    BEFORE UPDATE ON "Parser".wb_search_results
+    FOR EACH ROW EXECUTE FUNCTION "Parser".conveyor_requeue();
+
+-- Claim up to p_limit due rows; claimed rows are leased by pushing their next attempt forward
+CREATE OR REPLACE FUNCTION "Parser".claim_conveyor_batch(p_limit INTEGER DEFAULT 100, p_lease_seconds INTEGER DEFAULT 1800)
+RETURNS TABLE(id BIGINT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    UPDATE "Parser".wb_search_results w
+    SET conveyor_next_attempt_at = NOW() + make_interval(secs => p_lease_seconds)
+    WHERE w.id IN (
+        SELECT r.id FROM "Parser".wb_search_results r
+        WHERE COALESCE(r.conveyor_status, 'idle') NOT IN ('done', 'manual_review')
+          AND r.conveyor_next_attempt_at <= NOW()
+        ORDER BY r.conveyor_next_attempt_at, r.id
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING w.id::BIGINT;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION "Parser".claim_conveyor_batch(INTEGER, INTEGER) TO anon, authenticated, service_role;
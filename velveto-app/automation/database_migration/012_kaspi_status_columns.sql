@@ -0,0 +1,105 @@
+-- Migration: Promote Kaspi card state out of the specs JSONB blob
+-- kaspi_status / kaspi_sku / kaspi_upload_id become real, indexed columns so moderation
+-- counts and upload audits no longer scan specs. Run backfill_kaspi_columns.py afterwards.
+ALTER TABLE "Parser".wb_search_results
+ADD COLUMN IF NOT EXISTS kaspi_status TEXT,
+ADD COLUMN IF NOT EXISTS kaspi_sku TEXT,
+ADD COLUMN IF NOT EXISTS kaspi_upload_id TEXT;
+
+-- Moderation queue count (kaspi_created + kaspi_status) is answered from the index alone
+CREATE INDEX IF NOT EXISTS idx_wb_search_results_kaspi_status
+    ON "Parser".wb_search_results(kaspi_status, kaspi_created);
+
+CREATE INDEX IF NOT EXISTS idx_wb_search_results_kaspi_upload_id
+    ON "Parser".wb_search_results(kaspi_upload_id)
+    WHERE kaspi_upload_id IS NOT NULL;
+
+-- Keep the columns and the legacy specs keys in step while the dashboard still reads specs:
+-- whichever side a writer changed is copied to the other.
+CREATE OR REPLACE FUNCTION "Parser".sync_kaspi_columns()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    k TEXT;
+    col_new TEXT;
+    col_old TEXT;
+    spec_new TEXT;
+    spec_old TEXT;
+BEGIN
+    FOREACH k IN ARRAY ARRAY['kaspi_status', 'kaspi_sku', 'kaspi_upload_id'] LOOP
+        col_new := to_jsonb(NEW)->>k;
+        spec_new := NEW.specs->>k;
+        IF TG_OP = 'INSERT' THEN
+            col_old := NULL;
+            spec_old := NULL;
+        ELSE
+            col_old := to_jsonb(OLD)->>k;
+            spec_old := OLD.specs->>k;
+        END IF;
+
+        IF spec_new IS DISTINCT FROM spec_old AND col_new IS NOT DISTINCT FROM col_old THEN
+            NEW := jsonb_populate_record(NEW, jsonb_build_object(k, spec_new));
+        ELSIF col_new IS DISTINCT FROM col_old THEN
+            IF col_new IS NULL THEN
+                NEW.specs := COALESCE(NEW.specs, '{}'::jsonb) - k;
+            ELSE
+                NEW.specs := jsonb_set(COALESCE(NEW.specs, '{}'::jsonb), ARRAY[k], to_jsonb(col_new));
+            END IF;
+        END IF;
+    END LOOP;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS wb_search_results_kaspi_columns ON "Parser".wb_search_results;
+CREATE TRIGGER wb_search_results_kaspi_columns
+    BEFORE INSERT OR UPDATE ON "Parser".wb_search_results
+    FOR EACH ROW EXECUTE FUNCTION "Parser".sync_kaspi_columns();
+
+-- Conveyor requeue (011) also fires when only the column was written
+CREATE OR REPLACE FUNCTION "Parser".conveyor_requeue()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF (NEW.conveyor_status = 'idle' AND OLD.conveyor_status IS DISTINCT FROM 'idle')
+       OR NEW.kaspi_status IS DISTINCT FROM OLD.kaspi_status
+       OR (NEW.specs->>'kaspi_status') IS DISTINCT FROM (OLD.specs->>'kaspi_status') THEN
+        NEW.conveyor_next_attempt_at = NOW();
+        NEW.conveyor_attempts = 0;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+-- Backfill in keyset batches; returns the last id processed, NULL when done
+CREATE OR REPLACE FUNCTION "Parser".backfill_kaspi_columns(p_after_id BIGINT, p_limit INTEGER DEFAULT 1000)
+RETURNS BIGINT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id BIGINT;
+BEGIN
+    WITH batch AS (
+        SELECT id FROM "Parser".wb_search_results
+        WHERE id > p_after_id
+        ORDER BY id
+        LIMIT p_limit
+    ), updated AS (
+        UPDATE "Parser".wb_search_results w
+        SET kaspi_status = w.specs->>'kaspi_status',
+            kaspi_sku = w.specs->>'kaspi_sku',
+            kaspi_upload_id = w.specs->>'kaspi_upload_id'
+        FROM batch
+        WHERE w.id = batch.id
+          AND (w.kaspi_status IS DISTINCT FROM w.specs->>'kaspi_status'
+               OR w.kaspi_sku IS DISTINCT FROM w.specs->>'kaspi_sku'
+               OR w.kaspi_upload_id IS DISTINCT FROM w.specs->>'kaspi_upload_id')
+    )
+    SELECT MAX(id) INTO last_id FROM batch;
+    RETURN last_id;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION "Parser".backfill_kaspi_columns(BIGINT, INTEGER) TO service_role;
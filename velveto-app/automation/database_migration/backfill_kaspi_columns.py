@@ -0,0 +1,49 @@
+import os
+from dotenv import load_dotenv
+from supabase import create_client, Client
+
+# Copies specs.kaspi_status / kaspi_sku / kaspi_upload_id into the columns added by
+# 012_kaspi_status_columns.sql, in keyset batches so it can run against a live table.
+env_paths = [
+    os.path.join(os.getcwd(), ".env.local"),
+    os.path.join(os.path.dirname(__file__), "..", "..", ".env.local"),
+    os.path.join(os.getcwd(), ".env")
+]
+for path in env_paths:
+    if os.path.exists(path):
+        load_dotenv(path)
+        break
+
+SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+if not SUPABASE_URL or not SUPABASE_KEY:
+    print("Error: NEXT_PUBLIC_SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not found")
+    exit(1)
+
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+BATCH_SIZE = 1000
+
+def backfill():
+    print("📦 Backfilling Kaspi columns on wb_search_results...")
+    last_id = 0
+    batches = 0
+    while True:
+        try:
+            res = supabase.schema('Parser').rpc('backfill_kaspi_columns', {
+                "p_after_id": last_id,
+                "p_limit": BATCH_SIZE
+            }).execute()
+        except Exception as e:
+            print(f"❌ Backfill failed after id {last_id}: {e}")
+            return
+        if res.data is None:
+            break
+        last_id = res.data
+        batches += 1
+        print(f"   Processed up to id {last_id} ({batches} batches)")
+    print("✅ Backfill complete.")
+
+if __name__ == "__main__":
+    backfill()
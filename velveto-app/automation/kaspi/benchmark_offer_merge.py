@@ -0,0 +1,149 @@
+"""
+Benchmark for the Kaspi price feed build (generate_fixed_price + feed_store) on a synthetic feed.
+
+Builds a Fixcom feed of --offers offers (default 100k). A share of them belongs
+to --local local products, as "<id>" or "<id>_<suffix>" SKUs. The benchmark
+times:
+  - ingesting the feed into a scratch FeedStore (iter_upstream),
+  - assembling price.xml with local-product suppression,
+  - an incremental update of --patch local offers followed by reassembly,
+  - the old loop over every local id on a sample of offers (--legacy-sample),
+    checked against the store's result because the full feed takes minutes.
+
+    python3 benchmark_offer_merge.py
+    python3 benchmark_offer_merge.py --offers 200000 --local 10000
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from generate_fixed_price import iter_upstream, build_local_offer, serialize
+from feed_store import FeedStore, UNSUPPRESSED_FIXCOM
+
+NS_MAP = {'k': 'kaspiShopping'}
+OFFER_TAG = '{kaspiShopping}offer'
+
+
+def build_feed(n_offers, local_ids, overlap):
+    """Feed root with n_offers offers, about `overlap` of them owned by a local id."""
+    rnd = random.Random(42)
+    root = ET.Element('{kaspiShopping}kaspi_catalog', date="01.01.2025 00:00")
+    ET.SubElement(root, '{kaspiShopping}company').text = "Fixcom"
+    offers_node = ET.SubElement(root, '{kaspiShopping}offers')
+    local_list = list(local_ids)
+    for i in range(n_offers):
+        if local_list and rnd.random() < overlap:
+            base = rnd.choice(local_list)
+            sku = base if rnd.random() < 0.5 else f"{base}_{rnd.randint(1, 9)}"
+        else:
+            sku = f"fx{i}_{rnd.randint(100, 999)}"
+        offer = ET.SubElement(offers_node, OFFER_TAG, sku=sku)
+        ET.SubElement(offer, '{kaspiShopping}price').text = str(rnd.randint(1000, 90000))
+    return root
+
+
+def feed_bytes(root):
+    ET.register_namespace('', 'kaspiShopping')
+    return ET.tostring(root, encoding="utf-8")
+
+
+def store_merge(store, data, local_ids):
+    """Ingest + suppress; returns (kept Fixcom SKUs, suppressed SKUs)."""
+    store.replace_upstream(iter_upstream(io.BytesIO(data)))
+    store.set_local_ids(local_ids, replace=True)
+    kept = set(sku for (sku,) in store.conn.execute(UNSUPPRESSED_FIXCOM.format(columns="sku")))
+    every = [sku for (sku,) in store.conn.execute("SELECT sku FROM fragments WHERE source = 'fixcom'")]
+    return kept, [sku for sku in every if sku not in kept]
+
+
+def legacy_merge(root, local_ids):
+    """The previous implementation: every offer is tested against every local id."""
+    offers_node = root.find('k:offers', NS_MAP)
+    existing_skus = set(o.get('sku') for o in offers_node.findall('k:offer', NS_MAP) if o.get('sku'))
+    offers_to_remove = []
+    for offer in offers_node.findall('k:offer', NS_MAP):
+        sku = offer.get('sku')
+        if sku:
+            for local_id in local_ids:
+                if sku == local_id or sku.startswith(local_id + "_"):
+                    offers_to_remove.append(offer)
+                    existing_skus.discard(sku)
+                    break
+    for offer in offers_to_remove:
+        offers_node.remove(offer)
+    return existing_skus, [o.get('sku') for o in offers_to_remove]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def local_fragment(pid, price):
+    product = {"id": pid, "name": f"Local product {pid}", "price_kzt": price, "specs": {"stock": 10}}
+    return serialize(build_local_offer(product, f"ms{pid}"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--offers", type=int, default=100000)
+    parser.add_argument("--local", type=int, default=5000)
+    parser.add_argument("--overlap", type=float, default=0.05, help="Share of offers owned by local products")
+    parser.add_argument("--patch", type=int, default=10, help="Local offers changed in the incremental run")
+    parser.add_argument("--legacy-sample", type=int, default=5000, help="Offers used for the old algorithm (0 to skip)")
+    args = parser.parse_args()
+
+    local_ids = set(str(100000000 + i * 7) for i in range(args.local))
+    data = feed_bytes(build_feed(args.offers, local_ids, args.overlap))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = FeedStore(os.path.join(tmp, "feed_state.sqlite3"))
+
+        _, took = timed(store.replace_upstream, iter_upstream(io.BytesIO(data)))
+        print(f"📊 ingest: {args.offers} offers ({len(data) / 1e6:.1f} MB) in {took * 1000:.0f} ms")
+
+        def add_locals():
+            with store.transaction():
+                store.set_local_ids(local_ids, replace=True)
+                for pid in local_ids:
+                    store.upsert_local(pid, f"ms{pid}", local_fragment(pid, 5000))
+        _, took = timed(add_locals)
+        print(f"📊 {args.local} local offers stored in {took * 1000:.0f} ms")
+
+        out = io.BytesIO()
+        (fixcom, local, suppressed), took = timed(store.write_feed, out)
+        print(f"📊 assemble: {fixcom} Fixcom + {local} local offers ({suppressed} suppressed), "
+              f"{out.getbuffer().nbytes / 1e6:.1f} MB in {took * 1000:.0f} ms")
+
+        def patch():
+            with store.transaction():
+                for pid in list(local_ids)[:args.patch]:
+                    store.upsert_local(pid, f"ms{pid}", local_fragment(pid, 6000))
+            store.write_feed(io.BytesIO())
+        _, took = timed(patch)
+        print(f"📊 incremental: {args.patch} changed offers + reassembly in {took * 1000:.0f} ms")
+
+        if args.legacy_sample:
+            sample = min(args.legacy_sample, args.offers)
+            sample_store = FeedStore(os.path.join(tmp, "sample.sqlite3"))
+            sample_data = feed_bytes(build_feed(sample, local_ids, args.overlap))
+            old_feed = build_feed(sample, local_ids, args.overlap)
+            (new_existing, new_suppressed), new_took = timed(store_merge, sample_store, sample_data, local_ids)
+            (old_existing, old_suppressed), old_took = timed(legacy_merge, old_feed, local_ids)
+            same = new_existing == old_existing and sorted(new_suppressed) == sorted(old_suppressed)
+            print(f"📊 {sample} offers: store merge {new_took * 1000:.1f} ms, "
+                  f"legacy loop {old_took * 1000:.1f} ms ({old_took / max(new_took, 1e-9):.0f}x), "
+                  f"{'same result' if same else 'RESULTS DIFFER'}")
+            print(f"   Legacy extrapolated to {args.offers} offers: ~{old_took * args.offers / sample:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
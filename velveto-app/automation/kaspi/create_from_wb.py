@@ -378,7 +378,9 @@ def create_from_wb(article_input):
                 # Save back with only existing columns
                 update_data = {
                     "kaspi_created": True,
-                    # "kaspi_status": "moderation", # Column doesn't exist, stored in specs
+                    "kaspi_status": "moderation",
+                    "kaspi_sku": sku,
+                    "kaspi_upload_id": upload_id or "unknown",
                     "specs": specs
                 }
                 
@@ -0,0 +1,244 @@
+"""
+Per-SKU state of the Kaspi price feed (price.xml).
+
+Every offer is kept as its serialized XML fragment plus a content hash in a
+small SQLite file (data/feed_state.sqlite3). When the upstream feed changes,
+only the Fixcom offers whose hash changed are rewritten. Local offers are
+upserted one product at a time, and an unchanged hash is a no-op. The feed is then assembled by
+concatenating the stored fragments, with no parsing or serializing, and only
+when something changed since the last build.
+
+Suppression matches generate_fixed_price: a Fixcom offer whose SKU is "X" or
+"X_..." is dropped while X is a local product (kaspi_created), and a local
+offer whose SKU is still a Fixcom SKU after that is skipped. Fixcom offers are
+kept per upstream position (duplicate upstream SKUs all ship, as before) and
+local offers per product; when two products share a SKU, only the first
+(lowest id) is published.
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+DB_PATH = os.getenv(
+    "FEED_STATE_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "feed_state.sqlite3"),
+)
+DATE_PLACEHOLDER = "__FEED_DATE__"
+# Bumped when the fragments layout changes; the store is a cache and is rebuilt from scratch
+SCHEMA_VERSION = "2"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fragments (
+    source TEXT NOT NULL,      -- 'fixcom' or 'local'
+    sku TEXT NOT NULL,         -- '' for Fixcom offers without one
+    owner TEXT NOT NULL,       -- fixcom: SKU up to the first '_'; local: wb_search_results.id
+    position INTEGER NOT NULL, -- upstream order for fixcom offers, 0 for local ones
+    hash TEXT NOT NULL,
+    xml BLOB NOT NULL,
+    PRIMARY KEY (source, owner, position)
+);
+CREATE INDEX IF NOT EXISTS idx_fragments_sku ON fragments(source, sku);
+CREATE INDEX IF NOT EXISTS idx_fragments_position ON fragments(source, position);
+CREATE TABLE IF NOT EXISTS local_ids (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+UNSUPPRESSED_FIXCOM = """
+    SELECT {columns} FROM fragments
+    WHERE source = 'fixcom' AND owner NOT IN (SELECT id FROM local_ids)
+"""
+
+
+class FeedStore:
+    def __init__(self, path=DB_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self._in_transaction = False
+        if self.get_meta('schema') != SCHEMA_VERSION:
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS fragments")
+                self.conn.execute("DELETE FROM meta")
+            self.conn.executescript(SCHEMA)
+            self.set_meta('schema', SCHEMA_VERSION)
+
+    @contextmanager
+    def transaction(self):
+        """One commit for everything inside; nested calls join the outer transaction."""
+        with self.lock:
+            if self._in_transaction:
+                yield
+                return
+            self._in_transaction = True
+            try:
+                with self.conn:
+                    yield
+            finally:
+                self._in_transaction = False
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.transaction():
+            self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+    def _mark_dirty(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('dirty', '1')")
+
+    @property
+    def dirty(self):
+        return self.get_meta('dirty') == '1'
+
+    @property
+    def has_upstream(self):
+        return self.get_meta('head') is not None
+
+    def replace_upstream(self, parts):
+        """
+        Bring the Fixcom offers in line with a feed from generate_fixed_price.iter_upstream() parts.
+        Only positions whose fragment hash changed are rewritten, and the store is marked dirty only
+        if anything changed (a feed regenerated with just a new date is a no-op). Runs in one
+        transaction: a failed parse keeps the previous offers. Returns (offers, changed offers).
+        """
+        head, tail, count, changed = [], [], 0, 0
+        with self.transaction():
+            stored = dict(self.conn.execute("SELECT position, hash FROM fragments WHERE source = 'fixcom'"))
+            for part in parts:
+                kind = part[0]
+                if kind == 'head':
+                    head.append(part[1])
+                elif kind == 'tail':
+                    tail.append(part[1])
+                else:
+                    _, sku, xml = part
+                    digest = hashlib.sha1(xml).hexdigest()
+                    if stored.get(count) != digest:
+                        owner = sku.split('_', 1)[0] if sku else ''
+                        self.conn.execute("DELETE FROM fragments WHERE source = 'fixcom' AND position = ?", (count,))
+                        self.conn.execute(
+                            "INSERT INTO fragments(source, sku, owner, position, hash, xml) VALUES ('fixcom', ?, ?, ?, ?, ?)",
+                            (sku or '', owner, count, digest, xml),
+                        )
+                        changed += 1
+                    count += 1
+            changed += self.conn.execute(
+                "DELETE FROM fragments WHERE source = 'fixcom' AND position >= ?", (count,)
+            ).rowcount
+
+            head = b"".join(head).decode("utf-8")
+            tail = b"".join(tail).decode("utf-8")
+            if changed or head != self.get_meta('head') or tail != self.get_meta('tail'):
+                self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('head', ?)", (head,))
+                self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('tail', ?)", (tail,))
+                self._mark_dirty()
+        return count, changed
+
+    def set_local_ids(self, ids, replace=False):
+        """Record local product ids (they suppress Fixcom offers); replace=True drops all others."""
+        ids = [str(i) for i in ids]
+        with self.transaction():
+            before = self.conn.total_changes
+            if replace:
+                self.conn.execute("DELETE FROM local_ids")
+            self.conn.executemany("INSERT OR IGNORE INTO local_ids(id) VALUES (?)", [(i,) for i in ids])
+            if replace:
+                # Fragments of products that are no longer local go with them
+                self.conn.execute("DELETE FROM fragments WHERE source = 'local' AND owner NOT IN (SELECT id FROM local_ids)")
+            if self.conn.total_changes != before:
+                self._mark_dirty()
+
+    def remove_local(self, ids):
+        """Forget local products entirely (no longer on Kaspi)."""
+        ids = [(str(i),) for i in ids]
+        with self.transaction():
+            before = self.conn.total_changes
+            self.conn.executemany("DELETE FROM local_ids WHERE id = ?", ids)
+            self.conn.executemany("DELETE FROM fragments WHERE source = 'local' AND owner = ?", ids)
+            if self.conn.total_changes != before:
+                self._mark_dirty()
+
+    def upsert_local(self, owner, sku, xml):
+        """Store a local product's offer; returns False when the fragment is unchanged."""
+        owner = str(owner)
+        digest = hashlib.sha1(xml).hexdigest()
+        with self.transaction():
+            row = self.conn.execute(
+                "SELECT sku, hash FROM fragments WHERE source = 'local' AND owner = ?", (owner,)
+            ).fetchone()
+            if row and row[0] == sku and row[1] == digest:
+                return False
+            other = self.conn.execute(
+                "SELECT owner FROM fragments WHERE source = 'local' AND sku = ? AND owner != ? LIMIT 1", (sku, owner)
+            ).fetchone()
+            if other:
+                print(f"⚠️ SKU {sku} of local product {owner} is also used by {other[0]}; only the first is published.")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO fragments(source, sku, owner, position, hash, xml) VALUES ('local', ?, ?, 0, ?, ?)",
+                (sku, owner, digest, xml),
+            )
+            self._mark_dirty()
+        return True
+
+    def drop_local_offer(self, owner):
+        """The product stays local (still suppresses Fixcom) but has no offer of its own."""
+        with self.transaction():
+            cur = self.conn.execute("DELETE FROM fragments WHERE source = 'local' AND owner = ?", (str(owner),))
+            if cur.rowcount:
+                self._mark_dirty()
+
+    def write_feed(self, out):
+        """Assemble the feed into `out`; returns (Fixcom offers, local offers, suppressed Fixcom offers)."""
+        with self.lock:
+            head = self.get_meta('head', '')
+            tail = self.get_meta('tail', '')
+            out.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+            out.write(head.replace(DATE_PLACEHOLDER, datetime.now().strftime('%d.%m.%Y %H:%M')).encode("utf-8"))
+            out.write(b"<offers>\n")
+
+            fixcom = 0
+            for (xml,) in self.conn.execute(UNSUPPRESSED_FIXCOM.format(columns="xml") + " ORDER BY position"):
+                out.write(xml + b"\n")
+                fixcom += 1
+
+            local = 0
+            # First product per SKU wins; later duplicates are skipped
+            for (xml,) in self.conn.execute(
+                "SELECT xml FROM fragments f WHERE source = 'local' AND sku NOT IN ("
+                + UNSUPPRESSED_FIXCOM.format(columns="sku")
+                + ") AND CAST(owner AS INTEGER) = (SELECT MIN(CAST(owner AS INTEGER)) FROM fragments"
+                " WHERE source = 'local' AND sku = f.sku) ORDER BY CAST(owner AS INTEGER)"
+            ):
+                out.write(xml + b"\n")
+                local += 1
+
+            out.write(b"</offers>\n")
+            out.write(tail.encode("utf-8"))
+
+            total_fixcom = self.conn.execute("SELECT COUNT(*) FROM fragments WHERE source = 'fixcom'").fetchone()[0]
+        return fixcom, local, total_fixcom - fixcom
+
+    def mark_clean(self):
+        self.set_meta('dirty', '0')
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FeedStore()
+        return _store
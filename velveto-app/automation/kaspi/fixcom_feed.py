@@ -0,0 +1,126 @@
+"""
+Local copy of the Fixcom upstream feed.
+
+fetch() sends If-None-Match / If-Modified-Since; after a 304 the copy on disk
+(data/fixcom_feed.xml) stays current. A new download is streamed to a temp
+file and handed to the caller, which parses it once while ingesting it into
+the FeedStore; only then is it promoted to the good copy, together with its
+validators (data/fixcom_feed.json). When the request fails or the new file
+does not parse, the last good copy stays in use, so one network error no
+longer aborts the feed build.
+
+Usage:
+    feed = FixcomFeed(FIXCOM_XML_URL)
+    pending = feed.fetch()
+    if pending:
+        try:
+            ingest(pending)
+            feed.promote()
+        except Exception:
+            feed.discard()
+"""
+
+import os
+import json
+import time
+import tempfile
+import requests
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+FEED_PATH = os.getenv("FIXCOM_FEED_PATH", os.path.join(DATA_DIR, "fixcom_feed.xml"))
+TIMEOUT = 30
+CHUNK = 1 << 16
+
+
+class FixcomFeed:
+    def __init__(self, url, path=FEED_PATH):
+        self.url = url
+        self.path = path
+        self.meta_path = os.path.splitext(path)[0] + ".json"
+        self.tmp_path = None
+        self.meta = self._load_meta()
+        self._pending_meta = None
+
+    def _load_meta(self):
+        if not (os.path.exists(self.path) and os.path.exists(self.meta_path)):
+            return {}
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Could not read Fixcom feed meta {self.meta_path}: {e}")
+            return {}
+
+    @property
+    def available(self):
+        return bool(self.meta)
+
+    @property
+    def version(self):
+        """Identifies the good copy (its fetch time), so a store can tell whether it ingested it."""
+        return str(self.meta.get("fetched_at")) if self.meta else None
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def fetch(self):
+        """
+        Download a new version into a temp file. Returns its path, or None if the good copy is
+        current or had to be kept after an error. Raises only when there is no copy to fall back to.
+        """
+        headers = {}
+        if self.available:
+            if self.meta.get("etag"):
+                headers['If-None-Match'] = self.meta["etag"]
+            if self.meta.get("last_modified"):
+                headers['If-Modified-Since'] = self.meta["last_modified"]
+
+        try:
+            print(f"📡 Fetching Fixcom XML: {self.url}")
+            resp = requests.get(self.url, headers=headers, timeout=TIMEOUT, stream=True)
+            if resp.status_code == 304:
+                print("📡 Fixcom feed unchanged (304), using local copy.")
+                return None
+            resp.raise_for_status()
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # A temp file of our own: a cron rebuild and the conveyor may fetch at the same time
+            with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(self.path), suffix=".tmp", delete=False) as f:
+                self.tmp_path = f.name
+                for chunk in resp.iter_content(CHUNK):
+                    f.write(chunk)
+            self._pending_meta = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            }
+            return self.tmp_path
+        except Exception as e:
+            self.discard()
+            if not self.available:
+                raise
+            self._warn_fallback(e)
+            return None
+
+    def promote(self):
+        """The pending download parsed: make it the good copy."""
+        os.replace(self.tmp_path, self.path)
+        self.tmp_path = None
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(self.meta_path),
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(self._pending_meta, f)
+        os.replace(f.name, self.meta_path)
+        self.meta, self._pending_meta = self._pending_meta, None
+
+    def discard(self, error=None):
+        """Drop a pending download (failed request or parse); keeps the good copy."""
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.tmp_path = None
+        self._pending_meta = None
+        if error is not None and self.available:
+            self._warn_fallback(error)
+
+    def _warn_fallback(self, error):
+        age_h = (time.time() - self.meta.get("fetched_at", 0)) / 3600
+        print(f"⚠️ Fixcom fetch failed ({error}); using local copy from {age_h:.1f}h ago.")
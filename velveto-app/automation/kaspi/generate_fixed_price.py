@@ -1,191 +1,378 @@
 import os
-import requests
+import sys
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
 from supabase import create_client
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ms_code_map import get_code_map
+from feed_store import get_store, DATE_PLACEHOLDER
+from fixcom_feed import FixcomFeed
+
 # Config
 FIXCOM_XML_URL = "https://mskaspi.fixhub.kz/xml/35fde8f355cd299f7a3e26cbe0e4f917.xml"
 RETAIL_DIVISOR = 0.3 # Matching route.js logic
+NS_URI = "kaspiShopping"
+# Save to both root and public (to be sure)
+OUTPUT_PATHS = ['price.xml', 'public/price.xml']
+LOCAL_COLUMNS = 'id, name, price_kzt, specs, kaspi_created'
 
-def generate_xml():
-    print(f"🚀 Starting Hybrid XML generation...")
-    
-    # 1. Load Enviroment
+def _local_name(tag):
+    return tag.split('}', 1)[1] if tag.startswith('{') else tag
+
+def _serialize_into(elem, parts):
+    tag = _local_name(elem.tag)
+    attrs = "".join(f" {_local_name(k)}={quoteattr(v)}" for k, v in elem.attrib.items())
+    if elem.text is None and len(elem) == 0:
+        parts.append(f"<{tag}{attrs} />")
+        return
+    parts.append(f"<{tag}{attrs}>")
+    if elem.text:
+        parts.append(escape(elem.text))
+    for child in elem:
+        _serialize_into(child, parts)
+        if child.tail:
+            parts.append(escape(child.tail))
+    parts.append(f"</{tag}>")
+
+def serialize(elem):
+    """
+    Bytes of one element without namespace prefixes; the feed root declares
+    xmlns="kaspiShopping", so unprefixed elements inherit it.
+    (ET.tostring sets up a writer per call, which dominates on 100k offers.)
+    """
+    parts = []
+    _serialize_into(elem, parts)
+    return "".join(parts).encode("utf-8")
+
+def _root_open_tag(root, namespaces):
+    """Start tag of the feed root with its namespace declarations; the date is filled in on assembly"""
+    prefixes = {uri: prefix for prefix, uri in namespaces.items()}
+    parts = [f'xmlns={quoteattr(namespaces.get("", NS_URI))}']
+    parts += [f'xmlns:{prefix}={quoteattr(uri)}' for prefix, uri in namespaces.items() if prefix]
+    attrs = dict(root.attrib)
+    attrs['date'] = DATE_PLACEHOLDER
+    for name, value in attrs.items():
+        if name.startswith('{'):
+            uri, local = name[1:].split('}', 1)
+            name = f"{prefixes[uri]}:{local}" if prefixes.get(uri) else local
+        parts.append(f'{name}={quoteattr(value)}')
+    return f"<{_local_name(root.tag)} {' '.join(parts)}>\n".encode("utf-8")
+
+def iter_upstream(source):
+    """
+    Parse the upstream feed from `source` (binary file object) offer by offer and yield
+    ('head', bytes) for the root start tag and everything before <offers>,
+    ('offer', sku, bytes) for each entry of <offers>, and
+    ('tail', bytes) for everything after it, ending with the root end tag.
+    Parsed elements are dropped as soon as they are yielded, so memory stays flat.
+    """
+    namespaces = {}
+    stack = []
+    after_offers = False
+
+    for event, item in ET.iterparse(source, events=("start-ns", "start", "end")):
+        if event == "start-ns":
+            prefix, uri = item
+            namespaces[prefix] = uri
+            continue
+
+        if event == "start":
+            stack.append(item)
+            if len(stack) == 1:
+                yield ('head', _root_open_tag(item, namespaces))
+            continue
+
+        elem = stack.pop()
+        parent = stack[-1] if stack else None
+        depth = len(stack)
+        name = _local_name(elem.tag)
+
+        if depth == 0:
+            yield ('tail', f"</{name}>\n".encode("utf-8"))
+        elif depth == 1:
+            if name == "offers":
+                after_offers = True
+            else:
+                yield ('tail' if after_offers else 'head', serialize(elem) + b"\n")
+            parent.remove(elem)
+        elif depth == 2 and _local_name(parent.tag) == "offers":
+            sku = elem.get('sku') if name == "offer" else None
+            yield ('offer', str(sku) if sku else None, serialize(elem))
+            parent.remove(elem)
+
+class AtomicFeedWriter:
+    """
+    Binary stream written to a temp file next to the first destination; commit()
+    moves it into every destination with os.replace, so readers never see a partial feed.
+    """
+
+    def __init__(self, destinations):
+        self.destinations = []
+        for dest in destinations:
+            if os.path.isdir(os.path.dirname(dest) or '.'):
+                self.destinations.append(dest)
+            else:
+                print(f"⚠️ Failed to write to {dest}: directory does not exist")
+        if not self.destinations:
+            raise IOError("No writable feed destination")
+        self.tmp_path = None
+        self.file = None
+
+    def __enter__(self):
+        # Temp files of our own: a cron rebuild and the conveyor's update_offers may publish at once
+        self.file = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(self.destinations[0]) or '.',
+                                                suffix='.tmp', delete=False)
+        self.tmp_path = self.file.name
+        # mkstemp creates 0600; the feed is served to Kaspi
+        os.chmod(self.tmp_path, 0o644)
+        return self
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        for dest in self.destinations[1:]:
+            try:
+                with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(dest) or '.', suffix='.tmp', delete=False) as f:
+                    with open(self.tmp_path, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                os.chmod(f.name, 0o644)
+                os.replace(f.name, dest)
+            except Exception as e:
+                print(f"⚠️ Failed to write to {dest}: {e}")
+        os.replace(self.tmp_path, self.destinations[0])
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.file.closed:
+            self.file.close()
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+def build_local_offer(p, sku):
+    """Offer element for a local product, or None if it should not be listed"""
+    specs = p.get('specs', {})
+    price_kzt = p.get('price_kzt', 0)
+    price = int(price_kzt / RETAIL_DIVISOR)
+
+    if price < 500:
+        return None
+
+    stock = 'yes' if specs.get('stock', 0) > 0 or specs.get('legacy') else 'no' # Assume stock for legacy import
+    if specs.get('imported_from_fixcom'):
+        # Use price from DB which we imported
+         price = int(p['price_kzt'])
+         # Ensure we map it correctly if needed, but imported price is usually KZT
+
+    # Force brand 'Generic' as requested
+    brand_name = 'Generic'
+
+    offer = ET.Element('offer', sku=sku)
+
+    model_name = p['name']
+    if len(model_name) > 1000: # Schema max 1024
+        model_name = model_name[:997] + "..."
+
+    ET.SubElement(offer, 'model').text = model_name
+    ET.SubElement(offer, 'brand').text = brand_name
+
+    availabilities = ET.SubElement(offer, 'availabilities')
+    if stock == 'yes':
+         # For local products, we always use the "Pre-order 30 days" strategy
+         ET.SubElement(availabilities, 'availability', available='yes', storeId='PP1', preorder='true')
+    else:
+         ET.SubElement(availabilities, 'availability', available='no', storeId='PP1')
+
+    ET.SubElement(offer, 'price').text = str(price)
+    return offer
+
+def _get_supabase():
     # Explicitly check for .env locations
     env_paths = [
         '.env.local',
         '.env',
         '../.env'
     ]
-    loaded = False
     for path in env_paths:
         if os.path.exists(path):
             load_dotenv(path)
             print(f"✅ Loaded env from {path}")
-            loaded = True
             break
-            
+
     sb_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
     sb_key = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-    
+
     if not sb_url or not sb_key:
         print("❌ Supabase credentials missing!")
-        return
-        
-    supabase = create_client(sb_url, sb_key)
-    
-    # 2. Fetch Fixcom XML
-    print(f"📡 Fetching Fixcom XML: {FIXCOM_XML_URL}")
-    try:
-        resp = requests.get(FIXCOM_XML_URL, timeout=30)
-        resp.raise_for_status()
-        fixcom_root = ET.fromstring(resp.content)
-    except Exception as e:
-        print(f"❌ Failed to fetch Fixcom XML: {e}")
-        return
+        return None
+
+    return create_client(sb_url, sb_key)
+
+def get_fixcom_feed():
+    return FixcomFeed(FIXCOM_XML_URL)
+
+def refresh_upstream(store):
+    """
+    Bring the Fixcom offers in the store up to date with the local copy of the feed
+    (fixcom_feed.py: conditional GET, last good copy on errors). A new download is
+    parsed once, straight into the store, and only kept if that succeeds. Returns True
+    if any stored offer changed.
+    """
+    feed = get_fixcom_feed()
+    pending = feed.fetch()
+    if pending:
+        try:
+            with open(pending, 'rb') as f:
+                count, changed = store.replace_upstream(iter_upstream(f))
+        except Exception as e:
+            feed.discard(e)
+            if not feed.available:
+                raise
+        else:
+            feed.promote()
+            store.set_meta('fixcom_version', feed.version)
+            print(f"🔗 Stored {count} Fixcom offers ({changed} changed).")
+            return changed > 0
+
+    if store.has_upstream and store.get_meta('fixcom_version') == feed.version:
+        print("📡 Fixcom offers unchanged, reusing stored offers.")
+        return False
+
+    # The store is behind the good copy (first run, or the store was rebuilt)
+    with feed.open() as f:
+        count, changed = store.replace_upstream(iter_upstream(f))
+    store.set_meta('fixcom_version', feed.version)
+    print(f"🔗 Stored {count} Fixcom offers ({changed} changed).")
+    return changed > 0
+
+def sync_local_products(store, products, code_map):
+    """Patch the stored offers of these wb_search_results rows; returns how many fragments changed."""
+    with store.transaction():
+        return _sync_local_products(store, products, code_map)
+
+def _sync_local_products(store, products, code_map):
+    changed = 0
+    gone = [p['id'] for p in products if not p.get('kaspi_created')]
+    if gone:
+        store.remove_local(gone)
+
+    created = [p for p in products if p.get('kaspi_created')]
+    store.set_local_ids([p['id'] for p in created])
+    for p in created:
+        specs = p.get('specs') or {}
 
-    # 3. Fetch Local Products
-    print("🔍 Fetching local products from Supabase...")
-    # Fetch mapping for MoySklad codes
-    ms_res = supabase.schema('Parser').table('products').select('article, code').execute()
-    code_map = {str(p['article']): p['code'] for p in ms_res.data if p['article'] and p['code']}
-    
-    # Fetch our newly created products
-    local_res = supabase.schema('Parser').table('wb_search_results').select('*').eq('kaspi_created', True).execute()
-    local_products = local_res.data
-    print(f"📦 Found {len(local_products)} local products marked as created on Kaspi.")
-    if local_products:
-        print(f"DEBUG: First 5 local IDs: {[p['id'] for p in local_products[:5]]}")
-
-    # 4. Prepare for Merge
-    # Extract existing SKUs from Fixcom to avoid duplicates
-    # Note: Using namespace for findall
-    ns = {'k': 'kaspiShopping'}
-    existing_skus = set()
-    offers_node = fixcom_root.find('k:offers', ns)
-    if offers_node is None:
-        offers_node = ET.SubElement(fixcom_root, '{kaspiShopping}offers')
-    else:
-        for offer in offers_node.findall('k:offer', ns):
-            sku = offer.get('sku')
-            if sku:
-                existing_skus.add(str(sku))
-
-    print(f"🔗 Fixcom already has {len(existing_skus)} offers.")
-
-    # Merge logic: if we have a local product with ID X, remove any offers in Fixcom that start with "X_"
-    # This suppression allows us to "take over" the product with our clean SKU.
-    local_ids_str = set(str(p['id']) for p in local_products)
-    
-    offers_to_remove = []
-    if offers_node is not None:
-        for offer in offers_node.findall('k:offer', ns):
-            sku = offer.get('sku')
-            if sku:
-                # Check if this SKU belongs to a local product
-                # Logic: SKU is exactly ID or starts with "ID_"
-                for local_id in local_ids_str:
-                    if sku == local_id or sku.startswith(local_id + "_"):
-                        offers_to_remove.append(offer)
-                        # Identify SKU to remove from existing_skus if it was added
-                        if str(sku) in existing_skus:
-                            existing_skus.remove(str(sku))
-                        print(f"♻️  Suppressing Fixcom offer {sku} in favor of local version.")
-                        break
-                        
-        # Remove the suppressed offers
-        for offer in offers_to_remove:
-            offers_node.remove(offer)
-
-    print(f"🔗 Fixcom offers after cleanup: {len(existing_skus)}")
-
-    # 5. Add local products to XML
-    added_count = 0
-    # 5. Add local products to XML
-    NS_URI = "kaspiShopping"
-    NS = f"{{{NS_URI}}}" # e.g. {kaspiShopping}
-    
-    added_count = 0
-    for p in local_products:
-        specs = p.get('specs', {})
-        
         # Consistent SKU Logic: Specs -> codeMap -> SKIP if missing
         sku = specs.get('kaspi_sku')
         if not sku:
             sku = code_map.get(str(p['id']))
-            
+
         if not sku:
             print(f"⚠️ Skipping local product {p['id']} - MS Code (SKU) not found.")
+            store.drop_local_offer(p['id'])
             continue
-            
-        sku = str(sku)
-        
-        # If we suppressed the old one, existing_skus doesn't have it, so we add ours.
-        if sku in existing_skus:
-            print(f"⚠️ SKU {sku} already exists in Fixcom (not suppressed), skipping.")
-            continue
-            
-        price_kzt = p.get('price_kzt', 0)
-        price = int(price_kzt / RETAIL_DIVISOR)
-        
-        if price < 500:
+
+        offer = build_local_offer(p, str(sku))
+        if offer is None:
+            store.drop_local_offer(p['id'])
             continue
-            
-        stock = 'yes' if specs.get('stock', 0) > 0 or specs.get('legacy') else 'no' # Assume stock for legacy import
-        if specs.get('imported_from_fixcom'):
-            # Use price from DB which we imported
-             price = int(p['price_kzt'])
-             # Ensure we map it correctly if needed, but imported price is usually KZT
-        
-        # 5. Add local products to XML
-        # Create Offer element WITH NAMESPACE
-        # Force brand 'Generic' as requested
-        brand_name = 'Generic'
-        
-        offer = ET.SubElement(offers_node, f'{NS}offer', sku=sku)
-        
-        model_name = p['name']
-        if len(model_name) > 1000: # Schema max 1024
-            model_name = model_name[:997] + "..."
-            
-        ET.SubElement(offer, f'{NS}model').text = model_name
-        ET.SubElement(offer, f'{NS}brand').text = brand_name
-        
-        availabilities = ET.SubElement(offer, f'{NS}availabilities')
-        if stock == 'yes':
-             # For local products, we always use the "Pre-order 30 days" strategy
-             ET.SubElement(availabilities, f'{NS}availability', available='yes', storeId='PP1', preorder='true')
-        else:
-             ET.SubElement(availabilities, f'{NS}availability', available='no', storeId='PP1')
-        
-        ET.SubElement(offer, f'{NS}price').text = str(price)
-        
-        existing_skus.add(sku)
-        added_count += 1
-
-    # 6. Update Metadata
-    fixcom_root.set('date', datetime.now().strftime('%d.%m.%Y %H:%M'))
-    
-    # 7. Write to File
-    # Register namespace to avoid ns0: prefixes
-    ET.register_namespace('', NS_URI)
-    
-    print(f"💾 Saving consolidated XML with {len(existing_skus)} total offers...")
-    tree = ET.ElementTree(fixcom_root)
-    
-    # Save to both root and public (to be sure)
-    output_paths = ['price.xml', 'public/price.xml']
-    
-    for out_path in output_paths:
-        try:
-            with open(out_path, 'wb') as f:
-                f.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
-                tree.write(f, encoding='utf-8', xml_declaration=False)
-            print(f"✅ Success! Generated {out_path} (Added {added_count} new products).")
-        except Exception as e:
-            print(f"⚠️ Failed to write to {out_path}: {e}")
+        if store.upsert_local(p['id'], str(sku), serialize(offer)):
+            changed += 1
+    return changed
+
+def publish(store):
+    """Assemble the stored fragments into every output path"""
+    with AtomicFeedWriter(OUTPUT_PATHS) as writer:
+        fixcom, local, suppressed = store.write_feed(writer)
+        writer.commit()
+    store.mark_clean()
+    if suppressed:
+        print(f"♻️  Suppressed {suppressed} Fixcom offers in favor of local versions.")
+    print(f"✅ Success! Generated {', '.join(writer.destinations)} with {fixcom + local} offers ({local} local).")
+
+def generate_xml():
+    """Full rebuild: every kaspi_created product is re-checked, then the feed is published."""
+    print(f"🚀 Starting Hybrid XML generation...")
+
+    supabase = _get_supabase()
+    if not supabase:
+        return
+
+    # 1. Fetch Local Products
+    print("🔍 Fetching local products from Supabase...")
+    # Fetch mapping for MoySklad codes
+    code_map = get_code_map(supabase).as_dict()
+
+    # Fetch our newly created products
+    local_res = supabase.schema('Parser').table('wb_search_results').select(LOCAL_COLUMNS).eq('kaspi_created', True).execute()
+    local_products = local_res.data
+    print(f"📦 Found {len(local_products)} local products marked as created on Kaspi.")
+
+    # If we have a local product with ID X, offers "X" / "X_..." in Fixcom are suppressed
+    # so we can "take over" the product with our clean SKU.
+    store = get_store()
+    store.set_local_ids([p['id'] for p in local_products], replace=True)
+    changed = sync_local_products(store, local_products, code_map)
+    print(f"🧩 {changed} local offers changed.")
+
+    # 2. Fixcom XML (conditional, falls back to the last good copy)
+    try:
+        refresh_upstream(store)
+    except Exception as e:
+        print(f"❌ Failed to fetch Fixcom XML and no local copy to fall back on: {e}")
+        return
+
+    # 3. Write to File
+    try:
+        publish(store)
+    except Exception as e:
+        print(f"❌ Failed to write feed: {e}")
+
+def update_offers(ids):
+    """
+    Incremental rebuild after conveyor changes: only these wb_search_results ids are
+    re-read and re-serialized; the feed is rewritten from stored fragments if anything changed.
+    """
+    ids = [int(i) for i in ids]
+    store = get_store()
+    if not store.has_upstream:
+        # No stored feed yet: build everything once
+        return generate_xml()
+
+    supabase = _get_supabase()
+    if not supabase:
+        return
+
+    print(f"🧩 Updating {len(ids)} offers in price.xml...")
+    res = supabase.schema('Parser').table('wb_search_results').select(LOCAL_COLUMNS).in_('id', ids).execute()
+    rows = res.data or []
+    found = set(p['id'] for p in rows)
+    # Deleted rows leave the feed too
+    rows += [{"id": i, "kaspi_created": False} for i in ids if i not in found]
+
+    code_map = get_code_map(supabase)
+    codes = {str(p['id']): code_map.get(p['id'], fetch_missing=True) for p in rows if p.get('kaspi_created')}
+    changed = sync_local_products(store, rows, codes)
+
+    try:
+        refresh_upstream(store)
+    except Exception as e:
+        print(f"⚠️ Fixcom refresh failed, keeping stored offers: {e}")
+
+    if not store.dirty:
+        print("✅ price.xml already up to date.")
+        return
+    try:
+        publish(store)
+        print(f"🧩 Patched {changed} local offers.")
+    except Exception as e:
+        print(f"❌ Failed to write feed: {e}")
 
 if __name__ == "__main__":
     generate_xml()
@@ -1,10 +1,6 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.service import Service
 import time
 import sys
 import os
@@ -13,16 +9,16 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
 
+# Add automation directory to path to import the shared browser pool
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from browser_pool import get_pool
+
 def get_driver():
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument(f"user-agent={config.USER_AGENT}")
-    
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=chrome_options)
-    return driver
+    """Check out a warm Chrome from the shared Kaspi pool. Return it with release_driver()."""
+    return get_pool("kaspi", user_agent=config.USER_AGENT).acquire()
+
+def release_driver(driver):
+    get_pool("kaspi", user_agent=config.USER_AGENT).release(driver)
 
 def find_product_url_selenium(article):
     driver = get_driver()
@@ -58,7 +54,7 @@ def find_product_url_selenium(article):
         print(f"Error: {e}")
         return None
     finally:
-        driver.quit()
+        release_driver(driver)
 
 if __name__ == "__main__":
     article = "150510865"
@@ -5,6 +5,35 @@ import sys
 from typing import Dict, List, Optional, Tuple
 
 
+def _trie_pattern(keywords: List[str]) -> str:
+    """
+    Alternation of literal keywords factored into a prefix trie.
+    A position that starts no keyword fails after one character test, and the
+    greedy optional groups make it match the longest keyword starting there.
+    """
+    trie: Dict = {}
+    for kw in keywords:
+        node = trie
+        for ch in kw:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node: Dict) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in node.items() if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+def _keyword_starts(category_map: Dict[str, Tuple[str, str]], exclude_types: List[str] = ()) -> "re.Pattern":
+    """Zero-width match at every word start, capturing the longest map keyword there (\\b{kw} semantics)."""
+    keywords = [kw for kw, (_, cat_type) in category_map.items() if cat_type not in exclude_types]
+    return re.compile(r'\b(?=(' + _trie_pattern(keywords) + '))')
+
+
 class KaspiCategoryMapper:
     """Maps products to Kaspi categories and generates required attributes."""
     
@@ -189,57 +218,63 @@ class KaspiCategoryMapper:
         'контейнер': ('Master - Baskets and boxes', 'household'),
         'косметичк': ('Master - Cosmetic bags', 'cosmetics'),
     }
+
+    # Categories too sensitive to description noise: matched on the title only
+    STRICT_TITLE_ONLY_TYPES = ['socks', 'hoodies']
+
+    # Compiled once: any restricted keyword as a whole word; CATEGORY_MAP keywords ranked
+    # longest first (ties in map order), the order the title/description passes try them in
+    _RESTRICTED_RE = re.compile(r'\b(?:' + _trie_pattern(RESTRICTED_KEYWORDS) + r')\b', re.IGNORECASE)
+    _KEYWORD_RANK = {kw: rank for rank, kw in enumerate(sorted(CATEGORY_MAP, key=len, reverse=True))}
+    _TITLE_KEYWORDS = _keyword_starts(CATEGORY_MAP)
+    _DESCRIPTION_KEYWORDS = _keyword_starts(CATEGORY_MAP, STRICT_TITLE_ONLY_TYPES)
+
+    @classmethod
+    def _best_keyword(cls, pattern: "re.Pattern", text: str) -> Optional[str]:
+        """Highest-ranked keyword found anywhere in text"""
+        found = pattern.findall(text)
+        return min(found, key=cls._KEYWORD_RANK.__getitem__) if found else None
+
+    @classmethod
+    def match_keywords(cls, name: str, description: str = "") -> Tuple[Optional[str], Optional[str]]:
+        """
+        Keyword passes of detect_category, without the policy and fallbacks.
+        Returns ('restricted', keyword), ('title', keyword), ('description', keyword) or (None, None).
+        """
+        text = f"{name} {description}".lower()
+
+        # 0. Restricted keywords (whole words), unless it is a perfume
+        restricted = cls._RESTRICTED_RE.search(text)
+        if restricted and not ("perfume" in text or "духи" in text or "аромабокс" in text or "арома бокс" in text):
+            return 'restricted', restricted.group(0)
+
+        # 1. Title first, then description (non-strict categories only)
+        keyword = cls._best_keyword(cls._TITLE_KEYWORDS, name.lower())
+        if keyword:
+            return 'title', keyword
+        keyword = description and cls._best_keyword(cls._DESCRIPTION_KEYWORDS, description.lower())
+        if keyword:
+            return 'description', keyword
+        return None, None
     
     @classmethod
     def detect_category(cls, name: str, description: str = "") -> Tuple[Optional[str], Optional[str]]:
         """Detects category based on name and description keywords."""
         text = f"{name} {description}".lower()
         
-        # 0. Check for restricted categories first using word boundaries
-        print(f"DEBUG: Detecting category for '{name}'...", file=sys.stderr)
-        for restricted_kw in cls.RESTRICTED_KEYWORDS:
-            # Use regex to match whole word only
-            pattern = rf"\b{re.escape(restricted_kw)}\b"
-            if re.search(pattern, text, re.IGNORECASE):
-                # Special bypass for perfumes which might contain sensitive words in description
-                if "perfume" in text or "духи" in text or "аромабокс" in text or "арома бокс" in text:
-                    continue
-                print(f"⚠️ Detected strictly restricted keyword: {restricted_kw}", file=sys.stderr)
-                return cls.apply_policy(None, "no_cat", text)
+        # 0-1. Restricted keywords, then keyword mapping (title first, then description)
+        source, keyword = cls.match_keywords(name, description)
+        if source == 'restricted':
+            print(f"⚠️ Detected strictly restricted keyword: {keyword}", file=sys.stderr)
+            return cls.apply_policy(None, "no_cat", text)
 
         # Special check for perfumes (Recently allowed)
         if any(kw in text for kw in ['духи', 'парфюм', 'аромабокс', 'арома бокс', 'perfume', 'tester', 'fragrance']):
              print(f"⚠️ Allowing perfume category detection", file=sys.stderr)
 
-        # 1. Manual keyword mapping (fast pass)
-        print(f"DEBUG: Checking '{name}' against map (TITLE ONLY first)...", file=sys.stderr)
-        sorted_keywords = sorted(cls.CATEGORY_MAP.keys(), key=len, reverse=True)
-        
-        # Pass 1: Check ONLY Title
-        name_lower = name.lower()
-        for keyword in sorted_keywords:
+        if keyword:
             cat_name, cat_type = cls.CATEGORY_MAP[keyword]
-            pattern = rf"\b{re.escape(keyword)}"
-            if re.search(pattern, name_lower):
-                print(f"DEBUG: Found match '{keyword}' in TITLE -> {cat_name}", file=sys.stderr)
-                return cls.apply_policy(cat_name, cat_type, text)
-                
-        # Pass 2: Check Description (but exclude strict categories like Socks)
-        # Some categories are too sensitive to description noise (like Socks, Medicine keywords etc)
-        STRICT_TITLE_ONLY_TYPES = ['socks', 'hoodies']
-        
-        print(f"DEBUG: Checking Description for non-strict categories...", file=sys.stderr)
-        description_lower = description.lower()
-        for keyword in sorted_keywords:
-            cat_name, cat_type = cls.CATEGORY_MAP[keyword]
-            
-            if cat_type in STRICT_TITLE_ONLY_TYPES:
-                continue
-                
-            pattern = rf"\b{re.escape(keyword)}"
-            if re.search(pattern, description_lower):
-                print(f"DEBUG: Found match '{keyword}' in DESCRIPTION -> {cat_name}", file=sys.stderr)
-                return cls.apply_policy(cat_name, cat_type, text)
+            return cls.apply_policy(cat_name, cat_type, text)
         
         # 2. Universal Search in kaspi_categories.json
         try:
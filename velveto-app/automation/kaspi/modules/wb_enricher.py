@@ -5,89 +5,63 @@ This module fetches full product details from Wildberries public API
 to enrich basic product data with attributes, specifications, and other details.
 """
 
-import requests
 import json
 import sys
 import os
 from typing import Dict, Optional, List
 
+# Add automation directory to path to import shared modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import wb_basket
+import wb_detail
+
 
 class WBEnricher:
     """Enriches WB product data by fetching from public API."""
     
     @staticmethod
     def get_basket_number(nm_id):
-        vol = nm_id // 100000
-        part = nm_id // 1000
-        return vol, part
+        return wb_basket.get_basket_number(nm_id)
 
     @staticmethod
-    def fetch_wb_product_details(nm_id: int) -> Optional[Dict]:
+    def fetch_wb_product_details(nm_id: int, v4_data: Optional[Dict] = None) -> Optional[Dict]:
         """
         Fetch full product details from WB using fast JSON APIs.
+        v4_data can be passed in from a wb_detail.fetch_v4_details batch.
         """
-        vol, part = WBEnricher.get_basket_number(nm_id)
-        details = {}
-        host = None
-        
         print(f"🔍 Fetching details for {nm_id} via JSON API...", file=sys.stderr)
         
         # 1. Fetch info/ru/card.json (Basic info & Attributes)
-        for i in range(1, 41):
-            h = f"basket-{i:02d}.wbbasket.ru"
-            url = f"https://{h}/vol{vol}/part{part}/{nm_id}/info/ru/card.json"
-            try:
-                resp = requests.get(url, timeout=2)
-                if resp.status_code == 200:
-                    details = resp.json()
-                    host = h
-                    break
-            except:
-                continue
+        details, host = wb_basket.fetch_card(nm_id)
+        if not details:
+            details = {}
         
-        # 2. Fetch v4/detail (Pricing, Images count, etc.)
-        v4_url = f"https://card.wb.ru/cards/v4/detail?appType=1&curr=kzt&dest=82&nm={nm_id}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
+        # 2. Fetch v4/detail (Pricing, Images count, etc.) via the shared batch client
         try:
-            v4_resp = requests.get(v4_url, headers=headers, timeout=5)
-            if v4_resp.status_code == 200:
-                v4_data = v4_resp.json()
-                products = v4_data.get('data', {}).get('products', []) or v4_data.get('products', [])
-                if products:
-                    details['v4_data'] = products[0]
-                    
-                    # Ensure images are available
-                    pics_count = products[0].get('pics', 0)
-                    image_urls = []
-                    
-                    # Verify Host for Images if not found via card.json
-                    active_host = host
-                    if not active_host and pics_count > 0:
-                        print(f"⚠️ Host not found via card.json, searching for image host for {nm_id}...", file=sys.stderr)
-                        # Try finding image host
-                        for i in range(1, 50): # Check broader range of baskets
-                            h = f"basket-{i:02d}.wbbasket.ru"
-                            test_url = f"https://{h}/vol{vol}/part{part}/{nm_id}/images/big/1.webp"
-                            try:
-                                r = requests.head(test_url, timeout=1)
-                                if r.status_code == 200:
-                                    active_host = h
-                                    print(f"✅ Found image host: {active_host}", file=sys.stderr)
-                                    break
-                            except: pass
-                            
-                    if not active_host:
-                         active_host = "basket-01.wbbasket.ru" # Fallback
+            v4_product = v4_data if v4_data is not None else wb_detail.fetch_v4_detail(nm_id)
+            if v4_product:
+                details['v4_data'] = v4_product
+                
+                # Ensure images are available
+                pics_count = v4_product.get('pics', 0)
+                
+                # Verify Host for Images if not found via card.json
+                active_host = host
+                if not active_host and pics_count > 0:
+                    print(f"⚠️ Host not found via card.json, searching for image host for {nm_id}...", file=sys.stderr)
+                    active_host = wb_basket.resolve_image_host(nm_id)
+                    if active_host:
+                        print(f"✅ Found image host: {active_host}", file=sys.stderr)
+                        
+                if not active_host:
+                     active_host = "basket-01.wbbasket.ru" # Fallback
 
-                    for i_img in range(1, min(max(pics_count, 1), 6)):
-                        image_urls.append(f"https://{active_host}/vol{vol}/part{part}/{nm_id}/images/big/{i_img}.webp")
-                    details['image_urls'] = image_urls
-                    
-                    # Store name and description if not already in details
-                    if 'imt_name' not in details and products[0].get('name'):
-                         details['imt_name'] = products[0].get('name')
+                image_urls = wb_basket.build_image_urls(nm_id, active_host, min(max(pics_count, 1), 6) - 1)
+                details['image_urls'] = image_urls
+                
+                # Store name and description if not already in details
+                if 'imt_name' not in details and v4_product.get('name'):
+                     details['imt_name'] = v4_product.get('name')
         except Exception as e:
             print(f"  ⚠️ Error fetching v4 details: {e}", file=sys.stderr)
             
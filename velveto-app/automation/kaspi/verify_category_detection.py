@@ -0,0 +1,129 @@
+"""
+Regression check and benchmark for KaspiCategoryMapper keyword detection.
+
+The compiled detection (match_keywords) is compared with the previous
+implementation, one re.search per keyword, on:
+  - the corpus in data/category_corpus.txt,
+  - --random generated titles and descriptions built from map and restricted
+    keywords, with noise words, casing and punctuation.
+It then times --batch titles through match_keywords.
+
+    python3 verify_category_detection.py
+    python3 verify_category_detection.py --random 50000 --batch 100000
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from modules.category_mapper import KaspiCategoryMapper
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "category_corpus.txt")
+NOISE = ["подарок", "набор", "детский", "для", "новый", "big", "mini", "2024", "1:1", "x-large", "с котом", "дом", "крем"]
+PUNCT = ["", " ", "-", ",", ".", "(", ")", "/", "«", "»", "_"]
+
+
+def legacy_match(name, description=""):
+    """The previous keyword passes of detect_category, kept as the reference."""
+    cls = KaspiCategoryMapper
+    text = f"{name} {description}".lower()
+    for restricted_kw in cls.RESTRICTED_KEYWORDS:
+        pattern = rf"\b{re.escape(restricted_kw)}\b"
+        if re.search(pattern, text, re.IGNORECASE):
+            if "perfume" in text or "духи" in text or "аромабокс" in text or "арома бокс" in text:
+                continue
+            return 'restricted', None
+
+    sorted_keywords = sorted(cls.CATEGORY_MAP.keys(), key=len, reverse=True)
+    name_lower = name.lower()
+    for keyword in sorted_keywords:
+        if re.search(rf"\b{re.escape(keyword)}", name_lower):
+            return 'title', keyword
+
+    description_lower = description.lower()
+    for keyword in sorted_keywords:
+        if cls.CATEGORY_MAP[keyword][1] in cls.STRICT_TITLE_ONLY_TYPES:
+            continue
+        if re.search(rf"\b{re.escape(keyword)}", description_lower):
+            return 'description', keyword
+    return None, None
+
+
+def compiled_match(name, description=""):
+    source, keyword = KaspiCategoryMapper.match_keywords(name, description)
+    # Which restricted keyword fired is only logged; the result is the same for all of them
+    return (source, None) if source == 'restricted' else (source, keyword)
+
+
+def load_corpus():
+    cases = []
+    with open(CORPUS_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            name, _, description = line.partition("\t")
+            cases.append((name, description))
+    return cases
+
+
+def random_text(rnd, keywords, words):
+    parts = []
+    for _ in range(rnd.randint(0, words)):
+        word = rnd.choice(keywords) if rnd.random() < 0.4 else rnd.choice(NOISE)
+        # Glue a prefix/suffix now and then so word boundaries are exercised
+        if rnd.random() < 0.2:
+            word = rnd.choice(["пре", "x", "1", "ё"]) + word
+        if rnd.random() < 0.3:
+            word += rnd.choice(["а", "и", "ами", "s", "ный", ""])
+        if rnd.random() < 0.3:
+            word = word.upper() if rnd.random() < 0.5 else word.capitalize()
+        parts.append(word + rnd.choice(PUNCT))
+    return " ".join(parts)
+
+
+def random_cases(n):
+    rnd = random.Random(7)
+    keywords = list(KaspiCategoryMapper.CATEGORY_MAP) * 3 + KaspiCategoryMapper.RESTRICTED_KEYWORDS + ["духи", "perfume"]
+    return [(random_text(rnd, keywords, 6), random_text(rnd, keywords, 12)) for _ in range(n)]
+
+
+def check(cases, label):
+    mismatches = [(c, legacy_match(*c), compiled_match(*c)) for c in cases if legacy_match(*c) != compiled_match(*c)]
+    print(f"{'✅' if not mismatches else '❌'} {label}: {len(cases) - len(mismatches)}/{len(cases)} identical")
+    for case, old, new in mismatches[:20]:
+        print(f"   {case!r}: legacy {old}, compiled {new}")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--random", type=int, default=20000, help="Generated cases compared with the legacy loop")
+    parser.add_argument("--batch", type=int, default=100000, help="Titles classified in the benchmark")
+    args = parser.parse_args()
+
+    ok = check(load_corpus(), "corpus")
+    ok = check(random_cases(args.random), "random") and ok
+
+    titles = [name for name, _ in random_cases(args.batch)]
+    start = time.perf_counter()
+    for title in titles:
+        KaspiCategoryMapper.match_keywords(title)
+    took = time.perf_counter() - start
+    print(f"📊 {len(titles)} titles classified in {took * 1000:.0f} ms")
+
+    sample = titles[:2000]
+    start = time.perf_counter()
+    for title in sample:
+        legacy_match(title)
+    legacy_took = (time.perf_counter() - start) * len(titles) / len(sample)
+    print(f"   Legacy loop extrapolated: ~{legacy_took:.1f} s ({legacy_took / max(took, 1e-9):.0f}x)")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,9 @@
 from abc import ABC, abstractmethod
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
+import os
+import sys
 import time
 import random
 import urllib.parse
@@ -13,6 +11,10 @@ from curl_cffi import requests as crequests
 from bs4 import BeautifulSoup
 import re
 
+# Add automation directory to path to import the shared browser pool
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_pool import get_pool
+
 class SearchBackend(ABC):
     @abstractmethod
     def search(self, query):
@@ -30,31 +32,29 @@ class SearchBackend(ABC):
         pass
 
 class SeleniumBackend(SearchBackend):
+    pool_name = "default"
+
     def __init__(self, headless=True):
         self.headless = headless
         self.driver = None
+        self.pool = get_pool(self.pool_name, headless=headless)
 
     def _init_driver(self):
         if self.driver:
             return
-        
-        chrome_options = Options()
-        if self.headless:
-            chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-        chrome_options.add_argument("user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-        
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        # Borrow a warm driver; it goes back to the pool on close()
+        self.driver = self.pool.acquire()
 
     def close(self):
         if self.driver:
-            self.driver.quit()
+            self.pool.release(self.driver)
             self.driver = None
 
 class WBBackend(SeleniumBackend):
+    # Not the "wb" pool: its warmup sets the Astana location, which switches prices to tenge,
+    # and the scout compares prices in roubles
+    pool_name = "wb-scout"
+
     def search(self, query):
         self._init_driver()
         results = []
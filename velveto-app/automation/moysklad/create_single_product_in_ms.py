@@ -1,10 +1,14 @@
 import os
+import sys
 import requests
 import base64
 import argparse
 import json
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ms_metadata import cache as ms_cache
+
 # Load environment variables
 load_dotenv()
 
@@ -25,7 +29,10 @@ HEADERS = {
 }
 
 def get_or_create_store(name):
-    """Get or create store in MoySklad"""
+    """Get or create store in MoySklad (cached)"""
+    return ms_cache.get_or_fetch(f"store:{name}:create", lambda: _fetch_or_create_store(name))
+
+def _fetch_or_create_store(name):
     url = f"{BASE_URL}/entity/store?filter=name={name}"
     try:
         resp = requests.get(url, headers=HEADERS)
@@ -43,7 +50,10 @@ def get_or_create_store(name):
     return None
 
 def get_or_create_group(name):
-    """Get or create product folder in MoySklad"""
+    """Get or create product folder in MoySklad (cached)"""
+    return ms_cache.get_or_fetch(f"folder:{name}", lambda: _fetch_or_create_group(name))
+
+def _fetch_or_create_group(name):
     url = f"{BASE_URL}/entity/productfolder?filter=name={name}"
     try:
         resp = requests.get(url, headers=HEADERS)
@@ -61,7 +71,10 @@ def get_or_create_group(name):
     return None
 
 def get_price_type(name="Розничная цена"):
-    """Get price type meta"""
+    """Get price type meta (cached)"""
+    return ms_cache.get_or_fetch(f"pricetype:{name}", lambda: _fetch_price_type(name))
+
+def _fetch_price_type(name):
     url = f"{BASE_URL}/context/companysettings/pricetype"
     try:
         resp = requests.get(url, headers=HEADERS)
@@ -76,7 +89,10 @@ def get_price_type(name="Розничная цена"):
     return None
 
 def get_organization():
-    """Get first organization meta"""
+    """Get first organization meta (cached)"""
+    return ms_cache.get_or_fetch("organization", _fetch_organization)
+
+def _fetch_organization():
     url = f"{BASE_URL}/entity/organization"
     try:
         resp = requests.get(url, headers=HEADERS)
@@ -1,6 +1,4 @@
 import os
-import requests
-import base64
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -44,24 +42,30 @@ try:
 except ImportError:
     RETAIL_DIVISOR = 0.3
     MIN_PRICE_DIVISOR = 0.45
+from ms_metadata import cache as ms_cache
+from moysklad_client import get_client
+import ms_images
 
 # MoySklad settings
 LOGIN = os.getenv("MOYSKLAD_LOGIN")
 PASSWORD = os.getenv("MOYSKLAD_PASSWORD")
 BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
+
+# Entities per bulk POST (MoySklad accepts up to 1000; attribute-heavy payloads stay smaller)
+BULK_LIMIT = 100
+# Articles per existence-check filter, keeps the query string short
+FILTER_CHUNK = 50
 
 def get_or_create_group(name):
-    """Get or create product folder in MoySklad"""
+    """Get or create product folder in MoySklad (cached)"""
+    return ms_cache.get_or_fetch(f"folder:{name}", lambda: _fetch_or_create_group(name))
+
+def _fetch_or_create_group(name):
     url = f"{BASE_URL}/entity/productfolder?filter=name={name}"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=30)
+        resp = ms.get(url, timeout=30)
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -70,7 +74,7 @@ def get_or_create_group(name):
         
         # Create if not found
         print(f"📂 Creating group '{name}'...")
-        resp = requests.post(f"{BASE_URL}/entity/productfolder", json={"name": name}, headers=HEADERS, timeout=30)
+        resp = ms.post(f"{BASE_URL}/entity/productfolder", json={"name": name}, timeout=30)
         if resp.status_code == 200:
             return resp.json()['meta']
         else:
@@ -79,26 +83,21 @@ def get_or_create_group(name):
         print(f"❌ Error getting/creating group: {e}")
     return None
 
-# Cache for attributes to avoid repeated API calls
-_ATTRIBUTES_CACHE = {}
-
-def get_all_attributes():
-    """Fetch all existing attributes from MoySklad"""
-    global _ATTRIBUTES_CACHE
-    if _ATTRIBUTES_CACHE:
-        return _ATTRIBUTES_CACHE
-
+def _fetch_attributes():
     url = f"{BASE_URL}/entity/product/metadata/attributes"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=30)
+        resp = ms.get(url, timeout=30)
         if resp.status_code == 200:
-            rows = resp.json().get('rows', [])
-            for row in rows:
-                _ATTRIBUTES_CACHE[row['name']] = row
-            print(f"📦 Loaded {len(_ATTRIBUTES_CACHE)} attributes from MS.")
+            attributes = {row['name']: row for row in resp.json().get('rows', [])}
+            print(f"📦 Loaded {len(attributes)} attributes from MS.")
+            return attributes
     except Exception as e:
         print(f"❌ Error fetching attributes: {e}")
-    return _ATTRIBUTES_CACHE
+    return None
+
+def get_all_attributes():
+    """All product attributes from MoySklad, {name: row} (cached)"""
+    return ms_cache.get_or_fetch("product_attributes", _fetch_attributes) or {}
 
 def ensure_attribute(name, attr_type="string"):
     """Ensure an attribute exists in MoySklad. Create if missing."""
@@ -115,10 +114,13 @@ def ensure_attribute(name, attr_type="string"):
     }
     
     try:
-        resp = requests.post(f"{BASE_URL}/entity/product/metadata/attributes", json=payload, headers=HEADERS, timeout=30)
+        resp = ms.post(f"{BASE_URL}/entity/product/metadata/attributes", json=payload, timeout=30)
         if resp.status_code == 200:
             new_attr = resp.json()
-            _ATTRIBUTES_CACHE[name] = new_attr
+            # Only extend a real cached list; an empty one means the fetch failed
+            if attributes:
+                attributes[name] = new_attr
+                ms_cache.set("product_attributes", attributes)
             print(f"   ✅ Attribute '{name}' created.")
             return new_attr['meta']
         else:
@@ -129,10 +131,13 @@ def ensure_attribute(name, attr_type="string"):
     return None
 
 def get_price_type(name="Розничная цена"):
-    """Get price type meta"""
+    """Get price type meta (cached)"""
+    return ms_cache.get_or_fetch(f"pricetype:{name}", lambda: _fetch_price_type(name))
+
+def _fetch_price_type(name):
     url = f"{BASE_URL}/context/companysettings/pricetype"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=30)
+        resp = ms.get(url, timeout=30)
         if resp.status_code == 200:
             for pt in resp.json():
                 if pt['name'] == name:
@@ -145,63 +150,13 @@ def get_price_type(name="Розничная цена"):
     return None
 
 def upload_image_to_ms(ms_id, image_url, name):
-    """Download image from URL and upload to MoySklad product"""
+    """Download image from URL and upload to MoySklad product (waits for the upload)"""
     if not image_url:
-        return
-    
-    try:
-        from PIL import Image
-        import io
-        
-        # Download image
-        print(f"   📸 Downloading image for MS: {image_url}")
-        img_resp = requests.get(image_url, timeout=10)
-        if img_resp.status_code == 200:
-            image_content = img_resp.content
-            
-            # Convert to JPEG (since MS might not like WebP)
-            try:
-                img = Image.open(io.BytesIO(image_content))
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                    img = rgb_img
-                
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='JPEG', quality=90)
-                image_content = img_byte_arr.getvalue()
-                print("   🎨 Converted WebP to JPEG")
-            except Exception as conv_err:
-                print(f"   ⚠️ Image conversion failed, trying raw: {conv_err}")
-
-            content = base64.b64encode(image_content).decode('utf-8')
-            filename = f"{name.replace('/', '_')}.jpg"
-            
-            # Upload to MS
-            url = f"{BASE_URL}/entity/product/{ms_id}/images"
-            payload = {
-                "filename": filename,
-                "content": content
-            }
-            resp = requests.post(url, json=payload, headers=HEADERS, timeout=30)
-            if resp.status_code == 200:
-                print(f"   ✅ Image uploaded to MoySklad")
-            else:
-                print(f"   ❌ Failed to upload image to MS: {resp.text}")
-        else:
-            print(f"   ❌ Failed to download image: {img_resp.status_code}")
-    except Exception as e:
-        print(f"   ❌ Error in image upload process: {e}")
+        return False
+    return ms_images.get_pipeline().attach(ms_id, image_url, name).result()
 
-def create_product_in_ms(product, folder_meta, price_type_meta, extra_attributes=None, update_existing=True, kaspi_attributes=None):
-    """Create product in MoySklad and sync to Supabase"""
-    name = product['name']
-    price = product['price'] # Integer from DB
-    wb_id = str(product['id']) # Use as externalCode or article
-    # image_url = product.get('image_url') # Handled later as list
-    
+def build_attributes(name, extra_attributes=None, kaspi_attributes=None):
+    """extra_attributes plus one MS attribute per non-empty Kaspi attribute (created on demand)"""
     # Prepare dynamic attributes if provided
     dynamic_attributes = []
     if kaspi_attributes:
@@ -228,34 +183,10 @@ def create_product_in_ms(product, folder_meta, price_type_meta, extra_attributes
         all_attributes.extend(extra_attributes)
     if dynamic_attributes:
         all_attributes.extend(dynamic_attributes)
+    return all_attributes
 
-    ms_product_id = None
-    ms_product_obj = None # Ensure initialized
-    
-    # Check if exists by article (preferred) or externalCode
-    # We check by article first as it's the user-facing ID
-    url = f"{BASE_URL}/entity/product?filter=article={wb_id}"
-    try:
-        resp = requests.get(url, headers=HEADERS, timeout=30)
-        if resp.status_code == 200:
-            rows = resp.json().get('rows', [])
-            if rows:
-                print(f"⏭️  Product '{name}' already exists in MS (by article).")
-                ms_product_id = rows[0]['id']
-                ms_product_obj = rows[0]
-            else:
-                # Fallback check by externalCode
-                url_code = f"{BASE_URL}/entity/product?filter=externalCode={wb_id}"
-                resp_code = requests.get(url_code, headers=HEADERS, timeout=30)
-                if resp_code.status_code == 200:
-                   rows_code = resp_code.json().get('rows', [])
-                   if rows_code:
-                       print(f"⏭️  Product '{name}' already exists in MS (by externalCode).")
-                       ms_product_id = rows_code[0]['id']
-                       ms_product_obj = rows_code[0]
-    except Exception as e:
-        print(f"⚠️ Error checking existence: {e}")
-
+def build_price_fields(price, price_type_meta):
+    """salePrices / minPrice payload fields for a WB price"""
     # Pricing Calculation
     # Formula: Price * 100 / divisor
     # Retail (salePrices): WB_Price * 100 / 30
@@ -272,130 +203,195 @@ def create_product_in_ms(product, folder_meta, price_type_meta, extra_attributes
         "mediaType": "application/json"
     }
 
-    if not ms_product_id:
-        # Create new product
-        payload = {
-            "name": name,
-            "externalCode": wb_id,
-            "article": wb_id, 
-            "productFolder": {"meta": folder_meta},
-            "description": "Imported from WB Parser",
-            "salePrices": [
-                {
-                    "value": retail_price_val, 
-                    "priceType": {"meta": price_type_meta}
-                }
-            ],
-            "minPrice": {
-                "value": min_price_val,
-                "currency": {"meta": currency_meta}
+    return {
+        "salePrices": [
+            {
+                "value": retail_price_val, 
+                "priceType": {"meta": price_type_meta}
             }
+        ],
+        "minPrice": {
+            "value": min_price_val,
+            "currency": {"meta": currency_meta}
         }
-        
-        if all_attributes:
-            payload["attributes"] = all_attributes
-        
+    }
+
+def fetch_existing_products(articles):
+    """
+    Existing MS products for many WB articles, {article: row}.
+    Matches by article first (the user-facing ID), then by externalCode for the rest,
+    FILTER_CHUNK articles per request (repeating a filter key ORs the values).
+    """
+    articles = list(dict.fromkeys(str(a) for a in articles))
+    found = {}
+    for field in ("article", "externalCode"):
+        missing = [a for a in articles if a not in found]
+        for i in range(0, len(missing), FILTER_CHUNK):
+            chunk = set(missing[i:i + FILTER_CHUNK])
+            flt = ";".join(f"{field}={a}" for a in chunk)
+            try:
+                for row in ms.iter_rows("entity/product", params={"filter": flt}):
+                    key = str(row.get(field) or "")
+                    if key in chunk and key not in found:
+                        found[key] = row
+            except Exception as e:
+                print(f"⚠️ Error checking existence: {e}")
+    return found
+
+def _product_image_urls(product):
+    image_urls = product.get('image_urls', [])
+    if not image_urls and product.get('image_url'):
+        image_urls = [product.get('image_url')]
+    return image_urls
+
+def _post_products(payloads):
+    """POST payloads as arrays of BULK_LIMIT; yields (index, row, error) per payload in order."""
+    for start in range(0, len(payloads), BULK_LIMIT):
+        chunk = payloads[start:start + BULK_LIMIT]
         try:
-            resp = requests.post(f"{BASE_URL}/entity/product", json=payload, headers=HEADERS, timeout=30)
-            if resp.status_code == 200:
-                print(f"✅ Created '{name}' (Price: {price} -> Retail: {retail_price_val//100})")
-                ms_product_id = resp.json()['id']
-                
-                # UPLOAD IMAGES IMMEDIATELY
-                image_urls = product.get('image_urls', [])
-                if not image_urls and product.get('image_url'):
-                    image_urls = [product.get('image_url')]
-                
-                for idx, img_url in enumerate(image_urls):
-                    print(f"   🖼️ Uploading image {idx+1}/{len(image_urls)}...")
-                    upload_image_to_ms(ms_product_id, img_url, f"{name}_{idx+1}")
-                
-            else:
-                print(f"❌ Error creating '{name}': {resp.text}")
-                return False, f"API Error: {resp.text}"
+            resp = ms.post("entity/product", json=chunk, timeout=120)
+            items = resp.json()
         except Exception as e:
-            print(f"❌ Error creating product request: {e}")
-            return False, f"Request Error: {str(e)}"
-    else:
-        # Product exists
-        if update_existing:
+            print(f"❌ Error in bulk product request: {e}")
+            for offset in range(len(chunk)):
+                yield start + offset, None, f"Request Error: {str(e)}"
+            continue
+
+        if not isinstance(items, list):
+            # Whole request rejected (auth, malformed body...)
+            print(f"❌ Bulk product request failed: {resp.text}")
+            for offset in range(len(chunk)):
+                yield start + offset, None, f"API Error: {resp.text}"
+            continue
+
+        # The response lists entities in request order; failed ones carry 'errors'
+        for offset, item in enumerate(items):
+            if item.get('errors'):
+                yield start + offset, None, f"API Error: {item['errors'][0].get('error')}"
+            else:
+                yield start + offset, item, None
+
+def create_products_in_ms(products, folder_meta, price_type_meta, extra_attributes=None, update_existing=True):
+    """
+    Create or update many products in MoySklad with bulk POSTs and sync them to Supabase.
+    Existing products are found with one prefetch and updated in the same request (upsert by meta).
+    A product may carry 'kaspi_attributes' ({name: value}) to be stored as MS attributes.
+    Returns {wb_id: (ms_row, error)}; ms_row is the MS product or None on failure.
+    """
+    results = {}
+    if not products:
+        return results
+
+    existing = fetch_existing_products([p['id'] for p in products])
+
+    payloads = []
+    queued = [] # products matching payloads
+    for product in products:
+        name = product['name']
+        wb_id = str(product['id']) # Use as externalCode or article
+        row = existing.get(wb_id)
+
+        if row:
+            print(f"⏭️  Product '{name}' already exists in MS.")
+            if not update_existing:
+                print(f"⏭️  Skipping update for '{name}' (update_existing=False)")
+                results[wb_id] = (row, None)
+                continue
             # Update price and attributes
+            payload = {"meta": row['meta']}
+        else:
             payload = {
-                "salePrices": [
-                    {
-                        "value": retail_price_val, 
-                        "priceType": {"meta": price_type_meta}
-                    }
-                ],
-                "minPrice": {
-                    "value": min_price_val,
-                    "currency": {"meta": currency_meta}
-                }
+                "name": name,
+                "externalCode": wb_id,
+                "article": wb_id, 
+                "productFolder": {"meta": folder_meta},
+                "description": "Imported from WB Parser"
             }
-            if all_attributes:
-                payload["attributes"] = all_attributes
-                
-            try:
-                resp = requests.put(f"{BASE_URL}/entity/product/{ms_product_id}", json=payload, headers=HEADERS, timeout=30)
-                if resp.status_code == 200:
-                    print(f"🔄 Updated price and attributes for '{name}' to {retail_price_val//100}")
-                else:
-                    print(f"❌ Error updating '{name}': {resp.text}")
-            except Exception as e:
-                print(f"❌ Error updating product request: {e}")
+
+        payload.update(build_price_fields(product['price'], price_type_meta))
+        all_attributes = build_attributes(name, extra_attributes, product.get('kaspi_attributes'))
+        if all_attributes:
+            payload["attributes"] = all_attributes
+        payloads.append(payload)
+        queued.append(product)
+
+    for idx, row, error in _post_products(payloads):
+        product = queued[idx]
+        wb_id = str(product['id'])
+        if error:
+            print(f"❌ Error saving '{product['name']}': {error}")
+            results[wb_id] = (None, error)
+            continue
+        retail = row['salePrices'][0]['value'] // 100 if row.get('salePrices') else None
+        if wb_id in existing:
+            print(f"🔄 Updated price and attributes for '{product['name']}' to {retail}")
         else:
-             print(f"⏭️  Skipping update for '{name}' (update_existing=False)")
+            print(f"✅ Created '{product['name']}' (Price: {product['price']} -> Retail: {retail})")
+        results[wb_id] = (row, None)
 
-        # CHECK MISSING IMAGES (Run regardless of update_existing)
-        try:
-            current_images_size = 0
-            if ms_product_obj:
-                 current_images_size = ms_product_obj.get('images', {}).get('meta', {}).get('size', 0)
-            
-            if current_images_size == 0:
-                image_urls = product.get('image_urls', [])
-                if not image_urls and product.get('image_url'):
-                    image_urls = [product.get('image_url')]
-                
-                if image_urls:
-                    print(f"🔧 Product exists but has no images. Uploading {len(image_urls)} images...")
-                    for idx, img_url in enumerate(image_urls):
-                        upload_image_to_ms(ms_product_id, img_url, f"{name}_{idx+1}")
-        except Exception as img_check_err:
-                print(f"⚠️ Error checking images for existing product: {img_check_err}")
-
-    # Sync to Supabase 'products' table for Dashboard
-    if ms_product_id:
+    # Images: every new product, and existing ones that still have none.
+    # They attach in the background; callers don't wait for them.
+    for product in products:
+        wb_id = str(product['id'])
+        row, error = results.get(wb_id, (None, None))
+        if not row:
+            continue
         try:
-            # Fetch full product to get 'code' if we just created it or it exists
-            ms_code = None
+            if wb_id in existing:
+                current_images_size = existing[wb_id].get('images', {}).get('meta', {}).get('size', 0)
+                if current_images_size:
+                    continue
+            image_urls = _product_image_urls(product)
+            if image_urls and wb_id in existing:
+                print(f"🔧 Product exists but has no images. Uploading {len(image_urls)} images...")
+            if image_urls:
+                print(f"   🖼️ Queued {len(image_urls)} images for '{product['name']}'")
+                ms_images.attach_images(row['id'], image_urls, product['name'])
+        except Exception as img_err:
+            print(f"⚠️ Error queueing images for '{product['name']}': {img_err}")
+
+    sync_products_to_supabase(products, results)
+    return results
+
+def sync_products_to_supabase(products, results):
+    """Upsert created/updated products into the Supabase 'products' table (Dashboard)"""
+    with_image, without_image = [], []
+    for product in products:
+        row, _ = results.get(str(product['id']), (None, None))
+        if not row:
+            continue
+        db_data = {
+            "name": product['name'],
+            "article": str(product['id']),
+            "moysklad_id": row['id'],
+            "price": product['price'], # Use actual price from WB
+            "code": row.get('code'),
+        }
+        # Only add image_url if provided (avoiding undefined errors)
+        if product.get('image_url'):
+            db_data["image_url"] = product.get('image_url')
+            with_image.append(db_data)
+        else:
+            without_image.append(db_data)
+
+    for rows in (with_image, without_image):
+        for start in range(0, len(rows), BULK_LIMIT):
+            chunk = rows[start:start + BULK_LIMIT]
             try:
-                resp_info = requests.get(f"{BASE_URL}/entity/product/{ms_product_id}", headers=HEADERS, timeout=30)
-                if resp_info.status_code == 200:
-                    ms_code = resp_info.json().get('code')
-            except:
-                pass
-
-            # Upsert into products table
-            db_data = {
-                "name": name,
-                "article": wb_id,
-                "moysklad_id": ms_product_id,
-                "price": price, # Use actual price from WB
-                "code": ms_code,
-            }
-            # Only add image_url if provided (avoiding undefined errors)
-            if product.get('image_url'):
-                db_data["image_url"] = product.get('image_url')
-            supabase.schema('Parser').table('products').upsert(db_data, on_conflict="article").execute()
-            print(f"   💾 Synced to Supabase Dashboard: {name} - {price} ₸")
-        except Exception as e:
-            print(f"   ❌ Error syncing to Supabase: {e}")
+                supabase.schema('Parser').table('products').upsert(chunk, on_conflict="article").execute()
+                print(f"   💾 Synced {len(chunk)} products to Supabase Dashboard")
+            except Exception as e:
+                print(f"   ❌ Error syncing to Supabase: {e}")
 
-    if ms_product_id:
-        return ms_product_id, None
-    else:
-        return False, "Unknown Error (check stdout)"
+def create_product_in_ms(product, folder_meta, price_type_meta, extra_attributes=None, update_existing=True, kaspi_attributes=None):
+    """Create product in MoySklad and sync to Supabase"""
+    if kaspi_attributes:
+        product = dict(product, kaspi_attributes=kaspi_attributes)
+    results = create_products_in_ms([product], folder_meta, price_type_meta, extra_attributes, update_existing)
+    row, error = results.get(str(product['id']), (None, "Unknown Error (check stdout)"))
+    if row:
+        return row['id'], None
+    return False, error
 
 def main():
     print("🚀 Starting WB to MoySklad Export...")
@@ -417,12 +413,11 @@ def main():
     products = response.data
     print(f"Found {len(products)} products to export.")
     
-    created_count = 0
-    for p in products:
-        if create_product_in_ms(p, folder_meta, price_type_meta):
-            created_count += 1
+    results = create_products_in_ms(products, folder_meta, price_type_meta)
+    saved_count = sum(1 for row, _ in results.values() if row)
+    ms_images.drain()
             
-    print(f"🏁 Export complete. Created {created_count} new products.")
+    print(f"🏁 Export complete. Saved {saved_count}/{len(products)} products.")
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,12 @@
-
 import os
-import requests
-import base64
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from PIL import Image
-import io
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from moysklad_client import get_client
+import ms_images
 
 # Find .env.local relative to script location
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -22,46 +23,16 @@ LOGIN = os.getenv("MOYSKLAD_LOGIN")
 PASSWORD = os.getenv("MOYSKLAD_PASSWORD")
 BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
+CHECK_WORKERS = 4
 
-def upload_image_to_ms(ms_id, image_url, name):
-    if not image_url: return
+def has_no_images(ms_id):
     try:
-        img_resp = requests.get(image_url, timeout=10)
-        if img_resp.status_code == 200:
-            image_content = img_resp.content
-            
-            # Convert to JPEG
-            try:
-                img = Image.open(io.BytesIO(image_content))
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P': img = img.convert('RGBA')
-                    rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                    img = rgb_img
-                
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='JPEG', quality=90)
-                image_content = img_byte_arr.getvalue()
-            except:
-                pass
-
-            content = base64.b64encode(image_content).decode('utf-8')
-            filename = f"{name.replace('/', '_')}.jpg"
-            url = f"{BASE_URL}/entity/product/{ms_id}/images"
-            resp = requests.post(url, json={"filename": filename, "content": content}, headers=HEADERS)
-            if resp.status_code == 200:
-                print(f"   ✅ Fixed image for: {name}")
-                return True
-            else:
-                print(f"   ❌ Failed to upload for {name}: {resp.text}")
-    except Exception as e:
-        print(f"   ❌ Error for {name}: {e}")
+        res = ms.get(f"{BASE_URL}/entity/product/{ms_id}/images", params={"limit": 1})
+        if res.status_code == 200:
+            return res.json().get('meta', {}).get('size', 0) == 0
+    except:
+        pass
     return False
 
 def main():
@@ -72,7 +43,7 @@ def main():
     
     # Get price type meta once
     price_type_meta = None
-    res_pt = requests.get(f"{BASE_URL}/context/companysettings/pricetype", headers=HEADERS)
+    res_pt = ms.get(f"{BASE_URL}/context/companysettings/pricetype")
     if res_pt.status_code == 200:
         for pt in res_pt.json():
             if pt['name'] == "Розничная цена":
@@ -87,7 +58,6 @@ def main():
     for p in products:
         ms_id = p['moysklad_id']
         name = p['name']
-        image_url = p['image_url']
         price = p.get('price', 0)
         
         if price > 0 and price_type_meta:
@@ -99,18 +69,18 @@ def main():
                 "salePrices": [{"value": retail_val, "priceType": {"meta": price_type_meta}}],
                 "minPrice": {"value": min_val, "currency": {"meta": currency_meta}}
             }
-            requests.put(f"{BASE_URL}/entity/product/{ms_id}", json=price_payload, headers=HEADERS)
+            ms.put(f"{BASE_URL}/entity/product/{ms_id}", json=price_payload)
             print(f"💰 Updated price for {name}: {retail_val//100}")
 
-        # Check/Fix Images
-        try:
-            res = requests.get(f"{BASE_URL}/entity/product/{ms_id}/images", headers=HEADERS)
-            if res.status_code == 200:
-                if res.json().get('meta', {}).get('size', 0) == 0:
-                    print(f"📦 Product {name} has NO images. Uploading...")
-                    upload_image_to_ms(ms_id, image_url, name)
-        except:
-            pass
+    # Check/Fix Images: checks run in parallel, uploads go through the background image pipeline
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as pool:
+        missing = pool.map(lambda p: (p, has_no_images(p['moysklad_id'])), products)
+        for p, no_images in missing:
+            if no_images and p['image_url']:
+                print(f"📦 Product {p['name']} has NO images. Uploading...")
+                ms_images.get_pipeline().attach(p['moysklad_id'], p['image_url'], p['name'])
+
+    ms_images.drain()
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,13 @@
 import os
-import requests
 import json
-import base64
+import sys
 import argparse
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ms_metadata import cache as ms_cache
+from moysklad_client import get_client
+
 # Load environment variables from web project
 load_dotenv("moysklad-web/.env.local")
 
@@ -16,39 +19,65 @@ BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
 # Removed hardcoded WAREHOUSE_ID
 # Default target: "Склад ВБ"
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
+
+# Documents per bulk POST and products per stock-report filter
+BULK_LIMIT = 100
+FILTER_CHUNK = 50
 
 def get_store_meta(name="Склад ВБ"):
-    """Find store by name and return meta"""
+    """Find store by name and return meta (cached; a fallback store is not)"""
+    key = f"store:{name}"
+    cached = ms_cache.get(key)
+    if cached is not None:
+        return cached
+    meta, exact = _fetch_store_meta(name)
+    if exact:
+        ms_cache.set(key, meta)
+    return meta
+
+def _fetch_store_meta(name):
+    """Returns (meta, exact): exact is False when a fallback store was picked"""
     url = f"{BASE_URL}/entity/store"
     try:
-        resp = requests.get(url, headers=HEADERS)
+        resp = ms.get(url)
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             for row in rows:
                 if row['name'] == name:
-                    return row['meta']
+                    return row['meta'], True
             
             # Fallback if specific not found (e.g. for testing)
             # Try finding "Основной склад" if "Склад ВБ" missing
             if name != "Основной склад":
                  for row in rows:
                     if row['name'] == "Основной склад":
-                        return row['meta']
+                        print(f"⚠️ Store '{name}' not found, using 'Основной склад'")
+                        return row['meta'], False
             
-            if rows: return rows[0]['meta']
+            if rows:
+                print(f"⚠️ Store '{name}' not found, using '{rows[0]['name']}'")
+                return rows[0]['meta'], False
     except Exception as e:
         print(f"Error getting store: {e}")
+    return None, False
+
+def get_organization_meta():
+    """Meta of the first organization, used on stock documents (cached)"""
+    return ms_cache.get_or_fetch("organization", _fetch_organization_meta)
+
+def _fetch_organization_meta():
+    try:
+        org_resp = ms.get(f"{BASE_URL}/entity/organization")
+        if org_resp.status_code == 200 and org_resp.json().get('rows'):
+            return org_resp.json()['rows'][0]['meta']
+    except Exception as e:
+        print(f"Error getting organization: {e}")
     return None
 
 def find_product_by_article(article):
     url = f"{BASE_URL}/entity/product?filter=article={article}"
-    resp = requests.get(url, headers=HEADERS)
+    resp = ms.get(url)
     if resp.status_code == 200:
         rows = resp.json().get('rows', [])
         if rows:
@@ -66,7 +95,7 @@ def get_product_stock(product_id, store_id=None):
         url += f";store={BASE_URL}/entity/store/{store_id}"
         
     try:
-        resp = requests.get(url, headers=HEADERS)
+        resp = ms.get(url)
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -75,48 +104,105 @@ def get_product_stock(product_id, store_id=None):
         print(f"Error getting stock: {e}")
     return 0
 
-def create_enter(product_meta, quantity, price):
-    url = f"{BASE_URL}/entity/enter"
-    
+def get_products_stock(product_ids, store_id=None):
+    """
+    Stock for many products at once, {product_id: stock} (0 when MS has no row).
+    If store_id is provided, stock on that warehouse; otherwise total physical stock.
+    """
+    stocks = {pid: 0 for pid in product_ids}
+    store_filter = f";store={BASE_URL}/entity/store/{store_id}" if store_id else ""
+    for start in range(0, len(product_ids), FILTER_CHUNK):
+        chunk = product_ids[start:start + FILTER_CHUNK]
+        # Repeating product= ORs the products
+        flt = ";".join(f"product={BASE_URL}/entity/product/{pid}" for pid in chunk) + store_filter
+        try:
+            for row in ms.iter_rows("report/stock/all", params={"filter": flt}):
+                # meta.href: .../entity/product/<id>?expand=supplier
+                pid = row['meta']['href'].split('?')[0].split('/')[-1]
+                if pid in stocks:
+                    stocks[pid] = row.get('stock', 0)
+        except Exception as e:
+            print(f"Error getting stock: {e}")
+    return stocks
+
+def create_enters(items):
+    """
+    Create one enter document per item with bulk POSTs.
+    items: [{"product_meta": ..., "quantity": ..., "price": ...}]
+    Returns a result per item, in order: {"success": True, "data": ...} or {"success": False, "error": ...}
+    """
+    if not items:
+        return []
+
     # Dynamic store fetch
     store_meta = get_store_meta("Склад ВБ")
     if not store_meta:
-        return {"success": False, "error": "Store 'Склад ВБ' not found"}
+        return [{"success": False, "error": "Store 'Склад ВБ' not found"} for _ in items]
 
-    data = {
-        "organization": {
-            "meta": {
-                "href": f"{BASE_URL}/entity/organization/metadata/attributes", 
-                "type": "organization"
-            }
-        },
-        "store": {
-            "meta": store_meta
-        },
+    # We need a valid organization. Let's use the first one.
+    org_meta = get_organization_meta()
+    if not org_meta:
+        return [{"success": False, "error": "Could not find organization"} for _ in items]
+
+    documents = [{
+        "organization": {"meta": org_meta},
+        "store": {"meta": store_meta},
         "positions": [
             {
-                "quantity": quantity,
-                "price": int(price * 100),
+                "quantity": item['quantity'],
+                "price": int(item['price'] * 100),
                 "assortment": {
-                    "meta": product_meta
+                    "meta": item['product_meta']
                 }
             }
         ]
-    }
-    
-    # We need a valid organization. Let's fetch the first one.
-    org_url = f"{BASE_URL}/entity/organization"
-    org_resp = requests.get(org_url, headers=HEADERS)
-    if org_resp.status_code == 200 and org_resp.json().get('rows'):
-        data['organization']['meta'] = org_resp.json()['rows'][0]['meta']
-    else:
-        return {"success": False, "error": "Could not find organization"}
-
-    resp = requests.post(url, json=data, headers=HEADERS)
-    if resp.status_code == 200 or resp.status_code == 201:
-        return {"success": True, "data": resp.json()}
-    else:
-        return {"success": False, "error": resp.text}
+    } for item in items]
+
+    results = []
+    for start in range(0, len(documents), BULK_LIMIT):
+        chunk = documents[start:start + BULK_LIMIT]
+        try:
+            resp = ms.post(f"{BASE_URL}/entity/enter", json=chunk, timeout=120)
+            data = resp.json()
+        except Exception as e:
+            results.extend({"success": False, "error": str(e)} for _ in chunk)
+            continue
+
+        if not isinstance(data, list):
+            if resp.status_code in (400, 404, 412):
+                _forget_store_and_organization()
+            results.extend({"success": False, "error": resp.text} for _ in chunk)
+            continue
+
+        # Documents come back in request order; rejected ones carry 'errors'
+        failed = 0
+        shared_meta_error = False
+        for doc in data:
+            if doc.get('errors'):
+                failed += 1
+                shared_meta_error = shared_meta_error or _points_at_shared_meta(doc['errors'])
+                results.append({"success": False, "error": json.dumps(doc['errors'], ensure_ascii=False)})
+            else:
+                results.append({"success": True, "data": doc})
+        if shared_meta_error or (data and failed == len(data)):
+            _forget_store_and_organization()
+    return results
+
+def _points_at_shared_meta(errors):
+    """True if MoySklad blames the store or organization every document shares."""
+    for err in errors:
+        text = f"{err.get('parameter') or ''} {err.get('error') or ''}".lower()
+        if any(word in text for word in ("store", "organization", "склад", "юрлиц", "организац")):
+            return True
+    return False
+
+def _forget_store_and_organization():
+    # Store or organization may have been removed/renamed; look them up again next time
+    ms_cache.invalidate("store:")
+    ms_cache.invalidate("organization")
+
+def create_enter(product_meta, quantity, price):
+    return create_enters([{"product_meta": product_meta, "quantity": quantity, "price": price}])[0]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -1,20 +1,27 @@
 import os
+import sys
 import json
 import time
 import argparse
 import urllib.parse
 from dotenv import load_dotenv
 from supabase import create_client, Client
-import requests
 import re
+import math
+import hashlib
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from curl_cffi import requests as crequests
 
 # Selenium imports
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
 
+# Add parent directory to path to import shared modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wb_basket
+import wb_detail
+from browser_pool import get_pool
+
 load_dotenv()
 
 # Initialize Supabase
@@ -40,23 +47,14 @@ def init_supabase() -> Client:
 
 supabase = init_supabase()
 
-def get_basket_number(nm_id):
-    vol = nm_id // 100000
-    part = nm_id // 1000
-    return vol, part
+get_basket_number = wb_basket.get_basket_number
 
 def search_wb_selenium(query, limit=100, page=1):
     print(f"Searching for '{query}' via Selenium (Page {page})...")
     
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-    chrome_options.add_argument("user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-    
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=chrome_options)
+    # Warm driver from the shared pool (location is already set to Astana)
+    pool = get_pool("wb")
+    driver = pool.acquire()
     
     products = []
     
@@ -65,24 +63,6 @@ def search_wb_selenium(query, limit=100, page=1):
         # Add sort=popular to target best sellers
         url = f"https://www.wildberries.ru/catalog/0/search.aspx?search={encoded_query}&page={page}&sort=popular"
         driver.get(url)
-        
-        # Try to set location to Astana (Nur-Sultan)
-        try:
-            loc_btn = driver.find_element(By.CSS_SELECTOR, ".simple-menu__link--address")
-            loc_btn.click()
-            time.sleep(1)
-            search_input = driver.find_element(By.CSS_SELECTOR, ".ymaps-2-1-79-searchbox-input__input")
-            search_input.send_keys("Астана")
-            time.sleep(1)
-            first_res = driver.find_element(By.CSS_SELECTOR, ".address-item")
-            first_res.click()
-            time.sleep(1)
-            select_btn = driver.find_element(By.CSS_SELECTOR, ".details-self__btn")
-            select_btn.click()
-            time.sleep(2)
-            print("Location set to Astana (attempted)")
-        except:
-            pass
 
         # Scroll down to load more items (WB lazy loads)
         for _ in range(10):
@@ -170,42 +150,111 @@ def search_wb_selenium(query, limit=100, page=1):
     except Exception as e:
         print(f"Selenium search error: {e}")
     finally:
-        driver.quit()
+        pool.release(driver)
         
     return products
 
-def get_product_details(nm_id):
-    vol, part = get_basket_number(nm_id)
-    details = {}
-    host = None
-    
-    # Try to find host for card.json. Extended range based on discovery.
-    for i in range(1, 41):
-        h = f"basket-{i:02d}.wbbasket.ru"
-        url = f"https://{h}/vol{vol}/part{part}/{nm_id}/info/ru/card.json"
-        try:
-            resp = requests.get(url, timeout=1)
-            if resp.status_code == 200:
-                details = resp.json()
-                host = h
-                break
-        except:
-            continue
-            
-    v4_url = f"https://card.wb.ru/cards/v4/detail?appType=1&curr=kzt&dest=82&nm={nm_id}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+WB_SEARCH_API_URL = "https://search.wb.ru/exactmatch/ru/common/v5/search"
+WB_SEARCH_PAGE_SIZE = 100
+
+def _fetch_search_api_page(query, page):
+    params = {
+        "appType": 1,
+        "curr": "kzt",
+        "dest": 82,  # Astana
+        "query": query,
+        "resultset": "catalog",
+        "sort": "popular",
+        "page": page,
+        "spp": 30,
+    }
+    resp = crequests.get(
+        WB_SEARCH_API_URL,
+        params=params,
+        impersonate="chrome120",
+        headers={"Accept": "application/json", "Referer": "https://www.wildberries.ru/"},
+        timeout=15
+    )
+    if resp.status_code != 200:
+        print(f"  Search API returned {resp.status_code} for page {page}")
+        return []
+    data = resp.json()
+    return data.get('data', {}).get('products', []) or data.get('products', [])
+
+def _api_product_to_dict(item):
+    nm_id = item.get('id')
+
+    price_val = 0
+    sizes = item.get('sizes', [])
+    if sizes and 'price' in sizes[0]:
+        price_val = sizes[0]['price'].get('product', 0) // 100
+    if price_val == 0:
+        price_val = item.get('salePriceU', 0) // 100
+
+    # time1 + time2 is the delivery estimate in hours for the requested dest
+    delivery_text = ""
+    delivery_hours = (item.get('time1') or 0) + (item.get('time2') or 0)
+    if delivery_hours > 0:
+        delivery_text = f"{math.ceil(delivery_hours / 24)} дн"
+
+    image_url = ""
+    vol, _ = get_basket_number(nm_id)
+    basket = wb_basket.lookup_basket(vol)
+    if basket:
+        image_url = wb_basket.build_image_urls(nm_id, wb_basket.host_name(basket), 1)[0]
+
+    return {
+        'id': nm_id,
+        'name': item.get('name', 'Unknown'),
+        'brand': item.get('brand', ''),
+        'price_val': price_val,
+        'image_url': image_url,
+        'rating': float(item.get('reviewRating') or item.get('rating') or 0),
+        'feedbacks': item.get('feedbacks', 0),
+        'delivery_text': delivery_text
     }
+
+def search_wb_api(query, limit=100, page=1):
+    """Search through WB's public JSON endpoint; same product dicts as search_wb_selenium."""
+    print(f"Searching for '{query}' via JSON API (Page {page})...")
+
+    # 'page' keeps the Selenium meaning (one 100-item WB page); fetch extra pages in parallel if limit needs them
+    pages = list(range(page, page + max(1, math.ceil(limit / WB_SEARCH_PAGE_SIZE))))
+    products = []
     try:
-        v4_resp = requests.get(v4_url, headers=headers, timeout=5)
-        if v4_resp.status_code == 200:
-            v4_data = v4_resp.json()
-            products = v4_data.get('data', {}).get('products', []) or v4_data.get('products', [])
-            if products:
-                p = products[0]
-                details['v4_data'] = p
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            for items in executor.map(lambda pg: _fetch_search_api_page(query, pg), pages):
+                products.extend(_api_product_to_dict(item) for item in items if item.get('id'))
     except Exception as e:
-        print(f"  Error fetching v4 details: {e}")
+        print(f"Search API error: {e}")
+        return []
+
+    print(f"Found {len(products)} products via API.")
+    return products[:limit]
+
+def search_wb(query, limit=100, page=1, fetcher="api"):
+    """Fetch a search page, falling back to the browser when the API gives nothing."""
+    if fetcher == "api":
+        products = search_wb_api(query, limit, page)
+        if products:
+            return products
+        print("Search API returned no products, falling back to Selenium...")
+    return search_wb_selenium(query, limit, page)
+
+def get_product_details(nm_id, v4_data=None):
+    """
+    card.json + v4 detail for one article.
+    Pass v4_data from a wb_detail.fetch_v4_details batch to skip the per-article v4 call
+    ({} means the batch had nothing for this id).
+    """
+    # Basket host comes from the shared vol -> basket table (probed concurrently on a miss)
+    details, host = wb_basket.fetch_card(nm_id)
+    if not details: details = {}
+            
+    if v4_data is None:
+        v4_data = wb_detail.fetch_v4_detail(nm_id)
+    if v4_data:
+        details['v4_data'] = v4_data
         
     return details if details else None, host
 
@@ -234,176 +283,353 @@ def is_product_closed(name, brand, specs):
         
     return is_closed
 
-def parse_and_save(query, limit=50, page=1):
-    products = search_wb_selenium(query, limit, page)
-    
-    if not products:
-        print("No products found.")
-        return
+ENRICH_CONCURRENCY = int(os.getenv("WB_ENRICH_CONCURRENCY", "8"))
+
+class JobCancelled(Exception):
+    """Raised inside a parser job once its cancel event is set."""
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled()
+
+def enrich_products(products, concurrency=ENRICH_CONCURRENCY, cancel_event=None):
+    """Fetch details for all products concurrently; returns [(details, host)] in input order."""
+    # One batched v4 lookup for the whole page; only card.json stays per product.
+    # Ids of failed chunks get None, so get_product_details falls back to a single lookup
+    v4_map, v4_failed = wb_detail.fetch_v4_batch([p['id'] for p in products])
 
-    print(f"Processing {len(products)} products...")
+    def fetch(p):
+        if cancel_event is not None and cancel_event.is_set():
+            return None, None
+        try:
+            details, host = get_product_details(p['id'], v4_data=v4_map.get(p['id'], None if p['id'] in v4_failed else {}))
+            if details and details.get('v4_data') and not host:
+                # No card.json host; look up the image host here so it runs in parallel too
+                host = wb_basket.resolve_image_host(p['id'])
+            return details, host
+        except Exception as e:
+            print(f"  Error fetching details for {p['id']}: {e}")
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return list(executor.map(fetch, products))
+
+def build_search_item(p, position, details, host, query):
+    nm_id = p.get('id')
+    if not details: details = {}
+        
+    name = details.get('imt_name', p.get('name', 'Unknown'))
+    brand = details.get('selling', {}).get('brand_name', p.get('brand', 'Unknown'))
+    description = details.get('description', '')
     
-    seen_ids = set()
+    options = details.get('options', [])
+    specs = {}
+    for opt in options:
+        specs[opt['name']] = opt['value']
+    specs['description'] = description
+    specs['is_in_feed'] = True
     
-    for i, p in enumerate(products):
-        nm_id = p.get('id')
-        if nm_id in seen_ids:
-            continue
-        seen_ids.add(nm_id)
+    v4_data = details.get('v4_data', {})
+    if v4_data:
+        # Pricing Logic
+        # salePriceU is usually the 'card price' in cents.
+        # sizes -> price -> product is the actual price for that size in cents.
+        price_kzt = 0
         
-        print(f"[{i+1}/{len(products)}] Processing {nm_id}...")
-        
-        details, host = get_product_details(nm_id)
-        if not details: details = {}
-            
-        name = details.get('imt_name', p.get('name', 'Unknown'))
-        brand = details.get('selling', {}).get('brand_name', p.get('brand', 'Unknown'))
-        description = details.get('description', '')
+        # Try to get price from the first size (usually representative)
+        sizes = v4_data.get('sizes', [])
+        if sizes and 'price' in sizes[0]:
+            # 'product' is the final price in cents (usually)
+            price_cents = sizes[0]['price'].get('product', 0)
+            if price_cents > 0:
+                price_kzt = price_cents // 100
         
-        options = details.get('options', [])
-        specs = {}
-        for opt in options:
-            specs[opt['name']] = opt['value']
-        specs['description'] = description
-        specs['is_in_feed'] = True
+        # Fallback to salePriceU if size price missing
+        if price_kzt == 0:
+            price_val = v4_data.get('salePriceU', 0)
+            if price_val > 0:
+                price_kzt = price_val // 100
         
-        v4_data = details.get('v4_data', {})
-        if v4_data:
-            # Pricing Logic
-            # salePriceU is usually the 'card price' in cents.
-            # sizes -> price -> product is the actual price for that size in cents.
-            price_kzt = 0
-            
-            # Try to get price from the first size (usually representative)
-            sizes = v4_data.get('sizes', [])
-            if sizes and 'price' in sizes[0]:
-                # 'product' is the final price in cents (usually)
-                price_cents = sizes[0]['price'].get('product', 0)
-                if price_cents > 0:
-                    price_kzt = price_cents // 100
-            
-            # Fallback to salePriceU if size price missing
-            if price_kzt == 0:
-                price_val = v4_data.get('salePriceU', 0)
-                if price_val > 0:
-                    price_kzt = price_val // 100
-            
-            # Fallback to selenium price if still 0
-            if price_kzt == 0:
-                price_kzt = p.get('price_val', 0)
-            
-            # Improved Delivery Logic from V4 API
-            # dest=82 is Astana (usually). 
-            # In V4, sizes -> stocks -> time (is usually unrelated to delivery days directly in hours, often needs interpretation)
-            # But reliability is best from the Selenium 'delivery_text' or better yet, if we can parse it from 'sale' params.
-            # Actually, the simplest way for 'time' is usually found in `qty` logic, but V4 is tricky.
-            # Let's trust logic: if totalQuantity > 0 -> In Stock.
-            
-            # Stock Logic: User wants boolean only.
-            stock = v4_data.get('totalQuantity', 0)
-            in_stock = stock > 0
-            
-            # We will still save 'stock' in specs just in case, but rely on in_stock for UI.
-            specs['stock'] = stock 
-            
-            # Images logic
-            image_urls = []
-            pics_count = v4_data.get('pics', 0)
-            vol, part = get_basket_number(nm_id)
-            max_images = min(max(pics_count, 1), 5)
-            
-            for i_img in range(1, max_images + 1):
-                if host:
-                    img_url = f"https://{host}/vol{vol}/part{part}/{nm_id}/images/big/{i_img}.webp"
-                else:
-                    # Generic structure as fallback
-                    img_url = f"https://basket-11.wbbasket.ru/vol{vol}/part{part}/{nm_id}/images/big/{i_img}.webp"
-                image_urls.append(img_url)
-                
-            image_url = image_urls[0] if image_urls else p.get('image_url', "")
-            specs['image_urls'] = image_urls
-        else:
+        # Fallback to selenium price if still 0
+        if price_kzt == 0:
             price_kzt = p.get('price_val', 0)
-            in_stock = True
-            stock = 0
-            image_url = p.get('image_url', "")
-            specs['image_urls'] = [image_url] if image_url else []
-
-        # Refined Delivery Parsing
-        # Try to use the selenium text first as it reflects the visual "delivered by..."
-        delivery_text = p.get('delivery_text', "")
-        delivery_days = 0 # Default unknown
         
-        if delivery_text:
-            dt = delivery_text.lower()
-            if "завтра" in dt: 
-                delivery_days = 1
-            elif "послезавтра" in dt: 
-                delivery_days = 2
-            else:
-                # Search for dates like "22 января"
-                # This needs current date awareness, which is hard in isolated script.
-                # Or search for "через 5 дней"
-                match_days = re.search(r"(\d+)\s+д", dt) # "5 дн"
-                if match_days:
-                    delivery_days = int(match_days.group(1))
-                else:
-                    # Just generic number heuristic
-                    nums = re.findall(r"\d+", dt)
-                    if nums:
-                        # If date "15 jan", calculating diff is hard without knowing month.
-                        # User wants "Concrete days".
-                        # If selenium failed to give "days", we might try to map "Dates" to "Days from now".
-                        pass
+        # Improved Delivery Logic from V4 API
+        # dest=82 is Astana (usually). 
+        # In V4, sizes -> stocks -> time (is usually unrelated to delivery days directly in hours, often needs interpretation)
+        # But reliability is best from the Selenium 'delivery_text' or better yet, if we can parse it from 'sale' params.
+        # Actually, the simplest way for 'time' is usually found in `qty` logic, but V4 is tricky.
+        # Let's trust logic: if totalQuantity > 0 -> In Stock.
         
-        # Fallback: if V4 has valid delivery times? V4 is raw.
-        # Let's stick to what we extract but format it cleaner.
+        # Stock Logic: User wants boolean only.
+        stock = v4_data.get('totalQuantity', 0)
+        in_stock = stock > 0
         
-        is_closed = is_product_closed(name, brand, specs)
+        # We will still save 'stock' in specs just in case, but rely on in_stock for UI.
+        specs['stock'] = stock 
         
-        item = {
+        # Images logic
+        pics_count = v4_data.get('pics', 0)
+        max_images = min(max(pics_count, 1), 5)
+        img_host = host or "basket-11.wbbasket.ru"
+        image_urls = wb_basket.build_image_urls(nm_id, img_host, max_images)
+            
+        image_url = image_urls[0] if image_urls else p.get('image_url', "")
+        specs['image_urls'] = image_urls
+    else:
+        price_kzt = p.get('price_val', 0)
+        in_stock = True
+        stock = 0
+        image_url = p.get('image_url', "")
+        specs['image_urls'] = [image_url] if image_url else []
+
+    # Refined Delivery Parsing
+    # Try to use the selenium text first as it reflects the visual "delivered by..."
+    delivery_text = p.get('delivery_text', "")
+    delivery_days = 0 # Default unknown
+    
+    if delivery_text:
+        dt = delivery_text.lower()
+        if "завтра" in dt: 
+            delivery_days = 1
+        elif "послезавтра" in dt: 
+            delivery_days = 2
+        else:
+            # Search for dates like "22 января"
+            # This needs current date awareness, which is hard in isolated script.
+            # Or search for "через 5 дней"
+            match_days = re.search(r"(\d+)\s+д", dt) # "5 дн"
+            if match_days:
+                delivery_days = int(match_days.group(1))
+            else:
+                # Just generic number heuristic
+                nums = re.findall(r"\d+", dt)
+                if nums:
+                    # If date "15 jan", calculating diff is hard without knowing month.
+                    # User wants "Concrete days".
+                    # If selenium failed to give "days", we might try to map "Dates" to "Days from now".
+                    pass
+    
+    # Fallback: if V4 has valid delivery times? V4 is raw.
+    # Let's stick to what we extract but format it cleaner.
+    
+    is_closed = is_product_closed(name, brand, specs)
+    
+    item = {
+        "id": nm_id,
+        "position": position,
+        "name": name,
+        "brand": brand,
+        "price_kzt": price_kzt,
+        "in_stock": in_stock,
+        "image_url": image_url,
+        "product_url": f"https://www.wildberries.ru/catalog/{nm_id}/detail.aspx",
+        "specs": specs,
+        "delivery_days": delivery_days, # Numeric
+        #"delivery_date": delivery_text if delivery_text else "Уточняется", # Removed to fix DB error
+        #"is_closed": is_closed, # Removed to fix DB error
+        "query": query,
+        "rating": p.get('rating', 0),
+        "feedbacks": p.get('feedbacks', 0),
+        "updated_at": "now()"
+    }
+    return item
+
+def parse_and_save(query, limit=50, page=1, fetcher="api", cancel_event=None):
+    """
+    Search, enrich and save one page.
+    Returns stats: {"counts": {found, unique, enriched, saved}, "ids": [...], "errors": [...], "timings": {...}}
+    """
+    stats = {"counts": {"found": 0, "unique": 0, "enriched": 0, "saved": 0}, "ids": [], "errors": [], "timings": {}}
+    started = time.time()
+
+    products = search_wb(query, limit, page, fetcher)
+    stats["timings"]["search"] = round(time.time() - started, 2)
+    stats["counts"]["found"] = len(products)
+    
+    if not products:
+        print("No products found.")
+        return stats
+
+    # Keep the original search position of the first occurrence of each product
+    seen_ids = set()
+    unique = []
+    for i, p in enumerate(products):
+        nm_id = p.get('id')
+        if nm_id in seen_ids:
+            continue
+        seen_ids.add(nm_id)
+        unique.append((i + 1, p))
+    stats["counts"]["unique"] = len(unique)
+
+    check_cancelled(cancel_event)
+    print(f"Processing {len(unique)} products (concurrency {ENRICH_CONCURRENCY})...")
+    step = time.time()
+    enriched = enrich_products([p for _, p in unique], cancel_event=cancel_event)
+    stats["timings"]["enrich"] = round(time.time() - step, 2)
+    check_cancelled(cancel_event)
+
+    items = []
+    for (position, p), (details, host) in zip(unique, enriched):
+        if details:
+            stats["counts"]["enriched"] += 1
+        item = build_search_item(p, position, details, host, query)
+        items.append(item)
+        print(f"[{position}/{len(products)}] {item['id']}: {item['name']} ({item['price_kzt']} ₸)")
+
+    step = time.time()
+    if supabase:
+        try:
+            # Whole page in one request
+            supabase.schema('Parser').table('wb_search_results').upsert(items).execute()
+            stats["counts"]["saved"] = len(items)
+            stats["ids"] = [item['id'] for item in items]
+            print(f"  Saved {len(items)} products")
+        except Exception as e:
+            stats["errors"].append(f"DB save failed: {e}")
+            print(f"  Error saving DB: {e}")
+    else:
+        print(f"  [Dry Run] Would save {len(items)} products")
+    stats["timings"]["save"] = round(time.time() - step, 2)
+    print("Done.")
+    return stats
+
+REPARSE_BATCH_SIZE = 200
+
+# (tier name, ms_created, refresh interval): rows already in the conveyor / on Kaspi are refreshed first and more often
+REFRESH_TIERS = [
+    ("conveyor", True, timedelta(hours=6)),
+    ("catalog", False, timedelta(hours=48)),
+]
+
+def compute_content_hash(price_kzt, stock, image_urls):
+    """Hash of the fields incremental reparse watches for changes."""
+    payload = json.dumps({"price": price_kzt, "stock": stock, "images": image_urls}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def refresh_batch(rows, now_iso):
+    """
+    Compare a batch against fresh v4 data. Returns (changed row updates, unchanged ids).
+    Rows whose v4 chunk failed are in neither list, so they stay due for the next run.
+    """
+    v4_map, v4_failed = wb_detail.fetch_v4_batch([row['id'] for row in rows])
+    changed = []
+    unchanged_ids = []
+
+    for row in rows:
+        nm_id = row['id']
+        if nm_id in v4_failed:
+            continue
+        v4_data = v4_map.get(nm_id)
+        if not v4_data:
+            # Nothing to compare against; try again next interval
+            unchanged_ids.append(nm_id)
+            continue
+
+        price_kzt = wb_detail.get_price_kzt(v4_data)
+        stock = v4_data.get('totalQuantity', 0)
+        specs = row.get('specs') or {}
+
+        image_urls = specs.get('image_urls') or []
+        pics_count = v4_data.get('pics', 0)
+        basket = wb_basket.lookup_basket(get_basket_number(nm_id)[0])
+        if basket and pics_count:
+            image_urls = wb_basket.build_image_urls(nm_id, wb_basket.host_name(basket), min(pics_count, 5))
+
+        content_hash = compute_content_hash(price_kzt, stock, image_urls)
+        if content_hash == row.get('content_hash'):
+            unchanged_ids.append(nm_id)
+            continue
+
+        specs['stock'] = stock
+        if image_urls:
+            specs['image_urls'] = image_urls
+        # Every row carries the same keys: a bulk upsert sends the union of keys and
+        # writes NULL into any a row lacks, so missing values fall back to the stored ones
+        changed.append({
             "id": nm_id,
-            "position": i + 1,
-            "name": name,
-            "brand": brand,
-            "price_kzt": price_kzt,
-            "in_stock": in_stock,
-            "image_url": image_url,
-            "product_url": f"https://www.wildberries.ru/catalog/{nm_id}/detail.aspx",
+            "in_stock": stock > 0,
             "specs": specs,
-            "delivery_days": delivery_days, # Numeric
-            #"delivery_date": delivery_text if delivery_text else "Уточняется", # Removed to fix DB error
-            #"is_closed": is_closed, # Removed to fix DB error
-            "query": query,
-            "rating": p.get('rating', 0),
-            "feedbacks": p.get('feedbacks', 0),
-            "updated_at": "now()"
-        }
-        
-        if supabase:
+            "price_kzt": price_kzt if price_kzt > 0 else row.get('price_kzt'),
+            "image_url": image_urls[0] if image_urls else row.get('image_url'),
+            "content_hash": content_hash,
+            "refreshed_at": now_iso,
+            "updated_at": now_iso
+        })
+
+    return changed, unchanged_ids
+
+def reparse_incremental(batch_size=REPARSE_BATCH_SIZE, cancel_event=None):
+    """
+    Refresh only rows that are due for their tier, in keyset-paginated batches,
+    writing back only rows whose price, stock or images changed.
+    """
+    if not supabase: return
+    totals = {"checked": 0, "changed": 0}
+    changed_ids = []
+
+    for tier_name, in_conveyor, interval in REFRESH_TIERS:
+        cutoff = (datetime.now(timezone.utc) - interval).strftime('%Y-%m-%dT%H:%M:%SZ')
+        print(f"🔄 Reparse tier '{tier_name}' (not refreshed since {cutoff})...")
+        last_id = 0
+
+        while True:
+            check_cancelled(cancel_event)
             try:
-                supabase.schema('Parser').table('wb_search_results').upsert(item).execute()
-                print(f"  Saved {name} ({price_kzt} ₸)")
+                res = supabase.schema('Parser').table('wb_search_results').select("id, specs, content_hash, price_kzt, image_url") \
+                    .eq("ms_created", in_conveyor) \
+                    .or_(f"refreshed_at.is.null,refreshed_at.lt.{cutoff}") \
+                    .gt("id", last_id) \
+                    .order("id") \
+                    .limit(batch_size) \
+                    .execute()
             except Exception as e:
-                print(f"  Error saving DB: {e}")
-        else:
-            print(f"  [Dry Run] Would save: {name}")
-            
-        time.sleep(0.1)
-    print("Done.")
+                print(f"Reparse query error: {e}")
+                break
+
+            rows = res.data or []
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+
+            now_iso = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            changed, unchanged_ids = refresh_batch(rows, now_iso)
+            try:
+                if changed:
+                    supabase.schema('Parser').table('wb_search_results').upsert(changed).execute()
+                if unchanged_ids:
+                    supabase.schema('Parser').table('wb_search_results').update({"refreshed_at": now_iso}).in_("id", unchanged_ids).execute()
+            except Exception as e:
+                print(f"  ❌ Error writing batch: {e}")
+
+            totals["checked"] += len(rows)
+            totals["changed"] += len(changed)
+            changed_ids.extend(row['id'] for row in changed)
+            print(f"  Batch up to id {last_id}: {len(changed)} changed / {len(rows)} checked")
+
+            if len(rows) < batch_size:
+                break
+
+    print(f"✅ Reparse done: {totals['changed']} changed of {totals['checked']} checked.")
+    totals["ids"] = changed_ids
+    return totals
+
+def reparse_existing(full=False, cancel_event=None):
+    if not full:
+        return reparse_incremental(cancel_event=cancel_event)
 
-def reparse_existing():
     if not supabase: return
-    print("🔄 Starting reparse...")
+    print("🔄 Starting full reparse...")
     try:
         res = supabase.schema('Parser').table('wb_search_results').select("id, query").execute()
         if not res.data: return
         print(f"Updating {len(res.data)} products...")
+        v4_map, v4_failed = wb_detail.fetch_v4_batch([row['id'] for row in res.data])
         
         for i, row in enumerate(res.data):
             nm_id = row['id']
             print(f"[{i+1}/{len(res.data)}] Updating {nm_id}...")
-            details, host = get_product_details(nm_id)
+            details, host = get_product_details(nm_id, v4_data=v4_map.get(nm_id, None if nm_id in v4_failed else {}))
             if not details: continue
                 
             name = details.get('imt_name', 'Unknown')
@@ -456,18 +682,66 @@ def reparse_existing():
     except Exception as e:
         print(f"Reparse error: {e}")
 
+def run_job(job, cancel_event=None):
+    """
+    In-process entry point for worker.py: run one parser_queue job.
+    cancel_event (threading/multiprocessing Event) stops the job at the next stage boundary.
+    Returns {"status", "job_id", "mode", "query", "page", "counts", "errors", "timings", "dirty_ids"},
+    where dirty_ids are the wb_search_results rows the job wrote.
+    """
+    started = time.time()
+    mode = job.get('mode', 'search')
+    result = {
+        "status": "completed",
+        "job_id": job.get('id'),
+        "mode": mode,
+        "query": job.get('query'),
+        "page": job.get('page') or 1,
+        "counts": {},
+        "errors": [],
+        "timings": {},
+        "dirty_ids": []
+    }
+
+    try:
+        if mode == 'reparse':
+            counts = reparse_existing(cancel_event=cancel_event) or {}
+            result["dirty_ids"] = counts.pop("ids", [])
+            result["counts"] = counts
+        else:
+            query = "Хиты" if mode == 'top' else job.get('query')
+            if not query:
+                raise ValueError("Job has no query")
+            stats = parse_and_save(query, limit=job.get('limit') or 40, page=result["page"], cancel_event=cancel_event)
+            result["counts"] = stats["counts"]
+            result["errors"] = stats["errors"]
+            result["timings"] = stats["timings"]
+            result["dirty_ids"] = stats["ids"]
+            if stats["errors"]:
+                result["status"] = "error"
+    except JobCancelled:
+        result["status"] = "cancelled"
+    except Exception as e:
+        result["status"] = "error"
+        result["errors"].append(str(e))
+
+    result["timings"]["total"] = round(time.time() - started, 2)
+    return result
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("query", nargs='?', help="Search query")
     parser.add_argument("--limit", type=int, default=40)
     parser.add_argument("--mode", choices=['search', 'top', 'reparse'], default='search')
     parser.add_argument("--page", type=int, default=1)
+    parser.add_argument("--fetcher", choices=['api', 'selenium'], default='api')
+    parser.add_argument("--full", action="store_true", help="Reparse every row instead of only due/changed ones")
     args = parser.parse_args()
     
     if args.mode == 'reparse':
-        reparse_existing()
+        reparse_existing(full=args.full)
     else:
         query = args.query
         if args.mode == 'top': query = "Хиты"
         if not query: exit(1)
-        parse_and_save(query, args.limit, args.page)
+        parse_and_save(query, args.limit, args.page, args.fetcher)
@@ -4,6 +4,9 @@ import sys
 import json
 import logging
 import traceback
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -21,6 +24,10 @@ sys.path.append(kaspi_dir)
 from create_from_wb import create_from_wb
 import check_kaspi_status
 import generate_fixed_price # Import the XML generator
+sys.path.append(os.path.dirname(current_dir))
+from ms_code_map import get_code_map
+import rate_limit
+import ms_images
 
 # Setup Logging
 log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conveyor.log')
@@ -61,17 +68,13 @@ if not SUPABASE_URL:
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def get_preorder_attribute_beta(headers):
-    """Find the 'Предзаказ' attribute meta"""
-    url = f"{ms_creator.BASE_URL}/entity/product/metadata/attributes"
+def get_preorder_attribute_beta():
+    """Find the 'Предзаказ' attribute meta (from the cached attribute list)"""
     try:
-        resp = ms_creator.requests.get(url, headers=headers)
-        if resp.status_code == 200:
-            rows = resp.json().get('rows', [])
-            for row in rows:
-                if "предзаказ" in row['name'].lower():
-                    logger.info(f"Found Preorder attribute: {row['name']} ({row['id']})")
-                    return row['meta'], row['id']
+        for name, row in ms_creator.get_all_attributes().items():
+            if "предзаказ" in name.lower():
+                logger.info(f"Found Preorder attribute: {row['name']} ({row['id']})")
+                return row['meta'], row['id']
     except Exception as e:
         logger.error(f"Error finding preorder attribute: {e}")
     return None, None
@@ -88,13 +91,376 @@ def update_status(wb_id, status_dict):
     except Exception as e:
         logger.error(f"Failed to update DB status for {wb_id}: {e}")
 
+# Per-stage worker pools: slow Kaspi calls no longer hold up MoySklad work on other products
+STAGE_WORKERS = {
+    "ms": int(os.getenv("CONVEYOR_MS_WORKERS", "3")),
+    "stock": int(os.getenv("CONVEYOR_STOCK_WORKERS", "3")),
+    "kaspi": int(os.getenv("CONVEYOR_KASPI_WORKERS", "2")),
+}
+# Products per second entering the Kaspi stage. The MS and stock stages send bulk requests
+# through MoySkladClient, whose shared limiter already paces MoySklad calls
+KASPI_RATE = float(os.getenv("CONVEYOR_KASPI_RATE", "1"))
+XML_DEBOUNCE = int(os.getenv("CONVEYOR_XML_DEBOUNCE", "30"))
+# Products per bulk MS / stock request
+STAGE_BATCH = int(os.getenv("CONVEYOR_STAGE_BATCH", "50"))
+
+# Work queue (claim_conveyor_batch): batch size, claim lease and re-check / back-off delays
+CONVEYOR_BATCH = 100
+CONVEYOR_LEASE_SECONDS = 1800
+RECHECK_SECONDS = 600 # waiting on Kaspi moderation
+CLOSED_RECHECK_SECONDS = 86400
+MAX_BACKOFF_SECONDS = 6 * 3600
+CONVEYOR_COLUMNS = "id, name, price_kzt, image_url, specs, conveyor_status, conveyor_attempts, ms_created, stock_added, kaspi_created, kaspi_status"
+
+def schedule_next_attempt(wb_id, delay_seconds, attempts=None):
+    """Push a row's next conveyor attempt out by delay_seconds (optionally recording failed attempts)."""
+    next_at = (datetime.now(timezone.utc) + timedelta(seconds=delay_seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    update = {"conveyor_next_attempt_at": next_at}
+    if attempts is not None:
+        update["conveyor_attempts"] = attempts
+    try:
+        supabase.schema('Parser').table('wb_search_results').update(update).eq("id", int(wb_id)).execute()
+    except Exception as e:
+        logger.error(f"Failed to schedule next attempt for {wb_id}: {e}")
+
+def schedule_retry(wb_id, attempts):
+    """Exponential back-off after a failed run: 2, 4, 8... minutes, capped at 6 hours."""
+    attempts += 1
+    schedule_next_attempt(wb_id, min(60 * 2 ** attempts, MAX_BACKOFF_SECONDS), attempts)
+
+def claim_candidates():
+    """Claim due rows from the conveyor queue and load only the columns the stages need."""
+    claimed = supabase.schema('Parser').rpc('claim_conveyor_batch', {
+        "p_limit": CONVEYOR_BATCH,
+        "p_lease_seconds": CONVEYOR_LEASE_SECONDS
+    }).execute()
+    ids = [row['id'] for row in claimed.data or []]
+    if not ids:
+        return []
+    response = supabase.schema('Parser').table('wb_search_results') \
+        .select(CONVEYOR_COLUMNS) \
+        .in_("id", ids) \
+        .execute()
+    return response.data or []
+
+def stage_ms(pipeline, states):
+    """Step A: Create/Update a batch in MS with bulk requests. Returns {wb_id: next stage or None}."""
+    logger.info(f"Ensuring {len(states)} products in MS (Update Enabled)...")
+
+    prod_data = []
+    for state in states:
+        product, specs = state['product'], state['specs']
+        # Extract all images
+        image_urls = specs.get('image_urls', [])
+        if not image_urls and product.get('image_url'):
+            image_urls = [product.get('image_url')]
+
+        prod_data.append({
+            "id": product['id'],
+            "name": product['name'],
+            "price": int(product.get('price_kzt', 0) or 0),
+            "image_urls": image_urls,
+            "image_url": product.get('image_url'),
+            "kaspi_attributes": specs # Use specs for attributes
+        })
+    
+    # One prefetch plus bulk POSTs for the whole batch
+    # This will update nomenclature (category/description/attributes)
+    results = ms_creator.create_products_in_ms(
+        prod_data, 
+        pipeline.folder_meta, 
+        pipeline.price_type_meta, 
+        extra_attributes=pipeline.extra_attrs, 
+        update_existing=True
+    )
+
+    next_stages = {}
+    for state in states:
+        wb_id = state['wb_id']
+        ms_row, error_msg = results.get(wb_id, (None, "Unknown Error (check stdout)"))
+        if not ms_row:
+            update_status(wb_id, {"conveyor_status": "error", "conveyor_log": f"MS Creation Failed: {error_msg}"})
+            next_stages[wb_id] = None
+            continue
+
+        update_status(wb_id, {"ms_created": True})
+        state['ms_created'] = True
+        state['ms_id'] = ms_row['id']
+        state['ms_meta'] = ms_row['meta']
+        next_stages[wb_id] = "stock" if not state['stock_added'] else ("kaspi" if not state['kaspi_created'] else None)
+    return next_stages
+
+def stage_stock(pipeline, states):
+    """Step B: Stocking for a batch. Returns {wb_id: next stage or None}."""
+    logger.info(f"Checking Stock Availability on target warehouse for {len(states)} products...")
+    next_stages = {}
+
+    # Products that skipped the MS stage this run: one lookup by article for all of them
+    missing = [state['wb_id'] for state in states if not state.get('ms_id')]
+    found = ms_creator.fetch_existing_products(missing) if missing else {}
+    ready = []
+    for state in states:
+        if not state.get('ms_id') and state['wb_id'] in found:
+            state['ms_id'] = found[state['wb_id']]['id']
+            state['ms_meta'] = found[state['wb_id']]['meta']
+        if not state.get('ms_id'):
+            logger.error(f"Product {state['wb_id']} not found in MS for stocking")
+            next_stages[state['wb_id']] = None
+            continue
+        ready.append(state)
+
+    if not ready:
+        return next_stages
+
+    # Get warehouse meta to get its ID
+    target_warehouse_name = "Склад ВБ"
+    store_meta = ms_stock.get_store_meta(target_warehouse_name)
+    store_id = None
+    if store_meta:
+        store_id = store_meta['href'].split('/')[-1]
+
+    ms_ids = [state['ms_id'] for state in ready]
+    # CHECK: Global stock (Safety check to avoid adding stock if we have it elsewhere)
+    # We use the report but look at the global total
+    global_stocks = ms_stock.get_products_stock(ms_ids)
+    
+    # CHECK: Warehouse-specific stock (What Kaspi sees currently)
+    warehouse_stocks = ms_stock.get_products_stock(ms_ids, store_id=store_id)
+
+    to_enter = []
+    for state in ready:
+        wb_id = state['wb_id']
+        global_stock = global_stocks.get(state['ms_id'], 0)
+        current_stock_wh = warehouse_stocks.get(state['ms_id'], 0)
+
+        # Update specs['stock'] with WAREHOUSE stock (Isolation)
+        specs = {}
+        try:
+            # Fetch current specs
+            current_data = supabase.schema('Parser').table('wb_search_results').select("specs").eq("id", int(wb_id)).execute()
+            if current_data.data and current_data.data[0].get("specs"):
+                specs = current_data.data[0]["specs"]
+            
+            specs['stock'] = current_stock_wh
+            specs['warehouse_name'] = target_warehouse_name
+            specs['global_stock'] = global_stock
+            supabase.schema('Parser').table('wb_search_results').update({"specs": specs}).eq("id", int(wb_id)).execute()
+        except Exception as db_err:
+            logger.warning(f"Failed to update stock spec for {wb_id}: {db_err}")
+
+        if global_stock > 0:
+            logger.info(f"Product {wb_id} has stock globally ({global_stock}). Isolation: Skipping stocking for '{target_warehouse_name}'.")
+            update_status(wb_id, {"stock_added": True, "conveyor_log": f"Globally exists: {global_stock}. Warehouse '{target_warehouse_name}' has: {current_stock_wh}"})
+            state['stock_added'] = True
+            next_stages[wb_id] = "kaspi" if not state['kaspi_created'] else None
+        else:
+            to_enter.append((state, specs))
+
+    if to_enter:
+        logger.info(f"Adding Placeholder Stock (10) to '{target_warehouse_name}' for {len(to_enter)} products (Global stock is 0)...")
+        # We only enter stock if it's truly missing everywhere
+        results = ms_stock.create_enters([{
+            "product_meta": state['ms_meta'],
+            "quantity": 10,
+            "price": int(state['product'].get('price_kzt', 0) or 0)
+        } for state, _ in to_enter])
+
+        for (state, specs), res in zip(to_enter, results):
+            wb_id = state['wb_id']
+            if not res.get('success'):
+                logger.error(f"Stock error for {wb_id}: {res.get('error')}")
+                update_status(wb_id, {"conveyor_log": f"Stock Error: {res.get('error')}"})
+                next_stages[wb_id] = None
+                continue
+            update_status(wb_id, {"stock_added": True})
+            # Update spec again to reflect added stock
+            try:
+                specs['stock'] = 10 
+                supabase.schema('Parser').table('wb_search_results').update({"specs": specs}).eq("id", int(wb_id)).execute()
+            except: pass
+            state['stock_added'] = True
+            next_stages[wb_id] = "kaspi" if not state['kaspi_created'] else None
+
+    # Stock feeds the offer's availability: patch offers already listed on Kaspi
+    for state in ready:
+        if state['kaspi_created']:
+            pipeline.request_xml(state['wb_id'])
+
+    return next_stages
+
+def stage_kaspi(pipeline, state):
+    """Step C: Kaspi card + offer. Queues an XML rebuild on success."""
+    product, wb_id = state['product'], state['wb_id']
+    rate_limit.throttle("kaspi", KASPI_RATE)
+    logger.info(f"Creating Kaspi Card for Article: {wb_id}...")
+    k_success = create_from_wb(wb_id)
+    
+    if not k_success:
+        update_status(wb_id, {"conveyor_log": "Kaspi Creation Failed (check attributes)"})
+        return None
+
+    # 1. Resolve MS Code for Publishing (Must match Kaspi SKU)
+    ms_code = None
+    try:
+        # Refetch specs from DB (create_from_wb stores kaspi_sku there)
+        refetch = supabase.schema('Parser').table('wb_search_results').select("specs").eq("id", int(wb_id)).execute()
+        if refetch.data:
+            ms_code = refetch.data[0].get('specs', {}).get('kaspi_sku')
+    except: pass
+    
+    if not ms_code:
+        # Fallback: products table code (just created, so allow a direct lookup)
+        ms_code = get_code_map(supabase).get(wb_id, fetch_missing=True)
+    
+    if ms_code:
+        # 2. Direct Push to Kaspi Merchant API
+        try:
+            from publish_offer import publish_offer
+            logger.info(f"Publishing Offer via API. SKU: {ms_code}")
+            price_val = int(product.get('price_kzt', 0) or 0)
+            if price_val > 0:
+                 retail_price = int(price_val / 0.3)
+                 publish_offer(ms_code, price=retail_price, stock=10, preorder=True)
+        except Exception as po_err:
+            logger.warning(f"Failed to push offer directly: {po_err}")
+    else:
+        logger.warning(f"Could not find MS Code for publishing offer {wb_id}. Card created but offer pending XML sync.")
+    
+    update_status(wb_id, {"kaspi_created": True, "conveyor_status": "done"})
+    state['kaspi_created'] = True
+    # Kaspi card was created, patch its offer into the XML feed (coalesced across products)
+    pipeline.request_xml(wb_id)
+    return None
+
+STAGES = {
+    "ms": stage_ms,
+    "stock": stage_stock,
+    "kaspi": stage_kaspi,
+}
+# Stages that take a list of states and use bulk MoySklad requests
+BATCH_STAGES = {"ms", "stock"}
+
+class ConveyorPipeline:
+    """
+    MS create -> stock enter -> Kaspi create -> XML publish.
+    Each stage has its own thread pool; a product moves to the next stage's
+    pool as soon as its current stage finishes. The MS stages run on batches
+    of up to STAGE_BATCH products so they can use bulk requests.
+    """
+
+    def __init__(self, folder_meta, price_type_meta, extra_attrs):
+        self.folder_meta = folder_meta
+        self.price_type_meta = price_type_meta
+        self.extra_attrs = extra_attrs
+        self.executors = {
+            stage: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"conveyor-{stage}")
+            for stage, workers in STAGE_WORKERS.items()
+        }
+        self.in_flight = set()
+        self.lock = threading.Condition()
+        self.xml_event = threading.Event()
+        self.xml_ids = set()
+        threading.Thread(target=self._xml_loop, daemon=True).start()
+
+    def is_busy(self, wb_id):
+        with self.lock:
+            return wb_id in self.in_flight
+
+    def submit(self, stage, states):
+        """Queue products for a stage; returns how many were accepted (the rest are in flight)."""
+        with self.lock:
+            accepted = [state for state in states if state['wb_id'] not in self.in_flight]
+            self.in_flight.update(state['wb_id'] for state in accepted)
+        self._dispatch(stage, accepted)
+        return len(accepted)
+
+    def _dispatch(self, stage, states):
+        if stage in BATCH_STAGES:
+            for start in range(0, len(states), STAGE_BATCH):
+                self.executors[stage].submit(self._run, stage, states[start:start + STAGE_BATCH])
+        else:
+            for state in states:
+                self.executors[stage].submit(self._run, stage, [state])
+
+    def _run(self, stage, states):
+        next_stages = {}
+        try:
+            if stage in BATCH_STAGES:
+                next_stages = STAGES[stage](self, states)
+            else:
+                next_stages = {states[0]['wb_id']: STAGES[stage](self, states[0])}
+        except Exception as e:
+            logger.error(f"Stage '{stage}' failed for {[state['wb_id'] for state in states]}: {e}")
+            logger.error(traceback.format_exc())
+            for state in states:
+                update_status(state['wb_id'], {"conveyor_status": "error", "conveyor_log": f"Stage '{stage}' error: {e}"})
+
+        forward = {}
+        for state in states:
+            next_stage = next_stages.get(state['wb_id'])
+            if next_stage:
+                forward.setdefault(next_stage, []).append(state)
+            else:
+                self._finish(state)
+        for next_stage, group in forward.items():
+            self._dispatch(next_stage, group)
+
+    def _finish(self, state):
+        if not state['kaspi_created']:
+            # Stopped short of Kaspi: back off before the queue hands it out again
+            schedule_retry(state['wb_id'], state['attempts'])
+        with self.lock:
+            self.in_flight.discard(state['wb_id'])
+            self.lock.notify_all()
+
+    def request_xml(self, wb_id):
+        with self.lock:
+            self.xml_ids.add(wb_id)
+        self.xml_event.set()
+
+    def _regenerate_xml(self):
+        with self.lock:
+            ids, self.xml_ids = self.xml_ids, set()
+        if not ids:
+            return
+        try:
+            logger.info(f"Updating {len(ids)} offers in XML Feed...")
+            generate_fixed_price.update_offers(ids)
+        except Exception as e:
+            logger.error(f"Failed to regenerate XML: {e}")
+
+    def _xml_loop(self):
+        while True:
+            self.xml_event.wait()
+            time.sleep(XML_DEBOUNCE)
+            self.xml_event.clear()
+            self._regenerate_xml()
+
+    def drain(self):
+        """Wait for every in-flight product, then publish a pending XML rebuild."""
+        with self.lock:
+            while self.in_flight:
+                self.lock.wait()
+        if self.xml_event.is_set():
+            self.xml_event.clear()
+            self._regenerate_xml()
+
+def first_stage(ms_created, stock_added, kaspi_created):
+    if not ms_created:
+        return "ms"
+    if not stock_added:
+        return "stock"
+    if not kaspi_created:
+        return "kaspi"
+    return None
+
 def run_conveyor(single_pass=False, skip_parser=False):
     logger.info(f"🚀 Starting Integrated Conveyor (Single Pass: {single_pass}, Skip Parser: {skip_parser})...")
     
     # 1. Setup MS Context
     folder_meta = ms_creator.get_or_create_group("Parser WB")
     price_type_meta = ms_creator.get_price_type("Розничная цена")
-    preorder_meta, preorder_id = get_preorder_attribute_beta(ms_creator.HEADERS)
+    preorder_meta, preorder_id = get_preorder_attribute_beta()
     
     extra_attrs = []
     if preorder_meta:
@@ -105,6 +471,8 @@ def run_conveyor(single_pass=False, skip_parser=False):
     else:
         logger.warning("'Предзаказ' attribute not found. Will proceed without it.")
 
+    pipeline = ConveyorPipeline(folder_meta, price_type_meta, extra_attrs)
+
     # Import parser dynamically to avoid circular imports if any
     try:
         from parse_wb_top import parse_and_save
@@ -124,12 +492,11 @@ def run_conveyor(single_pass=False, skip_parser=False):
             # 0. BATCH CONTROL: Limit moderation queue to 100
             # -------------------------------------------------------------
             try:
-                # Count products currently in moderation
-                # Note: kaspi_status is stored inside the 'specs' JSONB column
+                # Count products currently in moderation (indexed kaspi_status column)
                 mod_resp = supabase.schema('Parser').table('wb_search_results') \
                     .select("id", count="exact") \
                     .eq("kaspi_created", True) \
-                    .contains("specs", {"kaspi_status": "moderation"}) \
+                    .eq("kaspi_status", "moderation") \
                     .execute()
                 
                 mod_count = mod_resp.count if hasattr(mod_resp, 'count') else 0
@@ -151,22 +518,19 @@ def run_conveyor(single_pass=False, skip_parser=False):
             # -------------------------------------------------------------
             # 1. PROCESS CANDIDATES (Conveyor) - PRIORITY
             # -------------------------------------------------------------
-            # Fetch last 50 items to check status
-            response = supabase.schema('Parser').table('wb_search_results') \
-                .select("*") \
-                .neq("conveyor_status", "done") \
-                .order("ms_created", desc=False) \
-                .order("updated_at", desc=True) \
-                .limit(100) \
-                .execute()
-            
-            candidates = response.data
+            # Claim due rows from the indexed work queue
+            candidates = claim_candidates()
             
             active_work = False
+            queued = {} # stage -> states, submitted together so the MS stages can batch
             if candidates:
                 for product in candidates:
                     wb_id = str(product['id'])
                     name = product['name']
+
+                    # Still moving through the pipeline from an earlier scan
+                    if pipeline.is_busy(wb_id):
+                        continue
                     
                     # Check current status
                     conveyor_status = product.get('conveyor_status', 'idle')
@@ -178,11 +542,13 @@ def run_conveyor(single_pass=False, skip_parser=False):
                     # is_closed might be in 'specs' jsonB column now if checking new parser logic
                     specs = product.get('specs') or {}
                     is_closed_val = product.get('is_closed', False) or specs.get('is_closed', False)
-                    k_status = specs.get('kaspi_status', 'none')
+                    k_status = product.get('kaspi_status') or specs.get('kaspi_status', 'none')
 
                     if (ms_created and stock_added and kaspi_created and k_status == 'created') or is_closed_val:
                         if conveyor_status != 'done' and not is_closed_val:
                              update_status(wb_id, {"conveyor_status": "done"})
+                        elif is_closed_val:
+                             schedule_next_attempt(wb_id, CLOSED_RECHECK_SECONDS)
                         continue
                     
                     # -------------------------------------------------------------
@@ -212,174 +578,35 @@ def run_conveyor(single_pass=False, skip_parser=False):
                             "kaspi_created": False, 
                             "ms_created": False, 
                             "conveyor_status": "processing",
+                            "kaspi_status": "pending",
+                            "kaspi_upload_id": None,
                             "specs": specs
                         })
                         logger.info(f"♻️ Reset status for {wb_id} to trigger re-submission.")
 
+                    stage = first_stage(ms_created, stock_added or product.get('stock_added'), kaspi_created)
+                    if not stage:
+                        # Waiting on Kaspi moderation; look again later
+                        schedule_next_attempt(wb_id, RECHECK_SECONDS)
+                        continue
+
                     active_work = True
                     update_status(wb_id, {"conveyor_status": "processing"})
-                    logger.info(f"--- Processing {name} ({wb_id}) ---")
-
-                    # Step A: Create/Update in MS
-                    if not ms_created:
-                        logger.info(f"Ensuring Product in MS (Update Enabled)...")
-                        # Extract all images
-                        image_urls = specs.get('image_urls', [])
-                        if not image_urls and product.get('image_url'):
-                            image_urls = [product.get('image_url')]
-
-                        prod_data = {
-                            "id": product['id'],
-                            "name": product['name'],
-                            "price": int(product.get('price_kzt', 0) or 0),
-                            "image_urls": image_urls,
-                            "image_url": product.get('image_url')
-                        }
-                        
-                        # Ensure create_product_in_ms returns the ID 
-                        # This will update nomenclature (category/description/attributes)
-                        result_id, error_msg = ms_creator.create_product_in_ms(
-                            prod_data, 
-                            folder_meta, 
-                            price_type_meta, 
-                            extra_attributes=extra_attrs, 
-                            update_existing=True,
-                            kaspi_attributes=specs # Use specs for attributes
-                        )
-                        
-                        if result_id:
-                            update_status(wb_id, {"ms_created": True})
-                            ms_created = True
-                            ms_id_created = result_id 
-                        else:
-                            update_status(wb_id, {"conveyor_status": "error", "conveyor_log": f"MS Creation Failed: {error_msg}"})
-                            continue
-
-                    # Step B: Stocking
-                    if ms_created and not stock_added:
-                        logger.info(f"Checking Stock Availability on target warehouse...")
-                        
-                        ms_prod = None
-                        if ms_id_created:
-                            from create_wb_products_in_ms import BASE_URL, HEADERS, requests
-                            try:
-                                resp = requests.get(f"{BASE_URL}/entity/product/{ms_id_created}", headers=HEADERS)
-                                if resp.status_code == 200:
-                                    ms_prod = resp.json()
-                            except:
-                                pass
-                        
-                        if not ms_prod:
-                             ms_prod = ms_stock.find_product_by_article(wb_id)
-                        
-                        if ms_prod:
-                             # Get warehouse meta to get its ID
-                             target_warehouse_name = "Склад ВБ"
-                             store_meta = ms_stock.get_store_meta(target_warehouse_name)
-                             store_id = None
-                             if store_meta:
-                                 store_id = store_meta['href'].split('/')[-1]
-
-                             # CHECK: Warehouse-specific stock (What Kaspi sees)
-                             current_stock_wh = ms_stock.get_product_stock(ms_prod['id'], store_id=store_id)
-                             
-                             # CHECK: Global stock (Safety check to avoid adding stock if we have it elsewhere)
-                             # We use the report but look at the global total
-                             global_stock = ms_stock.get_product_stock(ms_prod['id'])
-                             
-                             # CHECK: Warehouse-specific stock (What Kaspi sees currently)
-                             current_stock_wh = ms_stock.get_product_stock(ms_prod['id'], store_id=store_id)
-
-                             # Update specs['stock'] with WAREHOUSE stock (Isolation)
-                             try:
-                                 # Fetch current specs
-                                 current_data = supabase.schema('Parser').table('wb_search_results').select("specs").eq("id", int(wb_id)).execute()
-                                 specs = {}
-                                 if current_data.data and current_data.data[0].get("specs"):
-                                     specs = current_data.data[0]["specs"]
-                                 
-                                 specs['stock'] = current_stock_wh
-                                 specs['warehouse_name'] = target_warehouse_name
-                                 specs['global_stock'] = global_stock
-                                 supabase.schema('Parser').table('wb_search_results').update({"specs": specs}).eq("id", int(wb_id)).execute()
-                             except Exception as db_err:
-                                 logger.warning(f"Failed to update stock spec for {wb_id}: {db_err}")
-
-                             if global_stock > 0:
-                                 logger.info(f"Product {wb_id} has stock globally ({global_stock}). Isolation: Skipping stocking for '{target_warehouse_name}'.")
-                                 update_status(wb_id, {"stock_added": True, "conveyor_log": f"Globally exists: {global_stock}. Warehouse '{target_warehouse_name}' has: {current_stock_wh}"})
-                                 stock_added = True
-                             else:
-                                 logger.info(f"Adding Placeholder Stock (10) to '{target_warehouse_name}' (Global stock is 0)...")
-                                 price = int(product.get('price_kzt', 0) or 0)
-                                 # We only enter stock if it's truly missing everywhere
-                                 res = ms_stock.create_enter(ms_prod['meta'], 10, price)
-                                 if res.get('success'):
-                                     update_status(wb_id, {"stock_added": True})
-                                     stock_added = True
-                                     # Update spec again to reflect added stock
-                                     try:
-                                         specs['stock'] = 10 
-                                         supabase.schema('Parser').table('wb_search_results').update({"specs": specs}).eq("id", int(wb_id)).execute()
-                                     except: pass
-                                 else:
-                                     logger.error(f"Stock error: {res.get('error')}")
-                                     update_status(wb_id, {"conveyor_log": f"Stock Error: {res.get('error')}"})
-                        else:
-                            logger.error("Product not found in MS for stocking")
-                            pass
-
-                    # Step C: Kaspi
-                    if (stock_added or product.get('stock_added')) and not kaspi_created:
-                        logger.info(f"Creating Kaspi Card for Article: {wb_id}...")
-                        k_success = create_from_wb(wb_id)
-                        
-                        if k_success:
-                             # 1. Resolve MS Code for Publishing (Must match Kaspi SKU)
-                             ms_code = None
-                             try:
-                                 # Refetch specs from DB (create_from_wb stores kaspi_sku there)
-                                 refetch = supabase.schema('Parser').table('wb_search_results').select("specs").eq("id", int(wb_id)).execute()
-                                 if refetch.data:
-                                     ms_code = refetch.data[0].get('specs', {}).get('kaspi_sku')
-                             except: pass
-                             
-                             if not ms_code:
-                                 # Fallback: check products table for code
-                                 try:
-                                     res_p = supabase.schema('Parser').table('products').select("code").eq("article", wb_id).execute()
-                                     if res_p.data:
-                                         ms_code = res_p.data[0].get('code')
-                                 except: pass
-                             
-                             if ms_code:
-                                 # 2. Direct Push to Kaspi Merchant API
-                                 try:
-                                     from publish_offer import publish_offer
-                                     logger.info(f"Publishing Offer via API. SKU: {ms_code}")
-                                     price_val = int(product.get('price_kzt', 0) or 0)
-                                     if price_val > 0:
-                                          retail_price = int(price_val / 0.3)
-                                          publish_offer(ms_code, price=retail_price, stock=10, preorder=True)
-                                 except Exception as po_err:
-                                     logger.warning(f"Failed to push offer directly: {po_err}")
-                             else:
-                                 logger.warning(f"Could not find MS Code for publishing offer {wb_id}. Card created but offer pending XML sync.")
-                             
-                             update_status(wb_id, {"kaspi_created": True, "conveyor_status": "done"})
-                        else:
-                             update_status(wb_id, {"conveyor_log": "Kaspi Creation Failed (check attributes)"})
-                    
-                        if k_success:
-                            # If at least one Kaspi card was created, regenerate the XML feed immediately
-                            try:
-                                logger.info("Regenerating XML Feed...")
-                                generate_fixed_price.generate_xml()
-                            except Exception as e:
-                                logger.error(f"Failed to regenerate XML: {e}")
-
-                    
-                    time.sleep(0.05)
+                    logger.info(f"--- Queued {name} ({wb_id}) for stage '{stage}' ---")
+                    queued.setdefault(stage, []).append({
+                        "wb_id": wb_id,
+                        "product": product,
+                        "specs": specs,
+                        "ms_created": ms_created,
+                        "stock_added": bool(stock_added or product.get('stock_added')),
+                        "kaspi_created": kaspi_created,
+                        "ms_id": None,
+                        "ms_meta": None,
+                        "attempts": product.get('conveyor_attempts') or 0
+                    })
+
+            for stage, states in queued.items():
+                pipeline.submit(stage, states)
 
             # -------------------------------------------------------------
             # 2. RUN PARSER (Background)
@@ -416,7 +643,8 @@ def run_conveyor(single_pass=False, skip_parser=False):
                         logger.info(f"Autopilot: Scanning category '{target_kw}' (Page {current_page})...")
                         
                         # Note: parse_and_save now uses sort=popular internally
-                        count = parse_and_save(target_kw, limit=100, page=current_page)
+                        stats = parse_and_save(target_kw, limit=100, page=current_page)
+                        count = stats["counts"]["found"] if stats else 0
                         
                         # Rotate categories after some depth
                         if count == 0 or current_page >= 3: # 3 pages per category is enough for variety
@@ -435,6 +663,8 @@ def run_conveyor(single_pass=False, skip_parser=False):
                 pass
             
             if single_pass:
+                pipeline.drain()
+                ms_images.drain()
                 logger.info("Single pass complete.")
                 break
 
@@ -1,10 +1,12 @@
 import os
-import requests
-import base64
+import sys
 import json
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from moysklad_client import get_client, MoySkladError
+
 # Load env from moysklad-web
 load_dotenv(os.path.join(os.getcwd(), "moysklad-web", ".env.local"))
 # Also load local .env for MS credentials if they are there
@@ -34,40 +36,22 @@ if not LOGIN or not PASSWORD:
     print("❌ MoySklad credentials missing")
     exit(1)
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
 
 def fetch_all_products():
     print("📦 Fetching ALL products from MoySklad...")
     products = []
-    offset = 0
-    limit = 100
     
-    while True:
-        url = f"{BASE_URL}/entity/product?limit={limit}&offset={offset}"
-        try:
-            resp = requests.get(url, headers=HEADERS)
-            if resp.status_code != 200:
-                print(f"❌ Error fetching products: {resp.status_code} - {resp.text}")
-                break
-                
-            data = resp.json()
-            rows = data.get('rows', [])
-            products.extend(rows)
-            
-            print(f"   Fetched {len(rows)} items (Total: {len(products)})")
-            
-            if len(rows) < limit:
-                break
-                
-            offset += limit
-        except Exception as e:
-            print(f"❌ Exception fetching products: {e}")
-            break
+    try:
+        # 1000 per page, following meta.nextHref
+        for row in ms.iter_rows("entity/product"):
+            products.append(row)
+            if len(products) % 1000 == 0:
+                print(f"   Fetched {len(products)} items...")
+    except MoySkladError as e:
+        print(f"❌ Error fetching products: {e}")
+    except Exception as e:
+        print(f"❌ Exception fetching products: {e}")
             
     return products
 
@@ -1,9 +1,14 @@
 import os
-import requests
-import base64
+import sys
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from moysklad_client import get_client
+
 load_dotenv()
 
 # Supabase settings
@@ -16,18 +21,18 @@ LOGIN = os.getenv("MOYSKLAD_LOGIN")
 PASSWORD = os.getenv("MOYSKLAD_PASSWORD")
 BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
+WORKERS = 6
+
+# Content hash -> public URL, so identical pictures are stored once per run
+uploaded = {}
+uploaded_lock = threading.Lock()
 
 def get_ms_images(ms_id):
     """Fetch images for a product from MoySklad"""
     url = f"{BASE_URL}/entity/product/{ms_id}/images"
     try:
-        resp = requests.get(url, headers=HEADERS)
+        resp = ms.get(url, params={"limit": 1})
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -40,7 +45,7 @@ def get_ms_images(ms_id):
 def download_image(url):
     """Download image content from MoySklad"""
     try:
-        resp = requests.get(url, headers=HEADERS)
+        resp = ms.get(url)
         if resp.status_code == 200:
             return resp.content
     except Exception as e:
@@ -48,23 +53,58 @@ def download_image(url):
     return None
 
 def upload_to_supabase(content, filename):
-    """Upload image to Supabase Storage"""
+    """Upload image to Supabase Storage (stored under its content hash, once)"""
     bucket_name = "product-images"
+    digest = hashlib.sha256(content).hexdigest()
+    with uploaded_lock:
+        if digest in uploaded:
+            return uploaded[digest]
     try:
         # Check if bucket exists, if not create (handling via exception usually)
         # Assuming bucket exists as per previous context
         
-        path = f"ms_{filename}"
+        ext = os.path.splitext(filename)[1] or ".jpg"
+        path = f"ms_{digest[:32]}{ext}"
         supabase.storage.from_(bucket_name).upload(
             path=path,
             file=content,
             file_options={"content-type": "image/jpeg", "upsert": "true"}
         )
-        return supabase.storage.from_(bucket_name).get_public_url(path)
+        public_url = supabase.storage.from_(bucket_name).get_public_url(path)
+        with uploaded_lock:
+            uploaded[digest] = public_url
+        return public_url
     except Exception as e:
         print(f"Error uploading to Supabase: {e}")
     return None
 
+def sync_product(p):
+    """Copy the first MS image of one product to Supabase; True if image_url was updated"""
+    ms_id = p['moysklad_id']
+    print(f"Checking {p['name']} ({ms_id})...")
+    
+    img_url, filename = get_ms_images(ms_id)
+    
+    if not img_url:
+        print(f"   ⚪ No images found in MoySklad for {p['name']}")
+        return False
+
+    print(f"   📸 Found image: {filename}")
+    content = download_image(img_url)
+    if not content:
+        print(f"   ❌ Failed to download content for {p['name']}")
+        return False
+
+    public_url = upload_to_supabase(content, filename)
+    if not public_url:
+        print(f"   ❌ Failed to upload for {p['name']}")
+        return False
+
+    # Update product in Supabase
+    supabase.schema('Parser').table('products').update({"image_url": public_url}).eq("id", p['id']).execute()
+    print(f"   ✅ Updated image_url: {public_url}")
+    return True
+
 def main():
     print("🚀 Starting MoySklad Image Sync...")
     
@@ -75,31 +115,8 @@ def main():
     products = response.data
     print(f"Found {len(products)} products to check.")
     
-    updated_count = 0
-    
-    for p in products:
-        ms_id = p['moysklad_id']
-        print(f"Checking {p['name']} ({ms_id})...")
-        
-        img_url, filename = get_ms_images(ms_id)
-        
-        if img_url:
-            print(f"   📸 Found image: {filename}")
-            content = download_image(img_url)
-            
-            if content:
-                public_url = upload_to_supabase(content, filename)
-                if public_url:
-                    # Update product in Supabase
-                    supabase.schema('Parser').table('products').update({"image_url": public_url}).eq("id", p['id']).execute()
-                    print(f"   ✅ Updated image_url: {public_url}")
-                    updated_count += 1
-                else:
-                    print("   ❌ Failed to upload")
-            else:
-                print("   ❌ Failed to download content")
-        else:
-            print("   ⚪ No images found in MoySklad")
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        updated_count = sum(1 for ok in pool.map(sync_product, products) if ok)
             
     print(f"🏁 Sync complete. Updated {updated_count} products.")
 
@@ -1,10 +1,12 @@
 import os
-import requests
-import base64
+import sys
 import json
 from dotenv import load_dotenv
 from supabase import create_client
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from moysklad_client import get_client, MoySkladError
+
 load_dotenv("moysklad-web/.env.local")
 
 # Supabase
@@ -23,43 +25,23 @@ PASSWORD = os.getenv("MOYSKLAD_PASSWORD")
 BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
 MAIN_WAREHOUSE_ID = "de940fd4-23f4-11ef-0a80-0eb00010b17c"
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
 
 def sync_stock():
     print("🚀 Starting stock sync for Main Warehouse...")
     
     # Fetch assortment with stock info
     # We filter by store to get stock for specific warehouse
-    url = f"{BASE_URL}/entity/assortment"
     params = {
         "store": f"https://api.moysklad.ru/api/remap/1.2/entity/store/{MAIN_WAREHOUSE_ID}",
-        "limit": 1000,
         # "stockMode": "positiveOnly" # Get only items with stock > 0
     }
     
-    offset = 0
     total_updated = 0
     
-    while True:
-        params["offset"] = offset
-        print(f"📥 Fetching batch offset {offset}...")
-        
-        resp = requests.get(url, headers=HEADERS, params=params)
-        if resp.status_code != 200:
-            print(f"❌ Error fetching assortment: {resp.text}")
-            break
-            
-        data = resp.json()
-        rows = data.get('rows', [])
-        if not rows:
-            break
-            
-        for item in rows:
+    try:
+        # Pages are followed via meta.nextHref
+        for item in ms.iter_rows("entity/assortment", params=params):
             # We only care about products (not bundles/services if possible, but assortment returns all)
             # Check if it is a product or variant
             meta = item.get('meta', {})
@@ -99,10 +81,8 @@ def sync_stock():
                     total_updated += 1
             except Exception as e:
                 print(f"   ⚠️ Error upserting {name}: {e}")
-        
-        offset += 1000
-        if offset >= data.get('meta', {}).get('size', 0):
-            break
+    except MoySkladError as e:
+        print(f"❌ Error fetching assortment: {e}")
             
     print(f"🏁 Sync complete. Updated {total_updated} products.")
 
@@ -1,10 +1,12 @@
 import os
-import requests
-import base64
+import sys
 import json
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from moysklad_client import get_client, MoySkladError
+
 # Load env from moysklad-web
 load_dotenv(os.path.join(os.getcwd(), "..", "moysklad-web", ".env.local"))
 # Also load local .env for MS credentials if they are there
@@ -34,30 +36,21 @@ if not LOGIN or not PASSWORD:
     print("❌ MoySklad credentials missing")
     exit(1)
 
-auth_str = f"{LOGIN}:{PASSWORD}"
-auth_b64 = base64.b64encode(auth_str.encode()).decode()
-HEADERS = {
-    "Authorization": f"Basic {auth_b64}",
-    "Content-Type": "application/json"
-}
+ms = get_client(LOGIN, PASSWORD)
 
 def fetch_warehouses():
     print("📦 Fetching Warehouses from MoySklad...")
-    url = f"{BASE_URL}/entity/store"
     try:
-        resp = requests.get(url, headers=HEADERS)
-        if resp.status_code != 200:
-            print(f"❌ Error fetching warehouses: {resp.status_code} - {resp.text}")
-            return []
-        
-        rows = resp.json().get('rows', [])
         warehouses = []
-        for row in rows:
+        for row in ms.iter_rows("entity/store"):
             warehouses.append({
                 "moysklad_id": row['id'],
                 "name": row['name']
             })
         return warehouses
+    except MoySkladError as e:
+        print(f"❌ Error fetching warehouses: {e}")
+        return []
     except Exception as e:
         print(f"❌ Exception fetching warehouses: {e}")
         return []
@@ -115,47 +108,27 @@ def get_db_product_map():
 
 def fetch_stock_for_warehouse(warehouse_ms_id):
     # Fetch assortment filtered by store
-    url = f"{BASE_URL}/entity/assortment"
     params = {
         "store": f"https://api.moysklad.ru/api/remap/1.2/entity/store/{warehouse_ms_id}",
-        "limit": 1000,
         "scope": "product_variant" # Try to limit scope if possible, or filter later
     }
     
     stock_map = {} # article -> stock_value
     
-    offset = 0
-    while True:
-        params["offset"] = offset
-        # print(f"   Fetching batch offset {offset}...")
-        
-        try:
-            resp = requests.get(url, headers=HEADERS, params=params)
-            if resp.status_code != 200:
-                print(f"❌ Error fetching stock: {resp.text}")
-                break
-                
-            data = resp.json()
-            rows = data.get('rows', [])
-            if not rows:
-                break
-                
-            for item in rows:
-                # We assume we sync products. 
-                # Stock is 'stock' field.
-                stock = int(item.get('stock', 0))
-                article = item.get('article')
-                
-                if article:
-                    stock_map[str(article)] = stock
-            
-            if len(rows) < 1000:
-                break
-            offset += 1000
+    try:
+        # Pages are followed via meta.nextHref
+        for item in ms.iter_rows("entity/assortment", params=params):
+            # We assume we sync products. 
+            # Stock is 'stock' field.
+            stock = int(item.get('stock', 0))
+            article = item.get('article')
             
-        except Exception as e:
-            print(f"❌ Exception fetching stock batch: {e}")
-            break
+            if article:
+                stock_map[str(article)] = stock
+    except MoySkladError as e:
+        print(f"❌ Error fetching stock: {e}")
+    except Exception as e:
+        print(f"❌ Exception fetching stock batch: {e}")
             
     return stock_map
 
@@ -0,0 +1,207 @@
+"""
+Shared MoySklad JSON API client.
+
+One pooled keep-alive Session per account with gzip enabled. Requests are
+scheduled against MoySklad's limit of 45 requests per 3 seconds: a shared
+token bucket paces them, the X-RateLimit-Remaining / X-Lognex-Reset headers
+pause every thread when the window is almost spent, and 429 responses are
+retried after X-Lognex-Retry-After. Timeouts, dropped connections and 5xx are
+retried with an exponential back-off only for idempotent methods: a POST the
+server may already have committed (bulk product / enter creation) is sent
+again only when the connection was never established.
+
+Usage:
+    ms = get_client(LOGIN, PASSWORD)
+    resp = ms.get("entity/product", params={"filter": "article=123"})   # requests.Response
+    product = ms.get_json(f"entity/product/{product_id}")              # raises MoySkladError
+    for row in ms.iter_rows("entity/assortment", params={"store": store_href}):
+        ...
+"""
+
+import os
+import time
+import base64
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+import rate_limit
+
+BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
+HOST = "api.moysklad.ru"
+# 45 requests per 3 seconds per account
+RATE = 15
+BURST = 45
+MAX_RETRIES = 5
+TIMEOUT = 30
+PAGE_LIMIT = 1000
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+_window_lock = threading.Lock()
+_blocked_until = 0.0
+
+
+class MoySkladError(Exception):
+    """Non-success MoySklad response, with the first API error's code and message."""
+
+    def __init__(self, status, message, code=None, response=None):
+        super().__init__(f"MoySklad {status}: {message}")
+        self.status = status
+        self.message = message
+        self.code = code
+        self.response = response
+
+    @classmethod
+    def from_response(cls, resp):
+        message, code = resp.text, None
+        try:
+            errors = resp.json().get("errors") or []
+            if errors:
+                message = errors[0].get("error") or message
+                code = errors[0].get("code")
+        except ValueError:
+            pass
+        return cls(resp.status_code, message, code, resp)
+
+
+def _never_sent(exc):
+    """True if the request failed before reaching MoySklad (connect timeout, refused, DNS)."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    # NewConnectionError (refused, DNS) is a ConnectTimeoutError subclass
+    return isinstance(reason, ConnectTimeoutError)
+
+
+class MoySkladClient:
+    def __init__(self, login=None, password=None, token=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+
+        if token:
+            auth = f"Bearer {token}"
+        else:
+            auth_b64 = base64.b64encode(f"{login}:{password}".encode()).decode()
+            auth = f"Basic {auth_b64}"
+        self.session.headers.update({
+            "Authorization": auth,
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip"
+        })
+        self.limiter = rate_limit.for_host(HOST, RATE, BURST)
+
+    @staticmethod
+    def url(path):
+        if path.startswith("http"):
+            return path
+        return f"{BASE_URL}/{path.lstrip('/')}"
+
+    @staticmethod
+    def _wait_for_window():
+        with _window_lock:
+            delay = _blocked_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def _track_limits(resp):
+        """Pause everyone until the window resets when the server says it's nearly spent."""
+        global _blocked_until
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        reset_ms = resp.headers.get("X-Lognex-Reset")
+        if remaining is None or reset_ms is None:
+            return
+        try:
+            if int(remaining) <= 1:
+                with _window_lock:
+                    _blocked_until = max(_blocked_until, time.time() + int(reset_ms) / 1000)
+        except ValueError:
+            pass
+
+    def request(self, method, path, params=None, json=None, timeout=TIMEOUT, **kwargs):
+        """Send a request with pacing and retries; returns the final requests.Response."""
+        url = self.url(path)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        resp = None
+        for attempt in range(MAX_RETRIES):
+            self._wait_for_window()
+            self.limiter.acquire()
+            try:
+                resp = self.session.request(method, url, params=params, json=json, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == MAX_RETRIES - 1 or not (idempotent or _never_sent(e)):
+                    raise
+                print(f"⚠️ MoySklad {method} {url} failed ({e}), retrying...")
+                time.sleep(2 ** attempt)
+                continue
+
+            self._track_limits(resp)
+            if resp.status_code == 429:
+                retry_after = resp.headers.get("X-Lognex-Retry-After")
+                delay = int(retry_after) / 1000 if retry_after and retry_after.isdigit() else 2 ** attempt
+                print(f"⏳ MoySklad rate limit hit, waiting {delay:.1f}s...")
+                time.sleep(delay)
+                continue
+            if resp.status_code in RETRY_STATUSES and idempotent and attempt < MAX_RETRIES - 1:
+                time.sleep(2 ** attempt)
+                continue
+            return resp
+        return resp
+
+    def get(self, path, params=None, **kwargs):
+        return self.request("GET", path, params=params, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request("POST", path, json=json, **kwargs)
+
+    def put(self, path, json=None, **kwargs):
+        return self.request("PUT", path, json=json, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def _json(self, resp):
+        if resp.status_code not in (200, 201):
+            raise MoySkladError.from_response(resp)
+        return resp.json()
+
+    def get_json(self, path, params=None):
+        return self._json(self.get(path, params=params))
+
+    def post_json(self, path, json=None):
+        return self._json(self.post(path, json=json))
+
+    def put_json(self, path, json=None):
+        return self._json(self.put(path, json=json))
+
+    def iter_rows(self, path, params=None, limit=PAGE_LIMIT):
+        """Yield every row of a list endpoint, following meta.nextHref."""
+        params = dict(params or {})
+        params.setdefault("limit", limit)
+        data = self.get_json(path, params=params)
+        while True:
+            for row in data.get("rows", []):
+                yield row
+            next_href = data.get("meta", {}).get("nextHref")
+            if not next_href:
+                return
+            # nextHref already carries the filters and the next offset
+            data = self.get_json(next_href)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(login=None, password=None, token=None):
+    """Process-wide client per account; defaults to MOYSKLAD_LOGIN / MOYSKLAD_PASSWORD."""
+    login = login or os.getenv("MOYSKLAD_LOGIN")
+    password = password or os.getenv("MOYSKLAD_PASSWORD")
+    key = token or f"{login}:{password}"
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = MoySkladClient(login, password, token)
+        return _clients[key]
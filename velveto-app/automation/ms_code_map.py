@@ -0,0 +1,112 @@
+"""
+Cached article -> MoySklad code index for Parser.products.
+
+The Airtable sync, the Kaspi XML generator and the conveyor all need the MS
+code of a WB article. Instead of one `products` query per product, the whole
+mapping is read in a few paginated requests and kept in memory, reloaded
+once it is older than MS_CODE_MAP_TTL seconds.
+
+Usage:
+    code_map = get_code_map(supabase)
+    code = code_map.get("123456789")
+"""
+
+import os
+import time
+import threading
+
+TTL = int(os.getenv("MS_CODE_MAP_TTL", "300"))
+PAGE_SIZE = 1000
+
+
+class ArticleCodeMap:
+    def __init__(self, client, ttl=TTL):
+        self.client = client
+        self.ttl = ttl
+        self._codes = {}
+        self._loaded_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        codes = {}
+        offset = 0
+        while True:
+            res = self.client.schema('Parser').table('products')\
+                .select('article, code')\
+                .order('id')\
+                .range(offset, offset + PAGE_SIZE - 1)\
+                .execute()
+            page = res.data or []
+            for p in page:
+                if p.get('article') and p.get('code'):
+                    codes[str(p['article'])] = p['code']
+            if len(page) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+        return codes
+
+    def _ensure_fresh(self):
+        with self._lock:
+            now = time.time()
+            if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                return
+            if self._failed_at is not None and now - self._failed_at < self.ttl:
+                return
+            try:
+                self._codes = self._load()
+                self._loaded_at = time.time()
+                self._failed_at = None
+                print(f"🗂️ Loaded {len(self._codes)} article → MS code mappings")
+            except Exception as e:
+                # Keep serving the previous snapshot (if any) and retry only once the TTL has passed,
+                # not on every get() while Supabase is down
+                self._failed_at = time.time()
+                print(f"⚠️ Could not load MS code map ({len(self._codes)} cached mappings kept): {e}")
+
+    def get(self, article, fetch_missing=False):
+        """
+        MS code for a WB article, or None.
+        fetch_missing=True falls back to a single-row query for articles created
+        since the last reload (e.g. right after the conveyor created them in MS).
+        """
+        self._ensure_fresh()
+        article = str(article)
+        code = self._codes.get(article)
+        if code or not fetch_missing:
+            return code
+        try:
+            res = self.client.schema('Parser').table('products').select('code').eq('article', article).execute()
+            if res.data and res.data[0].get('code'):
+                code = res.data[0]['code']
+                self.remember(article, code)
+        except Exception as e:
+            print(f"⚠️ MS code lookup failed for {article}: {e}")
+        return code
+
+    def remember(self, article, code):
+        with self._lock:
+            self._codes[str(article)] = code
+
+    def as_dict(self):
+        self._ensure_fresh()
+        with self._lock:
+            return dict(self._codes)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+            self._failed_at = None
+
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_code_map(client):
+    """Process-wide map, created with the first caller's Supabase client."""
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = ArticleCodeMap(client)
+        return _instance
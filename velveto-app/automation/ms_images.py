@@ -0,0 +1,228 @@
+"""
+Background image transfer for MoySklad products.
+
+WB images are downloaded by a pool of threads and converted to JPEG. The MS
+upload body is streamed, so the base64 copy of the image is never built in
+memory. Uploads go through a smaller pool on the shared MoySklad client.
+Every uploaded (product, content hash) pair is appended to
+data/ms_image_hashes.txt, so the same picture is never attached to a product
+twice, even across restarts.
+
+Usage:
+    futures = attach_images(ms_id, image_urls, name)   # returns immediately
+    ...
+    drain()   # scripts: wait for pending uploads before exiting
+"""
+
+import io
+import os
+import json
+import base64
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from moysklad_client import get_client
+
+DOWNLOAD_WORKERS = int(os.getenv("MS_IMAGE_DOWNLOAD_WORKERS", "8"))
+UPLOAD_WORKERS = int(os.getenv("MS_IMAGE_UPLOAD_WORKERS", "3"))
+DOWNLOAD_TIMEOUT = 15
+HASHES_PATH = os.getenv(
+    "MS_IMAGE_HASHES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ms_image_hashes.txt"),
+)
+
+
+def to_jpeg(content):
+    """Re-encode an image (WB serves WebP/PNG) as JPEG on white; raw bytes if conversion fails."""
+    if Image is None:
+        return content
+    try:
+        img = Image.open(io.BytesIO(content))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+            img = rgb_img
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        img_byte_arr = io.BytesIO()
+        img.save(img_byte_arr, format='JPEG', quality=90)
+        return img_byte_arr.getvalue()
+    except Exception as conv_err:
+        print(f"   ⚠️ Image conversion failed, trying raw: {conv_err}")
+        return content
+
+
+class ImageBody:
+    """
+    {"filename": ..., "content": <base64>} encoded chunk by chunk.
+    Iterable rather than a generator, so a retried request can send it again.
+    """
+    CHUNK = 3 * 16384  # multiple of 3: chunks encode without padding
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.content = content
+        self.prefix = ('{"filename": %s, "content": "' % json.dumps(self.filename)).encode()
+
+    def __len__(self):
+        # Lets requests send a Content-Length instead of a chunked body
+        return len(self.prefix) + 4 * ((len(self.content) + 2) // 3) + 2
+
+    def __iter__(self):
+        yield self.prefix
+        view = memoryview(self.content)
+        for start in range(0, len(view), self.CHUNK):
+            yield base64.b64encode(view[start:start + self.CHUNK])
+        yield b'"}'
+
+
+class UploadedHashes:
+    """Append-only record of '<ms_id> <sha256>' lines already attached in MoySklad."""
+
+    def __init__(self, path=HASHES_PATH):
+        self.path = path
+        self._seen = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._seen is not None:
+            return
+        self._seen = set()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._seen = {line.strip() for line in f if line.strip()}
+            except Exception as e:
+                print(f"⚠️ Could not read image hash log {self.path}: {e}")
+
+    def claim(self, ms_id, digest):
+        """True if this image is not attached (or being attached) to the product yet."""
+        key = f"{ms_id} {digest}"
+        with self._lock:
+            self._load()
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+            return True
+
+    def release(self, ms_id, digest):
+        """Forget a claim whose upload failed, so it can be tried again."""
+        with self._lock:
+            self._seen.discard(f"{ms_id} {digest}")
+
+    def commit(self, ms_id, digest):
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(f"{ms_id} {digest}\n")
+            except Exception as e:
+                print(f"⚠️ Could not record uploaded image: {e}")
+
+
+class ImagePipeline:
+    def __init__(self, client=None, download_workers=DOWNLOAD_WORKERS, upload_workers=UPLOAD_WORKERS):
+        self.ms = client or get_client()
+        self.hashes = UploadedHashes()
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=download_workers))
+        self.downloads = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="ms-img-dl")
+        self.uploads = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="ms-img-up")
+        self.pending = set()
+        self._lock = threading.Lock()
+
+    def _track(self, future):
+        with self._lock:
+            self.pending.add(future)
+        future.add_done_callback(self._untrack)
+
+    def _untrack(self, future):
+        with self._lock:
+            self.pending.discard(future)
+
+    def attach(self, ms_id, image_url, name):
+        """Queue one image for a product; the Future resolves to True once it is attached."""
+        result = Future()
+        if not image_url:
+            result.set_result(False)
+            return result
+        self._track(result)
+        filename = f"{name.replace('/', '_')}.jpg"
+        self.downloads.submit(self._download, ms_id, image_url, filename, result)
+        return result
+
+    def _download(self, ms_id, image_url, filename, result):
+        try:
+            print(f"   📸 Downloading image for MS: {image_url}")
+            resp = self.session.get(image_url, timeout=DOWNLOAD_TIMEOUT)
+            if resp.status_code != 200:
+                print(f"   ❌ Failed to download image: {resp.status_code}")
+                result.set_result(False)
+                return
+            content = to_jpeg(resp.content)
+            digest = hashlib.sha256(content).hexdigest()
+            if not self.hashes.claim(ms_id, digest):
+                print(f"   ⏭️ Image already attached to {ms_id}: {filename}")
+                result.set_result(True)
+                return
+            self.uploads.submit(self._upload, ms_id, content, digest, filename, result)
+        except Exception as e:
+            print(f"   ❌ Error downloading image {image_url}: {e}")
+            result.set_result(False)
+
+    def _upload(self, ms_id, content, digest, filename, result):
+        try:
+            resp = self.ms.post(f"entity/product/{ms_id}/images", data=ImageBody(filename, content), timeout=60)
+            if resp.status_code == 200:
+                self.hashes.commit(ms_id, digest)
+                print(f"   ✅ Image uploaded to MoySklad: {filename}")
+                result.set_result(True)
+                return
+            print(f"   ❌ Failed to upload image to MS: {resp.text}")
+        except Exception as e:
+            print(f"   ❌ Error uploading image {filename}: {e}")
+        self.hashes.release(ms_id, digest)
+        result.set_result(False)
+
+    def drain(self, timeout=None):
+        """Block until every queued image has been uploaded or has failed."""
+        with self._lock:
+            pending = list(self.pending)
+        if pending:
+            print(f"⏳ Waiting for {len(pending)} image uploads...")
+            wait(pending, timeout=timeout)
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = ImagePipeline()
+        return _pipeline
+
+
+def attach_images(ms_id, image_urls, name):
+    """Queue a product's images in the background (named name_1, name_2, ...); returns their Futures."""
+    pipeline = get_pipeline()
+    return [pipeline.attach(ms_id, url, f"{name}_{idx+1}") for idx, url in enumerate(image_urls or [])]
+
+
+def drain(timeout=None):
+    if _pipeline is not None:
+        _pipeline.drain(timeout)
@@ -0,0 +1,106 @@
+"""
+Disk-backed TTL cache for MoySklad metadata.
+
+Folders, price types, product attributes, stores and the organization almost
+never change, but the MS scripts used to look them up on every call (the store
+and organization once per stock entry). Values are cached per key for
+MS_METADATA_TTL seconds and written to data/ms_metadata_cache.json, so a
+restarted worker starts warm.
+
+Usage:
+    store_meta = cache.get_or_fetch("store:Склад ВБ", lambda: fetch_store("Склад ВБ"))
+    cache.invalidate("store:")   # drop every store entry
+
+Clear from the shell with `python3 ms_metadata.py --clear`.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+CACHE_PATH = os.getenv(
+    "MS_METADATA_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ms_metadata_cache.json"),
+)
+TTL = int(os.getenv("MS_METADATA_TTL", str(6 * 3600)))
+
+
+class MetadataCache:
+    def __init__(self, path=CACHE_PATH, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = None  # {key: {"value": ..., "at": unix time}}
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Could not read MS metadata cache {self.path}: {e}")
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # A temp file of our own, so concurrent processes never write into each other's
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(self.path),
+                                             suffix=".tmp", delete=False) as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(f.name, self.path)
+        except Exception as e:
+            print(f"⚠️ Could not save MS metadata cache: {e}")
+
+    def get(self, key):
+        """Cached value, or None if missing or older than the TTL."""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry and time.time() - entry["at"] < self.ttl:
+                return entry["value"]
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()
+            self._entries[key] = {"value": value, "at": time.time()}
+            self._save()
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value or call fetch() and cache its result (None is not cached)."""
+        with self._lock:
+            value = self.get(key)
+            if value is not None:
+                return value
+            value = fetch()
+            if value is not None:
+                self.set(key, value)
+            return value
+
+    def invalidate(self, prefix=None):
+        """Drop entries whose key starts with prefix (everything if None)."""
+        with self._lock:
+            self._load()
+            if prefix is None:
+                self._entries = {}
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if not k.startswith(prefix)}
+            self._save()
+
+
+cache = MetadataCache()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clear", nargs="?", const="", help="Drop all entries, or those starting with a prefix")
+    args = parser.parse_args()
+    if args.clear is not None:
+        cache.invalidate(args.clear or None)
+        print("🧹 MS metadata cache cleared.")
@@ -1,10 +1,14 @@
 import os
+import sys
 import json
 import requests
 import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import base64
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ms_metadata import cache as ms_cache
+from moysklad_client import get_client
 
 # Load Ozon Env
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +29,7 @@ load_dotenv(ms_env_path)
 
 MOYSKLAD_LOGIN = os.getenv('MOYSKLAD_LOGIN')
 MOYSKLAD_PASSWORD = os.getenv('MOYSKLAD_PASSWORD')
+ms = get_client(MOYSKLAD_LOGIN, MOYSKLAD_PASSWORD)
 
 # Cache File
 CACHE_FILE = os.path.join(script_dir, "synced_orders.json")
@@ -39,11 +44,6 @@ def save_cache(cache):
     with open(CACHE_FILE, "w") as f:
         json.dump(cache, f, indent=2)
 
-def get_ms_auth_header():
-    auth_str = f"{MOYSKLAD_LOGIN}:{MOYSKLAD_PASSWORD}"
-    encoded_auth = base64.b64encode(auth_str.encode()).decode()
-    return {"Authorization": f"Basic {encoded_auth}"}
-
 def get_ozon_orders():
     url = "https://api-seller.ozon.ru/v3/posting/fbs/list"
     headers = {
@@ -79,11 +79,8 @@ def get_ozon_orders():
 
 def find_ms_product(article):
     # 1. Try exact match
-    url = f"https://api.moysklad.ru/api/remap/1.2/entity/product?filter=article={article}"
-    headers = get_ms_auth_header()
-    
     try:
-        resp = requests.get(url, headers=headers)
+        resp = ms.get("entity/product", params={"filter": f"article={article}"})
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -93,8 +90,7 @@ def find_ms_product(article):
         if '_' in article:
             clean_article = article.split('_')[0]
             print(f"ℹ️ Retrying search with clean article: {clean_article}")
-            url = f"https://api.moysklad.ru/api/remap/1.2/entity/product?filter=article={clean_article}"
-            resp = requests.get(url, headers=headers)
+            resp = ms.get("entity/product", params={"filter": f"article={clean_article}"})
             if resp.status_code == 200:
                 rows = resp.json().get('rows', [])
                 if rows:
@@ -105,22 +101,21 @@ def find_ms_product(article):
     return None
 
 def get_or_create_agent():
+    return ms_cache.get_or_fetch("counterparty:Покупатель Ozon", _fetch_or_create_agent)
+
+def _fetch_or_create_agent():
     # Find or create "Ozon Buyer"
     name = "Покупатель Ozon"
-    url = f"https://api.moysklad.ru/api/remap/1.2/entity/counterparty?filter=name={name}"
-    headers = get_ms_auth_header()
-    
     try:
-        resp = requests.get(url, headers=headers)
+        resp = ms.get("entity/counterparty", params={"filter": f"name={name}"})
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
                 return rows[0]
             
         # Create
-        create_url = "https://api.moysklad.ru/api/remap/1.2/entity/counterparty"
         payload = {"name": name}
-        resp = requests.post(create_url, headers=headers, json=payload)
+        resp = ms.post("entity/counterparty", json=payload)
         if resp.status_code == 200:
             return resp.json()
     except Exception as e:
@@ -128,10 +123,11 @@ def get_or_create_agent():
     return None
 
 def get_organization():
-    url = "https://api.moysklad.ru/api/remap/1.2/entity/organization"
-    headers = get_ms_auth_header()
+    return ms_cache.get_or_fetch("organization_row", _fetch_organization)
+
+def _fetch_organization():
     try:
-        resp = requests.get(url, headers=headers)
+        resp = ms.get("entity/organization")
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -141,11 +137,12 @@ def get_organization():
     return None
 
 def get_main_warehouse():
+    return ms_cache.get_or_fetch("store_row:Основной склад", _fetch_main_warehouse)
+
+def _fetch_main_warehouse():
     # "Основной склад"
-    url = "https://api.moysklad.ru/api/remap/1.2/entity/store?filter=name=Основной склад"
-    headers = get_ms_auth_header()
     try:
-        resp = requests.get(url, headers=headers)
+        resp = ms.get("entity/store", params={"filter": "name=Основной склад"})
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -155,9 +152,6 @@ def get_main_warehouse():
     return None
 
 def create_ms_order(ozon_order, agent, organization, warehouse):
-    url = "https://api.moysklad.ru/api/remap/1.2/entity/customerorder"
-    headers = get_ms_auth_header()
-    
     posting_number = ozon_order.get('posting_number')
     products = ozon_order.get('products', [])
     
@@ -197,7 +191,7 @@ def create_ms_order(ozon_order, agent, organization, warehouse):
     }
     
     try:
-        resp = requests.post(url, headers=headers, json=payload)
+        resp = ms.post("entity/customerorder", json=payload)
         if resp.status_code == 200:
             print(f"✅ Created MS Order: {posting_number}")
             return True
@@ -243,11 +237,8 @@ def get_ozon_cancelled_orders():
 
 def cancel_ms_order(posting_number):
     # Find order by name
-    url = f"https://api.moysklad.ru/api/remap/1.2/entity/customerorder?filter=name={posting_number}"
-    headers = get_ms_auth_header()
-    
     try:
-        resp = requests.get(url, headers=headers)
+        resp = ms.get("entity/customerorder", params={"filter": f"name={posting_number}"})
         if resp.status_code == 200:
             rows = resp.json().get('rows', [])
             if rows:
@@ -259,7 +250,7 @@ def cancel_ms_order(posting_number):
                 # Update to applicable=False
                 update_url = order['meta']['href']
                 payload = {"applicable": False}
-                update_resp = requests.put(update_url, headers=headers, json=payload)
+                update_resp = ms.put(update_url, json=payload)
                 
                 if update_resp.status_code == 200:
                     print(f"✅ Cancelled MS Order: {posting_number} (Reserve released)")
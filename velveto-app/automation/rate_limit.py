@@ -0,0 +1,51 @@
+"""
+Thread-safe token-bucket rate limiting.
+
+RateLimiter(rate, burst) allows `rate` calls per second on average with
+bursts of up to `burst`. throttle(host) applies a shared per-host limiter so
+concurrent workers never exceed a host's budget in aggregate.
+"""
+
+import os
+import time
+import threading
+
+DEFAULT_HOST_RATE = float(os.getenv("HOST_RATE_LIMIT", "10"))
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then consume them."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_host_limiters = {}
+_host_lock = threading.Lock()
+
+
+def for_host(host, rate=None, burst=None):
+    """Shared limiter for a host, created on first use."""
+    with _host_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = RateLimiter(rate or DEFAULT_HOST_RATE, burst)
+        return _host_limiters[host]
+
+
+def throttle(host, rate=None):
+    for_host(host, rate).acquire()
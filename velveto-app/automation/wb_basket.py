@@ -0,0 +1,230 @@
+"""
+Wildberries basket host resolver.
+
+Card data and images for an article live on one of the
+basket-NN.wbbasket.ru hosts, chosen by the article's `vol` (nm_id // 100000).
+Baskets are assigned to volumes in increasing order, so the mapping is a
+sorted list of [vol_from, vol_to, basket] ranges. The table is kept on disk,
+looked up with bisect, and grows every time a probe finds a new volume.
+"""
+
+import os
+import json
+import bisect
+import tempfile
+import threading
+import requests
+import rate_limit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+TABLE_PATH = os.getenv(
+    "WB_BASKET_TABLE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "wb_basket_ranges.json"),
+)
+MAX_BASKET = 50
+PROBE_WORKERS = 8
+PROBE_TIMEOUT = 2
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+# Known ranges used until the on-disk table exists
+SEED_RANGES = [
+    [0, 143, 1], [144, 287, 2], [288, 431, 3], [432, 719, 4], [720, 1007, 5],
+    [1008, 1061, 6], [1062, 1115, 7], [1116, 1169, 8], [1170, 1313, 9], [1314, 1601, 10],
+    [1602, 1655, 11], [1656, 1919, 12], [1920, 2045, 13], [2046, 2189, 14], [2190, 2405, 15],
+    [2406, 2621, 16], [2622, 2837, 17], [2838, 3053, 18], [3054, 3269, 19], [3270, 3485, 20],
+    [3486, 3701, 21], [3702, 3917, 22], [3918, 4133, 23], [4134, 4349, 24], [4350, 4565, 25],
+    [4566, 4781, 26], [4782, 4997, 27], [4998, 5213, 28], [5214, 5429, 29], [5430, 5645, 30],
+    [5646, 5861, 31], [5862, 6077, 32], [6078, 6293, 33], [6294, 6509, 34], [6510, 6725, 35],
+    [6726, 6941, 36], [6942, 7157, 37], [7158, 7373, 38], [7374, 7589, 39], [7590, 7805, 40],
+    [7806, 8021, 41], [8022, 8237, 42],
+]
+
+_lock = threading.Lock()
+_ranges = None  # sorted list of [vol_from, vol_to, basket]
+_starts = []
+_session = requests.Session()
+_session.headers.update(HEADERS)
+_executor = None
+
+
+def get_basket_number(nm_id):
+    vol = nm_id // 100000
+    part = nm_id // 1000
+    return vol, part
+
+
+def host_name(basket):
+    return f"basket-{basket:02d}.wbbasket.ru"
+
+
+def _load():
+    global _ranges, _starts
+    if _ranges is not None:
+        return
+    ranges = None
+    if os.path.exists(TABLE_PATH):
+        try:
+            with open(TABLE_PATH, "r", encoding="utf-8") as f:
+                ranges = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Could not read basket table {TABLE_PATH}: {e}")
+    _ranges = sorted(ranges or [list(r) for r in SEED_RANGES])
+    _starts = [r[0] for r in _ranges]
+
+
+def _save():
+    try:
+        os.makedirs(os.path.dirname(TABLE_PATH), exist_ok=True)
+        # A temp file of our own, so concurrent processes never write into each other's
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(TABLE_PATH),
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(_ranges, f)
+        os.replace(f.name, TABLE_PATH)
+    except Exception as e:
+        print(f"⚠️ Could not save basket table: {e}")
+
+
+def _find(vol):
+    """Index of the range containing vol, or -(insertion point) - 1."""
+    idx = bisect.bisect_right(_starts, vol) - 1
+    if idx >= 0 and _ranges[idx][0] <= vol <= _ranges[idx][1]:
+        return idx
+    return -(idx + 1) - 1
+
+
+def lookup_basket(vol):
+    """Return the known basket number for vol, or None."""
+    with _lock:
+        _load()
+        idx = _find(vol)
+        return _ranges[idx][2] if idx >= 0 else None
+
+
+def learn(vol, basket):
+    """Record a confirmed vol -> basket hit, merging it into neighbouring ranges."""
+    with _lock:
+        _load()
+        idx = _find(vol)
+        if idx >= 0:
+            lo, hi, old_basket = _ranges[idx]
+            if old_basket == basket:
+                return
+            # Stale entry: carve this vol out of the known range
+            split = [r for r in ([lo, vol - 1, old_basket], [vol + 1, hi, old_basket]) if r[0] <= r[1]]
+            _ranges[idx:idx + 1] = split
+            pos = idx + (1 if split and split[0][1] < vol else 0)
+        else:
+            pos = -(idx + 1)
+
+        new_range = [vol, vol, basket]
+        # Baskets grow with vol, so a gap between two ranges of the same basket is that basket too
+        if pos > 0 and _ranges[pos - 1][2] == basket:
+            new_range[0] = _ranges[pos - 1][0]
+            del _ranges[pos - 1]
+            pos -= 1
+        if pos < len(_ranges) and _ranges[pos][2] == basket:
+            new_range[1] = _ranges[pos][1]
+            del _ranges[pos]
+        _ranges.insert(pos, new_range)
+        _starts[:] = [r[0] for r in _ranges]
+        _save()
+
+
+def _candidates(vol, exclude=None):
+    """Baskets worth probing for vol, most likely first."""
+    with _lock:
+        _load()
+        idx = _find(vol)
+        if idx >= 0:
+            low = high = _ranges[idx][2]
+        else:
+            pos = -(idx + 1)
+            low = _ranges[pos - 1][2] if pos > 0 else 1
+            high = _ranges[pos][2] if pos < len(_ranges) else MAX_BASKET
+
+    likely = list(range(low, high + 1))
+    rest = [b for b in range(1, MAX_BASKET + 1) if b not in likely]
+    # Newer volumes land on newer baskets, so try the ones after the likely window first
+    rest.sort(key=lambda b: (b < low, abs(b - low)))
+    return [b for b in likely + rest if b != exclude]
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="wb-basket")
+        return _executor
+
+
+def _probe(basket, path, method):
+    url = f"https://{host_name(basket)}/{path}"
+    try:
+        rate_limit.throttle(host_name(basket))
+        resp = _session.request(method, url, timeout=PROBE_TIMEOUT)
+        if resp.status_code == 200:
+            return basket, resp
+    except Exception:
+        pass
+    return None
+
+
+def _probe_all(vol, path, method, exclude=None):
+    """Probe candidate baskets concurrently, cancelling the rest on the first hit."""
+    executor = _get_executor()
+    pending = {executor.submit(_probe, b, path, method) for b in _candidates(vol, exclude)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result:
+                    return result
+    finally:
+        for future in pending:
+            future.cancel()
+    return None
+
+
+def _request(nm_id, suffix, method):
+    vol, part = get_basket_number(nm_id)
+    path = f"vol{vol}/part{part}/{nm_id}/{suffix}"
+
+    basket = lookup_basket(vol)
+    if basket:
+        hit = _probe(basket, path, method)
+        if hit:
+            return hit
+    hit = _probe_all(vol, path, method, exclude=basket)
+    if hit:
+        learn(vol, hit[0])
+    return hit
+
+
+def fetch_card(nm_id):
+    """
+    Fetch info/ru/card.json for an article.
+    Returns (card_dict, host); (None, None) if no basket serves it.
+    """
+    hit = _request(nm_id, "info/ru/card.json", "GET")
+    if not hit:
+        return None, None
+    basket, resp = hit
+    try:
+        return resp.json(), host_name(basket)
+    except ValueError:
+        return None, host_name(basket)
+
+
+def resolve_image_host(nm_id):
+    """Find the host serving images/big/1.webp for an article, or None."""
+    hit = _request(nm_id, "images/big/1.webp", "HEAD")
+    return host_name(hit[0]) if hit else None
+
+
+def build_image_urls(nm_id, host, count):
+    vol, part = get_basket_number(nm_id)
+    return [f"https://{host}/vol{vol}/part{part}/{nm_id}/images/big/{i}.webp" for i in range(1, count + 1)]
@@ -0,0 +1,103 @@
+"""
+Batched client for WB's cards/v4/detail endpoint.
+
+The endpoint takes a `;`-separated list of nm ids, so a whole search page
+(or a reparse batch) costs a handful of requests instead of one per article.
+Results are returned as {nm_id: product}, where product is the same dict
+callers previously stored as `v4_data`.
+"""
+
+import time
+import requests
+import rate_limit
+from concurrent.futures import ThreadPoolExecutor
+
+V4_DETAIL_URL = "https://card.wb.ru/cards/v4/detail"
+CHUNK_SIZE = 50
+MAX_WORKERS = 4
+MAX_ATTEMPTS = 4
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+_session = requests.Session()
+_session.headers.update(HEADERS)
+
+
+def _retry_delay(resp, attempt):
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return 2 ** attempt
+
+
+def _fetch_chunk(nm_ids):
+    """Products of one chunk; None if it could not be fetched (429/5xx/network after retries)."""
+    params = {
+        "appType": 1,
+        "curr": "kzt",
+        "dest": 82,
+        "nm": ";".join(str(nm_id) for nm_id in nm_ids),
+    }
+    for attempt in range(MAX_ATTEMPTS):
+        resp = None
+        try:
+            rate_limit.throttle("card.wb.ru")
+            resp = _session.get(V4_DETAIL_URL, params=params, timeout=10)
+            if resp.status_code == 200:
+                data = resp.json()
+                return data.get('data', {}).get('products', []) or data.get('products', [])
+            print(f"  ⚠️ v4 detail returned {resp.status_code} for {len(nm_ids)} ids")
+            if resp.status_code not in RETRY_STATUSES:
+                return None
+        except Exception as e:
+            print(f"  Error fetching v4 details: {e}")
+        if attempt < MAX_ATTEMPTS - 1:
+            time.sleep(_retry_delay(resp, attempt))
+    return None
+
+
+def fetch_v4_batch(nm_ids, chunk_size=CHUNK_SIZE):
+    """
+    Fetch v4 detail for many articles. Returns ({nm_id: product}, failed_ids): ids missing
+    from a good response are simply absent, ids of chunks that failed are in failed_ids.
+    """
+    unique_ids = list(dict.fromkeys(int(nm_id) for nm_id in nm_ids))
+    chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+    if not chunks:
+        return {}, set()
+
+    result = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunks))) as executor:
+        for chunk, products in zip(chunks, executor.map(_fetch_chunk, chunks)):
+            if products is None:
+                failed.update(chunk)
+                continue
+            for product in products:
+                if product.get('id'):
+                    result[product['id']] = product
+    return result, failed
+
+
+def fetch_v4_details(nm_ids, chunk_size=CHUNK_SIZE):
+    """Fetch v4 detail for many articles. Ids missing from the response (or failed) are absent from the result."""
+    return fetch_v4_batch(nm_ids, chunk_size)[0]
+
+
+def fetch_v4_detail(nm_id):
+    """Single-article convenience wrapper; returns the product dict or None."""
+    return fetch_v4_details([nm_id]).get(int(nm_id))
+
+
+def get_price_kzt(v4_data):
+    """Final price in KZT: first size price, falling back to salePriceU (both in cents)."""
+    sizes = v4_data.get('sizes', [])
+    if sizes and 'price' in sizes[0]:
+        price_cents = sizes[0]['price'].get('product', 0)
+        if price_cents > 0:
+            return price_cents // 100
+    price_val = v4_data.get('salePriceU', 0)
+    return price_val // 100 if price_val > 0 else 0
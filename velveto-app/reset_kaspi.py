@@ -12,20 +12,17 @@ supabase = create_client(sb_url, sb_key)
 print("🔄 Resetting products with potential Kaspi validation errors...")
 
 # Query using JSONB arrow operator
-query = supabase.schema('Parser').table('wb_search_results').select("id, specs") \
+query = supabase.schema('Parser').table('wb_search_results').select("id, specs, kaspi_status") \
     .eq("kaspi_created", True) \
     .limit(1000)
 
-# We can also add a filter for specs->>kaspi_status.neq.approved manually if needed
-# but let's just fetch all created and filtered in python if needed.
-
 res = query.execute()
 
 if not res.data:
     print("No products found to reset.")
     sys.exit(0)
 
-filtered_data = [p for p in res.data if p.get('specs', {}).get('kaspi_status') != 'approved']
+filtered_data = [p for p in res.data if p.get('kaspi_status') != 'approved']
 print(f"📡 Found {len(filtered_data)} products to reset (excluding approved).")
 
 # Do it in batches of 50
@@ -46,6 +43,9 @@ for i in range(0, len(filtered_data), batch_size):
         try:
              supabase.schema('Parser').table('wb_search_results').update({
                 "kaspi_created": False,
+                "kaspi_status": None,
+                "kaspi_sku": None,
+                "kaspi_upload_id": None,
                 "conveyor_status": "idle",
                 "specs": specs
             }).eq("id", pid).execute()
@@ -4,10 +4,20 @@ import sys
 import subprocess
 import threading
 import concurrent.futures
+import multiprocessing
+import json
 import random
+import select
+import signal
+import socket
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
 # Load env from local file robustly
 current_dir = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(current_dir, "velveto-app", ".env.local"))
@@ -47,10 +57,14 @@ except ImportError as e:
         print("Conveyor logic not available due to import error.")
 
 try:
-    from sync_to_airtable import sync_products as sync_to_airtable_func
+    from sync_to_airtable import mark_dirty, request_full_sync, start_sync_loop
 except ImportError as e:
     print(f"⚠️ Warning: Could not import Airtable sync logic: {e}")
-    def sync_to_airtable_func():
+    def mark_dirty(ids):
+        pass
+    def start_sync_loop():
+        pass
+    def request_full_sync():
         # Fallback to subprocess if direct import fails
         try:
             script_path = os.path.join(current_dir, "velveto-app", "automation", "airtable", "sync_to_airtable.py")
@@ -75,6 +89,168 @@ except ImportError:
 active_jobs_lock = threading.Lock()
 active_jobs = set()
 
+# Job claiming / leases (see database_migration/008_parser_queue_leases.sql)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 40
+# Safety poll (expired leases, missed notifications); with LISTEN available the worker is otherwise idle
+IDLE_POLL_INTERVAL = 60 if os.environ.get("DATABASE_URL") and psycopg2 else 15
+
+# Set whenever there may be new work: queue notification, slot freed, autonomous job added
+wake_event = threading.Event()
+
+# Slot sizing: each search/top job drives a Chrome (~600 MB); one core stays free for the conveyor thread
+CHROME_JOB_MB = 600
+METRICS_INTERVAL = 60
+
+def auto_slot_count():
+    cpus = os.cpu_count() or 2
+    try:
+        ram_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        ram_mb = 4096
+    by_cpu = cpus - 1
+    by_ram = (ram_mb - 1024) // CHROME_JOB_MB
+    return max(1, min(by_cpu, by_ram))
+
+def max_slots():
+    return int(os.environ.get("PARSER_MAX_SLOTS") or auto_slot_count())
+
+def default_slot_budgets(total):
+    top = max(1, total // 3)
+    return {
+        "search": int(os.environ.get("PARSER_SLOTS_SEARCH") or max(1, total - top)),
+        "top": int(os.environ.get("PARSER_SLOTS_TOP") or top),
+        # Reparse is HTTP-only (no browser), one is plenty
+        "reparse": int(os.environ.get("PARSER_SLOTS_REPARSE") or 1),
+    }
+
+def slot_mode(mode):
+    """Queue mode -> slot pool (same mapping as claim_parser_job)."""
+    return mode if mode in ("top", "reparse") else "search"
+
+class SlotScheduler:
+    """
+    Separate slot budget per job mode so one mode can't starve the others, under a shared
+    cap: the budgets may add up to more than `limit` (every mode keeps at least one slot),
+    but no more than `limit` jobs run at once.
+    """
+
+    def __init__(self, budgets, limit):
+        self.budgets = dict(budgets)
+        self.limit = min(limit, sum(self.budgets.values()))
+        self.busy = {mode: 0 for mode in self.budgets}
+        self.lock = threading.Lock()
+
+    @property
+    def total(self):
+        return self.limit
+
+    def free_modes(self):
+        with self.lock:
+            if sum(self.busy.values()) >= self.limit:
+                return []
+            return [mode for mode, budget in self.budgets.items() if self.busy[mode] < budget]
+
+    def acquire(self, mode):
+        with self.lock:
+            self.busy[slot_mode(mode)] += 1
+
+    def release(self, mode):
+        with self.lock:
+            self.busy[slot_mode(mode)] -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return {mode: {"busy": self.busy[mode], "total": budget} for mode, budget in self.budgets.items()}
+
+_total_slots = max_slots()
+scheduler = SlotScheduler(default_slot_budgets(_total_slots), _total_slots)
+
+def fetch_queue_depth():
+    try:
+        res = supabase.schema('Parser').rpc('parser_queue_depth', {}).execute()
+        return {row['mode']: row['pending'] for row in (res.data or [])}
+    except Exception as e:
+        print(f"⚠️ Queue depth error: {e}")
+        return {}
+
+def start_metrics_reporter():
+    """Log slot usage and queue depth, and publish them to Parser.worker_status."""
+    def report():
+        while True:
+            slots = scheduler.snapshot()
+            depth = fetch_queue_depth()
+            usage = ", ".join(f"{mode} {v['busy']}/{v['total']}" for mode, v in slots.items())
+            print(f"📈 Slots: {usage} | Pending: {depth or 0}")
+            try:
+                supabase.schema('Parser').table('worker_status').upsert({
+                    "worker_id": WORKER_ID,
+                    "slots": slots,
+                    "queue_depth": depth,
+                    "updated_at": "now()"
+                }).execute()
+            except Exception as e:
+                print(f"⚠️ Metrics report error: {e}")
+            time.sleep(METRICS_INTERVAL)
+
+    t = threading.Thread(target=report, daemon=True)
+    t.start()
+    return t
+
+def start_queue_listener():
+    """LISTEN on parser_queue (trigger in migration 008) and wake the dispatcher on inserts."""
+    db_url = os.environ.get("DATABASE_URL")
+    if not db_url or not psycopg2:
+        print("ℹ️ DATABASE_URL/psycopg2 not available, falling back to periodic queue checks.")
+        return None
+
+    def listen_forever():
+        while True:
+            try:
+                conn = psycopg2.connect(db_url)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute("LISTEN parser_queue;")
+                print("👂 Listening for parser_queue notifications...")
+                while True:
+                    if select.select([conn], [], [], 300) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        wake_event.set()
+            except Exception as e:
+                print(f"⚠️ Queue listener error: {e}")
+                time.sleep(10)
+
+    t = threading.Thread(target=listen_forever, daemon=True)
+    t.start()
+    return t
+
+def start_heartbeat(job_id, on_lost=None):
+    """Extend the job lease while it runs. Returns an Event that stops the heartbeat."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                res = supabase.schema('Parser').rpc('heartbeat_parser_job', {
+                    "p_job_id": job_id,
+                    "p_worker_id": WORKER_ID,
+                    "p_lease_seconds": LEASE_SECONDS
+                }).execute()
+                if res.data is False:
+                    print(f"⚠️ Lost lease on job {job_id}")
+                    if on_lost:
+                        on_lost()
+                    return
+            except Exception as e:
+                print(f"⚠️ Heartbeat error for job {job_id}: {e}")
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
 def start_background_services():
     """Starts background services (Kaspi Checker, Airtable Sync)"""
     def run_periodically():
@@ -87,16 +263,16 @@ def start_background_services():
             except Exception as e:
                 print(f"⚠️ Kaspi Status Checker Error: {e}")
             
-            # 2. Airtable Sync
+            # 2. Airtable Sync (queued; the sync loop coalesces it with job-triggered runs)
             try:
-                # print("⏱️  Running Periodic Airtable Sync...")
-                sync_to_airtable_func()
+                request_full_sync()
             except Exception as e:
                 print(f"⚠️ Airtable Sync Error: {e}")
 
             time.sleep(300) # Every 5 minutes
             
     print("🚀 Starting Background Services (Kaspi Checker + Airtable Sync)...")
+    start_sync_loop()
     t = threading.Thread(target=run_periodically, daemon=True)
     t.start()
     return t
@@ -134,80 +310,184 @@ def check_autonomous_mode():
         print(f"⚠️ Autonomous Mode Check Error: {e}")
     return False
 
+# Parser jobs run in long-lived job processes, forked from a forkserver that already imported
+# parse_wb_top (selenium, supabase, curl_cffi) and the modules this file imports (the child
+# re-runs this module's top level), instead of one `python3 parse_wb_top.py` per job.
+# A job process serves one job at a time and is reused, so its browser pool and HTTP clients
+# stay warm between jobs. One stuck past the timeout is terminated and replaced, and its slot
+# is only freed once it is gone.
+JOB_TIMEOUT = 1200 # 20 min, from the moment the job process starts
+CANCEL_GRACE = 60
+KILL_GRACE = 10
+JOB_PRELOAD = ['parse_wb_top', 'process_conveyor', 'sync_to_airtable', 'telegram_bot']
+
+_job_ctx = None
+_job_ctx_lock = threading.Lock()
+
+def get_job_context():
+    global _job_ctx
+    with _job_ctx_lock:
+        if _job_ctx is None:
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(JOB_PRELOAD)
+            _job_ctx = ctx
+        return _job_ctx
+
+def _job_process_loop(conn, cancel_event):
+    # SIGTERM (timeout, worker exit) unwinds the loop so the finally below still closes the browsers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    import browser_pool
+    try:
+        import parse_wb_top
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            try:
+                outcome = ("ok", parse_wb_top.run_job(job, cancel_event))
+            except Exception as e:
+                outcome = ("exception", str(e))
+            conn.send(outcome)
+    finally:
+        # atexit does not run in multiprocessing children
+        browser_pool.close_all()
+
+class JobProcess:
+    """A long-lived job process; run() hands it one job, recv() waits for the outcome."""
+
+    def __init__(self, ctx):
+        self.cancel_event = ctx.Event()
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_job_process_loop, args=(child_conn, self.cancel_event), name="job-process", daemon=True)
+        self.proc.start()
+        child_conn.close()
+
+    def run(self, job):
+        self.cancel_event.clear()
+        self.conn.send(job)
+
+    def stop(self):
+        """Terminate, then kill, a job process that did not stop on its own."""
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.proc.join(KILL_GRACE)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join(KILL_GRACE)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+_idle_job_processes = []
+_idle_job_processes_lock = threading.Lock()
+
+def acquire_job_process():
+    """An idle job process, or a new one; at most one per running job ever exists."""
+    with _idle_job_processes_lock:
+        while _idle_job_processes:
+            job_process = _idle_job_processes.pop()
+            if job_process.proc.is_alive():
+                return job_process
+            job_process.stop()
+    return JobProcess(get_job_context())
+
+def release_job_process(job_process, reusable):
+    if reusable and job_process.proc.is_alive():
+        with _idle_job_processes_lock:
+            _idle_job_processes.append(job_process)
+    else:
+        job_process.stop()
+
 def run_parser(job):
     job_id = job['id']
     mode = job['mode']
     query = job.get('query', '')
     
-    with active_jobs_lock:
-        active_jobs.add(job_id)
-        
     print(f"🚀 Starting job {job_id}: {mode} '{query}'...")
     
-    # Mark as processing
-    supabase.schema('Parser').table("parser_queue").update({"status": "processing"}).eq("id", job_id).execute()
-    
-    script_path = os.path.join(current_dir, "velveto-app", "automation", "moysklad", "parse_wb_top.py")
-    cmd = ["python3", script_path]
+    job_process = acquire_job_process()
+    reusable = False
     
-    if mode == 'top':
-        cmd.extend(["--mode", "top"])
-    else:
-        cmd.extend([query])
-        
-    cmd.extend(["--page", str(job.get('page', 1))])
+    # Already marked processing by claim_parser_job; keep the lease alive while we run
+    heartbeat = start_heartbeat(job_id, on_lost=job_process.cancel_event.set)
     
     try:
-        # Run with timeout to prevent ghost jobs
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=1200) # 20 min timeout
+        job_process.run(job)
+        recv_conn = job_process.conn
+        
+        outcome = None
+        if recv_conn.poll(JOB_TIMEOUT):
+            outcome = recv_conn.recv()
+            reusable = True
+        else:
+            print(f"⌛ Job {job_id} timed out, cancelling...")
+            job_process.cancel_event.set()
+            if recv_conn.poll(CANCEL_GRACE):
+                outcome = recv_conn.recv()
+                reusable = True
+            else:
+                print(f"🔪 Job {job_id} did not stop, terminating its process...")
+                job_process.proc.terminate()
+            result = outcome[1] if outcome and outcome[0] == "ok" else {"status": "error", "errors": []}
+            result["errors"].append("Timeout error (20 minutes)")
+            result["status"] = "error"
+            outcome = ("ok", result)
+        
+        if outcome[0] == "exception":
+            raise Exception(outcome[1])
+        result = outcome[1]
         
-        if result.returncode == 0:
-            print(f"✅ Job {job_id} completed!")
-            supabase.schema('Parser').table("parser_queue").update({
-                "status": "completed",
-                "log": f"Success. Log: {result.stdout[-2000:]}"
-            }).eq("id", job_id).execute()
+        # Only the rows this job wrote go to Airtable
+        mark_dirty(result.pop("dirty_ids", []))
+        
+        if result["status"] == "completed":
+            print(f"✅ Job {job_id} completed! {result.get('counts')} in {result.get('timings', {}).get('total')}s")
         else:
-            print(f"❌ Job {job_id} failed!")
-            supabase.schema('Parser').table("parser_queue").update({
-                "status": "error",
-                "log": result.stderr[-2000:]
-            }).eq("id", job_id).execute()
+            print(f"❌ Job {job_id} {result['status']}: {result.get('errors')}")
+        supabase.schema('Parser').table("parser_queue").update({
+            "status": "completed" if result["status"] == "completed" else "error",
+            "log": json.dumps(result, ensure_ascii=False)
+        }).eq("id", job_id).eq("worker_id", WORKER_ID).execute()
             
-    except subprocess.TimeoutExpired:
-        print(f"⌛ Job {job_id} timed out!")
+    except (EOFError, BrokenPipeError):
+        job_process.proc.join(KILL_GRACE)
+        exitcode = job_process.proc.exitcode
+        print(f"❌ Job process crashed for job {job_id} (exit code {exitcode})")
         supabase.schema('Parser').table("parser_queue").update({
             "status": "error",
-            "log": "Timeout error (20 minutes)"
-        }).eq("id", job_id).execute()
+            "log": f"Job process crashed (exit code {exitcode})"
+        }).eq("id", job_id).eq("worker_id", WORKER_ID).execute()
     except Exception as e:
         print(f"❌ Exception in job {job_id}: {e}")
         supabase.schema('Parser').table("parser_queue").update({
             "status": "error",
             "log": str(e)
-        }).eq("id", job_id).execute()
+        }).eq("id", job_id).eq("worker_id", WORKER_ID).execute()
     finally:
+        # Stop the heartbeat first: a late lost-lease callback must not cancel the next job
+        heartbeat.set()
+        # The slot is only released once the job process is idle again or really gone
+        release_job_process(job_process, reusable)
         with active_jobs_lock:
             active_jobs.remove(job_id)
-        
-        # Trigger immediate Airtable sync after job
-        try:
-            print(f"🔄 Job {job_id} finished, triggering Airtable sync...")
-            sync_to_airtable_func()
-        except Exception as e:
-            print(f"⚠️ Error in post-job sync: {e}")
+        scheduler.release(mode)
+        wake_event.set()
 
-def fetch_next_job():
-    # 1. Check for search jobs
-    res = supabase.schema('Parser').table("parser_queue").select("*").eq("status", "pending").eq("mode", "search").order("created_at", desc=False).limit(1).execute()
+def claim_next_job(modes):
+    """Atomically claim the highest-priority pending (or lease-expired) job among `modes`."""
+    res = supabase.schema('Parser').rpc('claim_parser_job', {
+        "p_worker_id": WORKER_ID,
+        "p_modes": modes,
+        "p_lease_seconds": LEASE_SECONDS
+    }).execute()
     if res.data:
         return res.data[0]
-        
-    # 2. Check for any other jobs (top)
-    res = supabase.schema('Parser').table("parser_queue").select("*").eq("status", "pending").order("created_at", desc=False).limit(1).execute()
-    if res.data:
-        return res.data[0]
-        
     return None
 
 def main():
@@ -215,6 +495,10 @@ def main():
     
     # Start Services
     start_background_services()
+    start_queue_listener()
+    start_metrics_reporter()
+    print(f"🧮 Slot budgets: {scheduler.budgets} (at most {scheduler.limit} at once)")
+    get_job_context()
     
     # Also start the Conveyor Logic (Stream Processor)
     print("🚀 Starting Integrated Conveyor Stream...")
@@ -223,30 +507,33 @@ def main():
     t_conveyor.start()
     
     # Use ThreadPoolExecutor for concurrent jobs
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scheduler.total) as executor:
         while True:
             try:
-                # Check if we have slots available
-                with active_jobs_lock:
-                    slots_busy = len(active_jobs)
+                wake_event.clear()
+                
+                # Check which mode pools have free slots
+                free_modes = scheduler.free_modes()
                 
                 job = None
-                if slots_busy < 2:
-                    job = fetch_next_job()
+                if free_modes:
+                    job = claim_next_job(free_modes)
                     
-                    if not job:
-                        # If no job, try Autonomous Mode
+                    if not job and "search" in free_modes:
+                        # If no job, try Autonomous Mode (adds a search job)
                         if check_autonomous_mode():
-                            job = fetch_next_job()
+                            job = claim_next_job(free_modes)
 
                     if job:
                         with active_jobs_lock:
-                            if job['id'] in active_jobs:
-                                continue
-                        
+                            active_jobs.add(job['id'])
+                        scheduler.acquire(job['mode'])
                         executor.submit(run_parser, job)
+                        # More work may be waiting; try to fill the next slot right away
+                        continue
                 
-                time.sleep(2)
+                # Sleep until a notification / finished job, or the safety poll
+                wake_event.wait(IDLE_POLL_INTERVAL)
                 
             except Exception as e:
                 error_msg = f"⚠️ <b>Main Loop Error</b>\n{str(e)}"